@@ -0,0 +1,852 @@
+"""
+وضع async للبوت (ASGI): نفس منطق bot.py (الجلسات، الكتالوج، الـ prompt، الكاش، الـ routing،
+الـ leads، الـ snapshot) بس كل الانتظار على event loop واحد بدل thread لكل انتظار:
+- الـ webhook يتحقق من التوقيع ويحط الـ body بطابور بالذاكرة ويرد 200 فوراً؛ consumer واحد
+  يسوي التكرار والجلسة والـ leads (SQLite) بـ thread واحد (INGEST_POOL)
+- كل call للـ store أو الـ leads (ممكن SQLite يبلوك) يمشي بـ thread (asyncio.to_thread)،
+  والـ loop يبقى بس للتايمرات والـ HTTP
+- تايمرات الـ debounce والـ typing = loop.call_later
+- Graph و OpenAI و CallMeBot بـ httpx.AsyncClient و AsyncOpenAI على نفس الـ loop
+
+    uvicorn asgi_bot:app --host 0.0.0.0 --port $PORT
+
+على Heroku بس الـ web process يستلم HTTP، فالـ Procfile يشغل هذا بدل gunicorn إذا BOT_RUNTIME=asyncio.
+
+وضع Flask (gunicorn bot:app) يبقى مثل ما هو؛ هذا الملف يستورد bot.py بـ BOT_RUNTIME=asyncio
+حتى threads الخلفية مالته ما تشتغل.
+"""
+import os
+
+os.environ.setdefault("BOT_RUNTIME", "asyncio")
+
+import asyncio
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import httpx
+from openai import AsyncOpenAI
+
+import bot
+from bot import (
+    ANSWER_CACHE, BREAKERS, CALLMEBOT_URL, CALL_BUDGET, DEBOUNCE, GRAPH_BATCH, GRAPH_BATCH_MAX,
+    GRAPH_BATCH_RETRIES, GRAPH_BATCH_URL, GRAPH_BATCH_WINDOW, GRAPH_MESSAGES_URL, HTTP_POOL_HOSTS,
+    HTTP_POOL_PER_HOST, LEADS, LLM_STATS, METRICS, MODEL_TIERS, OPENAI_API_KEY, OPENAI_CONCURRENCY,
+    OPENAI_QUEUE_MAX, OPENAI_STREAM, REPLY_BUDGET, REQUEST_TIMEOUT, RESUME_DELAY, ROUTER, SEND_PENDING,
+    SESSION_SNAPSHOT, STORE, TENANTS, TYPING_DELAY, TYPING_REFRESH, VERIFY_TOKEN, CircuitOpenError, GraphBatcher, MemorySessionStore,
+    MessengerClient, Overloaded, ReplyStream, RetryPlan, RetryableError, SessionSnapshot, TypingManager,
+    backoff_delay, call_deadline, classify_response, completion_args, current_tenant, deadline_budget,
+    INGEST_QUEUE_SIZE, extract_iraqi_phone, failed_answer, format_leads, get_session, ingest_events, lead_recipient,
+    log, valid_signature,
+    model_answer, note_reply, openai_errors, plain_reply, prepare_answer, quick_answer, record_user_message,
+    requeue_inflight, rss_bytes, set_trace, settle_reply, take_batch, use_tenant,
+)
+
+if bot.THREADED:
+    raise RuntimeError("asgi_bot needs BOT_RUNTIME=asyncio (bot.py was imported in threads mode)")
+
+LOOP_LAG_INTERVAL = 0.5    # كل نص ثانية نقيس تأخر الـ loop (إذا شي بلوكه يبين هنا)
+
+# تنخلق بالـ startup داخل الـ loop
+HTTP = None        # httpx.AsyncClient واحد (keep-alive) لـ Graph و CallMeBot
+AOPENAI = None
+
+_TASKS = set()     # مراجع للـ tasks حتى الـ GC ما يمسحها بالنص
+
+def spawn(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _TASKS.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
+def _task_done(task):
+    _TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log("Task error:", task.exception())
+
+# =======================================================
+# 🛡️ Resilience (bot.RetryPlan، بس الانتظار await)
+# =======================================================
+async def resilient_call(endpoint, attempt, *, retries=1, budget=CALL_BUDGET):
+    """attempt(remaining) هنا coroutine؛ القرارات كلها من bot.RetryPlan."""
+    plan = RetryPlan(endpoint, retries, budget)
+    while (remaining := plan.start()) is not None:
+        try:
+            result = await attempt(remaining)
+        except RetryableError as e:
+            wait = plan.failed(e)
+            if wait is None:
+                break
+            await asyncio.sleep(wait)
+        except Exception:
+            plan.rejected()
+            raise
+        else:
+            plan.succeeded()
+            return result
+    raise plan.give_up()
+
+async def http_request(method, url, *, params=None, json=None, data=None, timeout=REQUEST_TIMEOUT, retries=1,
+                       budget=CALL_BUDGET):
+    """مثل MessengerClient.request: يرجع الـ response، أو None إذا فشل أو الـ breaker مفتوح."""
+    endpoint = MessengerClient.endpoint(url)
+
+    async def attempt(remaining):
+        t0 = time.monotonic()
+        try:
+            r = await HTTP.request(method, url, params=params, json=json, data=data, timeout=min(timeout, remaining))
+        except httpx.TransportError as e:
+            raise RetryableError(str(e) or type(e).__name__) from e
+        METRICS.observe("http_request_seconds", time.monotonic() - t0, endpoint=endpoint)
+        if r.status_code >= 400:
+            retryable, wait = classify_response(r)
+            msg = f"HTTP {r.status_code}: {r.text[:200]}"
+            if retryable:
+                raise RetryableError(msg, wait)
+            raise httpx.HTTPStatusError(msg, request=r.request, response=r)
+        return r
+
+    try:
+        return await resilient_call(endpoint, attempt, retries=retries, budget=budget)
+    except CircuitOpenError:
+        return None
+    except Exception as e:
+        log(f"{method} {url} failed:", e)
+        return None
+
+# =======================================================
+# 📦 Graph (batch على الـ loop)
+# =======================================================
+class AsyncGraph:
+    """
+    نسخة الـ event loop من GraphBatcher: الإرسالات اللي توصل خلال GRAPH_BATCH_WINDOW
+    تطلع بـ batch request واحد (نفس batch_form / batch_results).
+    كل مستخدم إرساله الجديد ينتظر اللي قبله يخلص، فالترتيب (typing ثم الرسالة) محفوظ.
+    كل إرسال يحمل توكن صفحته، والـ batch الواحد ممكن يخلط صفحات.
+    """
+
+    def __init__(self, batch=GRAPH_BATCH, window=GRAPH_BATCH_WINDOW, max_items=GRAPH_BATCH_MAX,
+                 retries=GRAPH_BATCH_RETRIES):
+        self.batch = batch
+        self.window = window
+        self.max_items = max_items
+        self.retries = retries
+        self._pending = []          # [(body, token, future, attempts)]
+        self._tail = {}             # recipient -> future آخر إرسال إله
+        self._sending = set()       # futures طلعت بـ request وبعدها ما رجعت
+        self._flush_handle = None
+        self.batches = 0
+        self.items = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _submit(self, receiver, payload, token):
+        """
+        يحجز مكان الإرسال بدور المستخدم فوراً (بدون await)، حتى typing اللي ينطلب قبل
+        الرسالة يطلع قبلها حتى لو الرسالة حاضرة أسرع. يرجع future النتيجة.
+        """
+        body = {"recipient": {"id": receiver}}
+        body.update(payload)
+        fut = asyncio.get_running_loop().create_future()
+        prev = self._tail.get(receiver)
+        self._tail[receiver] = fut
+        fut.add_done_callback(lambda f: self._tail.get(receiver) is f and self._tail.pop(receiver))
+        if prev is not None and not prev.done():
+            prev.add_done_callback(lambda _: self._dispatch(body, token, fut))
+        else:
+            self._dispatch(body, token, fut)
+        return fut
+
+    def _dispatch(self, body, token, fut):
+        if fut.done():
+            return      # انلغى (send خلص وقته) وهو ينتظر دوره
+        if self.batch:
+            self._enqueue(body, token, fut, 0)
+        else:
+            spawn(self._post_direct(body, token, fut))
+
+    async def _post_direct(self, body, token, fut):
+        self._sending.add(fut)
+        try:
+            r = await self._post_one(body, token)
+        finally:
+            self._sending.discard(fut)
+        if not fut.done():
+            fut.set_result(r)
+
+    async def send(self, receiver, payload, token, timeout=None):
+        """يرجع نتيجة الإرسال (أو None). timeout=None → ما ننتظر أكثر من ميزانية الـ call."""
+        if not token:
+            return None
+        fut = self._submit(receiver, payload, token)
+        wait = timeout if timeout is not None else max(0.1, call_deadline(CALL_BUDGET) - time.monotonic())
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), wait)
+        except asyncio.TimeoutError:
+            return self._cancel(fut)
+
+    def _cancel(self, fut):
+        """مثل GraphBatcher._cancel: اللي بعده ما طلع ينلغى (None)، واللي بالطريق SEND_PENDING."""
+        if fut.done():
+            return fut.result()
+        if fut in self._sending:
+            return SEND_PENDING
+        self._pending = [p for p in self._pending if p[2] is not fut]
+        fut.cancel()
+        METRICS.inc("graph_batch_items_total", status="cancelled")
+        return None
+
+    def send_action(self, receiver, action, token):
+        # typing ما ننتظره؛ الرسالة اللي بعده تنتظره بالـ tail
+        if token:
+            self._submit(receiver, {"sender_action": action}, token)
+
+    def _enqueue(self, body, token, fut, attempts):
+        if fut.done():
+            return      # انلغى وهو ينتظر الإعادة
+        self._pending.append((body, token, fut, attempts))
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_items], self._pending[self.max_items:]
+            spawn(self._send_batch(batch))
+
+    async def _post_one(self, body, token):
+        return await http_request("POST", GRAPH_MESSAGES_URL, params={"access_token": token}, json=body)
+
+    async def _send_batch(self, batch):
+        self._sending.update(fut for _, _, fut, _ in batch)
+        try:
+            await self._post_batch(batch)
+        finally:
+            self._sending.difference_update(fut for _, _, fut, _ in batch)
+
+    async def _post_batch(self, batch):
+        if len(batch) == 1:
+            results = [(await self._post_one(batch[0][0], batch[0][1]), False, None)]
+        else:
+            tokens = [token for _, token, _, _ in batch]
+            r = await http_request(
+                "POST", GRAPH_BATCH_URL, params={"access_token": tokens[0]},
+                data=GraphBatcher.batch_form([body for body, _, _, _ in batch], tokens),
+            )
+            try:
+                payload = r.json() if r is not None else None
+            except ValueError:
+                payload = None
+            results = GraphBatcher.batch_results(payload, len(batch))
+
+        loop = asyncio.get_running_loop()
+        for (body, token, fut, attempts), (res, retryable, wait) in zip(batch, results):
+            if res:
+                METRICS.inc("graph_batch_items_total", status="ok")
+                if not fut.done():
+                    fut.set_result(res)
+            elif retryable and attempts < self.retries:
+                self.retried += 1
+                METRICS.inc("graph_batch_items_total", status="retried")
+                delay = wait if wait is not None else backoff_delay(attempts + 1)
+                loop.call_later(delay, self._enqueue, body, token, fut, attempts + 1)
+            else:
+                self.failed += 1
+                METRICS.inc("graph_batch_items_total", status="failed")
+                if not fut.done():
+                    fut.set_result(None)
+        self.batches += 1
+        self.items += len(batch)
+
+    def depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {
+            "depth": len(self._pending),
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+GRAPH = AsyncGraph()
+
+async def send_message(receiver, text):
+    # عيادة المراجع من الـ context (schedule_reply يثبتها) بدل tenant_of اللي يقرا الـ store
+    tenant = current_tenant()
+    if not tenant.token:
+        log(f"Missing page access token ({tenant.name})")
+        return None
+    with METRICS.timer("stage_seconds", stage="graph_send"):
+        r = await GRAPH.send(receiver, {"message": {"text": text}}, tenant.token)
+    if not r:
+        log("Failed to send message")
+    return r
+
+async def notify_callmebot(text, user):
+    with METRICS.timer("stage_seconds", stage="notify"):
+        r = await http_request("GET", CALLMEBOT_URL, params={"user": user, "text": text}, retries=1)
+    METRICS.inc("notifications_total", status="ok" if r else "failed")
+    return bool(r)
+
+# =======================================================
+# ✍️ Typing Indicator (تايمرات على الـ loop)
+# =======================================================
+class AsyncTyping:
+    """
+    نفس حالات TypingManager (idle → pending → typing → replying) بس كل مستخدم
+    إله تايمر call_later بدل loop يفحص الكل. كل شي على نفس الـ thread، فما نحتاج locks:
+    finish يلغي التايمر ويشيل الـ entry قبل ما الرسالة تنرسل.
+    الـ entry يحفظ token صفحة المراجع (current_tenant وقت ما انخلق) حتى التايمرات ما تقرا الـ store.
+    """
+
+    IDLE, PENDING, TYPING, REPLYING = TypingManager.IDLE, TypingManager.PENDING, TypingManager.TYPING, \
+        TypingManager.REPLYING
+    MAX_TYPING = TypingManager.MAX_TYPING
+
+    class _Entry:
+        __slots__ = ("state", "since", "timer", "token")
+
+        def __init__(self):
+            self.state = AsyncTyping.IDLE
+            self.since = 0.0
+            self.timer = None
+            self.token = current_tenant().token
+
+    def __init__(self, delay=TYPING_DELAY, refresh=TYPING_REFRESH):
+        self.delay = delay
+        self.refresh = refresh
+        self._entries = {}
+        self.sent_on = 0
+        self.sent_off = 0
+        self.saved = 0
+
+    def _arm(self, user_id, e, delay):
+        if e.timer is not None:
+            e.timer.cancel()
+        e.timer = asyncio.get_running_loop().call_later(delay, self._tick, user_id, e)
+
+    def _typing_on(self, user_id, e):
+        GRAPH.send_action(user_id, "typing_on", e.token)
+        self.sent_on += 1
+
+    def on_message(self, user_id):
+        e = self._entries.get(user_id)
+        if e is None:
+            e = self._entries[user_id] = self._Entry()
+        if e.state in (self.IDLE, self.PENDING):
+            e.state = self.PENDING
+            e.since = time.monotonic()
+            self._arm(user_id, e, self.delay)
+
+    def begin_reply(self, user_id):
+        e = self._entries.get(user_id)
+        if e is None:
+            e = self._entries[user_id] = self._Entry()
+            e.since = time.monotonic()
+        if e.state not in (self.TYPING, self.REPLYING):
+            self._typing_on(user_id, e)
+            self._arm(user_id, e, self.refresh)
+        e.state = self.REPLYING
+
+    def finish(self, user_id, message_follows):
+        e = self._entries.pop(user_id, None)
+        if e is None:
+            return
+        if e.timer is not None:
+            e.timer.cancel()
+        active = e.state in (self.TYPING, self.REPLYING)
+        e.state = self.IDLE
+        if not active:
+            return
+        if message_follows:
+            self.saved += 1
+        else:
+            GRAPH.send_action(user_id, "typing_off", e.token)
+            self.sent_off += 1
+
+    def release(self, user_id):
+        """مثل TypingManager.release: الرد عند worker ثاني، نوكف بصمت."""
+        e = self._entries.pop(user_id, None)
+        if e is not None and e.timer is not None:
+            e.timer.cancel()
+
+    def _tick(self, user_id, e):
+        e.timer = None
+        if self._entries.get(user_id) is not e or e.state == self.IDLE:
+            return
+        if time.monotonic() - e.since > self.MAX_TYPING:
+            e.state = self.IDLE
+            del self._entries[user_id]
+            return
+        self._typing_on(user_id, e)
+        if e.state == self.PENDING:
+            e.state = self.TYPING
+        self._arm(user_id, e, self.refresh)
+
+    def active(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"active": self.active(), "sent_on": self.sent_on, "sent_off": self.sent_off, "saved_calls": self.saved}
+
+
+TYPING = AsyncTyping()
+
+# =======================================================
+# 🤖 OpenAI (AsyncOpenAI + حد للـ calls سوية)
+# =======================================================
+async def complete_chat(messages, *, model, timeout=REQUEST_TIMEOUT, usage=None):
+    """bot.complete_chat بس القراءة من AsyncOpenAI؛ قص الـ stream والـ stats من bot.ReplyStream."""
+    if not OPENAI_STREAM:
+        t0 = time.monotonic()
+        return plain_reply(await AOPENAI.chat.completions.create(**completion_args(model, messages, timeout)),
+                           messages, usage, t0)
+
+    reader = ReplyStream(messages, timeout, usage)
+    stream = await AOPENAI.chat.completions.create(**completion_args(model, messages, timeout))
+    try:
+        async for chunk in stream:
+            if reader.feed(chunk):
+                break
+    finally:
+        await stream.close()
+    return reader.result()
+
+async def _openai_attempt(messages, remaining, model, usage):
+    with openai_errors():
+        return await complete_chat(messages, model=model, timeout=min(REQUEST_TIMEOUT, remaining), usage=usage)
+
+
+class ModelGate:
+    """
+    بديل ModelExecutor على الـ loop: أقصى OPENAI_CONCURRENCY calls سوية، والطابور (FIFO)
+    محدود بـ OPENAI_QUEUE_MAX. كل مستخدم إله lock: call واحد بالطريق والباقي ينتظر بالترتيب،
+    فردوده تطلع بالترتيب والـ FIFO يطلع عادل بين المستخدمين.
+    كل عيادة إلها semaphore بحصتها (model_concurrency) ينطلب قبل العام، فالواكف على
+    حصة عيادته ما ياخذ مكان بطابور الباقين.
+    """
+
+    def __init__(self, workers=OPENAI_CONCURRENCY, max_queue=OPENAI_QUEUE_MAX):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._sem = None
+        self._tenant_sems = {}      # tenant -> asyncio.Semaphore
+        self._tenant_inflight = Counter()
+        self._user_locks = {}       # user_id -> asyncio.Lock
+        self._user_refs = Counter()  # user_id -> calls بالطريق أو منتظرة (حتى نمسح الـ lock وراها)
+        self._waiting = 0
+        self._inflight = 0
+        self.submitted = 0
+        self.started = 0
+        self.shed = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    async def run(self, user_id, fn, *args):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.workers)
+        if self._sem.locked() and self._waiting >= self.max_queue:
+            self.shed += 1
+            METRICS.inc("model_shed_total", reason="backlog")
+            raise Overloaded(f"model queue full ({self._waiting})")
+        tenant = current_tenant()
+        tenant_sem = self._tenant_sems.get(tenant)
+        if tenant_sem is None:
+            tenant_sem = self._tenant_sems[tenant] = asyncio.Semaphore(tenant.model_concurrency)
+        user_lock = self._user_locks.get(user_id)
+        if user_lock is None:
+            user_lock = self._user_locks[user_id] = asyncio.Lock()
+        self._user_refs[user_id] += 1
+        self.submitted += 1
+        self._waiting += 1
+        t0 = time.monotonic()
+        held = []
+        try:
+            # الترتيب: دور المستخدم، بعدين حصة العيادة، بعدين الـ pool العام
+            for lock in (user_lock, tenant_sem, self._sem):
+                await asyncio.wait_for(lock.acquire(), max(0.05, call_deadline(CALL_BUDGET) - time.monotonic()))
+                held.append(lock)
+        except asyncio.TimeoutError:
+            for lock in held:
+                lock.release()
+            self._forget(user_id)
+            self.shed += 1
+            METRICS.inc("model_shed_total", reason="deadline")
+            raise Overloaded("model queue wait exceeded the reply budget") from None
+        finally:
+            self._waiting -= 1
+        waited = time.monotonic() - t0
+        METRICS.observe("stage_seconds", waited, stage="model_queue")
+        self.started += 1
+        self.wait_sum += waited
+        self.wait_max = max(self.wait_max, waited)
+        self._inflight += 1
+        self._tenant_inflight[tenant] += 1
+        try:
+            return await fn(*args)
+        finally:
+            self._inflight -= 1
+            self._tenant_inflight[tenant] -= 1
+            self._sem.release()
+            tenant_sem.release()
+            user_lock.release()
+            self._forget(user_id)
+
+    def _forget(self, user_id):
+        self._user_refs[user_id] -= 1
+        if not self._user_refs[user_id]:
+            del self._user_refs[user_id]
+            del self._user_locks[user_id]
+
+    def depth(self):
+        return self._waiting
+
+    def inflight(self):
+        return self._inflight
+
+    def tenant_inflight(self, tenant):
+        return self._tenant_inflight[tenant]
+
+    def stats(self):
+        return {
+            "queued": self._waiting,
+            "inflight": self._inflight,
+            "submitted": self.submitted,
+            "shed": self.shed,
+            "wait_avg": round(self.wait_sum / self.started, 3) if self.started else 0.0,
+            "wait_max": round(self.wait_max, 3),
+        }
+
+
+MODEL_GATE = ModelGate()
+
+async def tier_call(tier, messages):
+    usage = {}
+    with ROUTER.recording(tier, usage):
+        out = await resilient_call(
+            "openai", lambda remaining: _openai_attempt(messages, remaining, MODEL_TIERS[tier], usage)
+        )
+    return out.strip()
+
+async def routed_complete(user_id, text, messages):
+    """ModelRouter.complete بس الـ calls await: fast أول، وإذا ROUTER.accepts رفض الرد نصعّد لـ strong."""
+    if await asyncio.to_thread(ROUTER.choose, user_id, text) == "strong":
+        return await tier_call("strong", messages)
+    try:
+        out, error = await tier_call("fast", messages), None
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        out, error = "", e
+    if ROUTER.accepts(user_id, out, messages, error):
+        return out
+    return await tier_call("strong", messages)
+
+async def ask_openai_chat(user_id, text):
+    cache_key, cached, messages = await asyncio.to_thread(prepare_answer, user_id, text)
+    if cached:
+        return cached
+    try:
+        out = await MODEL_GATE.run(user_id, routed_complete, user_id, text, messages)
+    except Exception as e:
+        return failed_answer(e)
+    return model_answer(cache_key, out)
+
+# =======================================================
+# ⏱️ Reply Timers (call_later بدل heap + thread pool)
+# =======================================================
+class ReplyTimers:
+    """كل key إله موعد واحد؛ رسالة جديدة تلغي الموعد القديم وتحط جديد."""
+
+    def __init__(self):
+        self._handles = {}
+
+    def schedule(self, key, delay, fn, *args):
+        old = self._handles.pop(key, None)
+        if old is not None:
+            old.cancel()
+        self._handles[key] = asyncio.get_running_loop().call_later(delay, self._fire, key, fn, args)
+
+    def _fire(self, key, fn, args):
+        self._handles.pop(key, None)
+        spawn(fn(*args))
+
+    def scheduled(self, key):
+        return key in self._handles
+
+    def pending(self):
+        return len(self._handles)
+
+
+REPLY_TIMERS = ReplyTimers()
+
+async def schedule_reply(user_id, version_snapshot, delay, trace_id, tenant):
+    # كل رد task خاص بيه، فالـ trace والـ deadline والعيادة (ContextVars) ما يختلطون بين المراجعين
+    set_trace(trace_id)
+    with deadline_budget(REPLY_BUDGET), use_tenant(tenant):
+        await _reply_batch(user_id, version_snapshot, delay)
+
+async def _reply_batch(user_id, version_snapshot, delay):
+    """bot._reply_batch بس الموديل والإرسال await، وشغل الـ store بـ thread."""
+    batch = await asyncio.to_thread(take_batch, user_id, version_snapshot, delay)
+    if batch is None:
+        if not REPLY_TIMERS.scheduled(("reply", user_id)):
+            TYPING.release(user_id)
+        return
+    batch_text, batch_since, waited = batch
+
+    TYPING.begin_reply(user_id)
+
+    t_answer = time.monotonic()
+    reply = await asyncio.to_thread(quick_answer, user_id, batch_text) or await ask_openai_chat(user_id, batch_text)
+    answer_secs = time.monotonic() - t_answer
+    sent_at = await asyncio.to_thread(settle_reply, user_id, reply)
+    TYPING.finish(user_id, message_follows=sent_at is not None)
+    if sent_at is None:
+        return
+
+    t_send = time.monotonic()
+    sent = await send_message(user_id, reply)
+    note_reply(user_id, sent, batch_since, sent_at, waited, answer_secs, time.monotonic() - t_send)
+
+# =======================================================
+# 📥 Events + Leads
+# =======================================================
+LOOP = None         # الـ event loop (ينحفظ بالـ startup) حتى INGEST_POOL يرجعله
+LEAD_WAKE = None    # asyncio.Event (ينخلق بالـ startup)
+WEBHOOK_QUEUE = None  # asyncio.Queue للـ bodies اللي توقيعها صحيح (ينخلق بالـ startup)
+
+# thread واحد لـ ingest_events: mark_processed و record_user_message و LEADS.add كلها store/SQLite،
+# ورسائل نفس المراجع لازم تتسجل وتتجدول بترتيب وصولها
+INGEST_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+
+async def webhook_consumer():
+    """ياخذ الـ bodies بالترتيب ويعالجها بـ INGEST_POOL؛ الـ ack للفيسبوك طلع قبلها."""
+    while True:
+        ts, body = await WEBHOOK_QUEUE.get()
+        METRICS.observe("stage_seconds", time.time() - ts, stage="ingest_wait")
+        try:
+            await LOOP.run_in_executor(INGEST_POOL, ingest_events, body, process_event)
+        except Exception as e:
+            log("Ingest handler error:", e)
+
+def process_event(event):
+    """put مال ingest_events (يشتغل بـ INGEST_POOL)؛ الـ typing والتايمر يرجعون للـ loop."""
+    user_id = event["user_id"]
+    txt = event.get("text", "")
+    set_trace(event.get("trace"))
+
+    with use_tenant(TENANTS.get(event.get("page"))) as tenant:
+        version, delay = record_user_message(user_id, txt)
+        LOOP.call_soon_threadsafe(message_recorded, tenant, user_id, version, delay, event.get("trace"))
+
+        phone = extract_iraqi_phone(txt)
+        if phone:
+            facts = (get_session(user_id) or {}).get("facts") or {}
+            if LEADS.add(user_id, phone, name=facts.get("name"), service=facts.get("service"), page=tenant.page_id):
+                LOOP.call_soon_threadsafe(LEAD_WAKE.set)
+    return True
+
+def message_recorded(tenant, user_id, version, delay, trace_id):
+    with use_tenant(tenant):
+        TYPING.on_message(user_id)
+    REPLY_TIMERS.schedule(("reply", user_id), delay, schedule_reply, user_id, version, delay, trace_id, tenant)
+
+async def lead_sender():
+    """نفس LeadOutbox._run: نفس الملف والـ lease، بس الإرسال await."""
+    while True:
+        try:
+            while True:
+                rows = await asyncio.to_thread(LEADS.claim, time.time())
+                if not rows:
+                    break
+                ok = await notify_callmebot(format_leads(rows), lead_recipient(rows))
+                await asyncio.to_thread(LEADS.finish, rows, ok, time.time())
+                await asyncio.sleep(LEADS.min_interval)
+            await asyncio.to_thread(LEADS.purge, time.time())
+            wait = await asyncio.to_thread(LEADS.next_wait, time.time())
+        except Exception as e:
+            log("Lead outbox error:", e)
+            wait = 5
+        try:
+            await asyncio.wait_for(LEAD_WAKE.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+        LEAD_WAKE.clear()
+
+async def loop_lag_monitor():
+    # إذا callback بلوك الـ loop (SQLite بطيء، CPU)، كل المحادثات تتأخر — هنا يبين
+    while True:
+        t0 = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        METRICS.observe("event_loop_lag_seconds", max(0.0, time.monotonic() - t0 - LOOP_LAG_INTERVAL))
+
+# =======================================================
+# 💾 Session Snapshot
+# =======================================================
+SNAPSHOT = None
+
+def start_snapshot(loop):
+    """مثل bot.py؛ الجلسات اللي ترجع بباتش معلق تنجدول على الـ loop (الـ loader thread منفصل)."""
+    global SNAPSHOT
+    if not SESSION_SNAPSHOT or not isinstance(STORE, MemorySessionStore):
+        return
+
+    def resume_pending(user_id, st):
+        if requeue_inflight(st):
+            loop.call_soon_threadsafe(
+                REPLY_TIMERS.schedule, ("reply", user_id), RESUME_DELAY, schedule_reply, user_id, st["msg_version"], 0,
+                None, TENANTS.get(st.get("page")),
+            )
+
+    SNAPSHOT = SessionSnapshot(STORE, on_restore=resume_pending)
+    STORE.snapshot = SNAPSHOT
+    SNAPSHOT.start()
+
+# =======================================================
+# 📈 STATS
+# =======================================================
+async def stats():
+    return {
+        "runtime": "asyncio",
+        "threads": threading.active_count(),
+        "tasks": len(asyncio.all_tasks()),
+        "rss_bytes": rss_bytes(),
+        "sessions": await asyncio.to_thread(STORE.count),
+        "sessions_evicted": getattr(STORE, "evicted", 0),
+        "scheduled_timers": REPLY_TIMERS.pending(),
+        "answer_cache": ANSWER_CACHE.stats(),
+        "typing": TYPING.stats(),
+        "debounce": DEBOUNCE.stats(),
+        "openai": LLM_STATS.stats(),
+        "breakers": {name: b.stats() for name, b in BREAKERS.items()},
+        "graph_batch": GRAPH.stats(),
+        "leads": await asyncio.to_thread(LEADS.stats),
+        "model_executor": MODEL_GATE.stats(),
+        "routing": ROUTER.stats(),
+        "snapshot": SNAPSHOT.stats() if SNAPSHOT else None,
+        "tenants": [
+            {
+                "page": t.page_id,
+                "name": t.name,
+                "model_quota": t.model_concurrency,
+                "model_inflight": MODEL_GATE.tenant_inflight(t),
+            }
+            for t in TENANTS.tenants
+        ],
+    }
+
+
+# نفس أسماء bot.py، بس تقرا من مكونات الـ loop
+METRICS.gauge("pending_batches", REPLY_TIMERS.pending)
+METRICS.gauge("ingest_queue_depth", lambda: WEBHOOK_QUEUE.qsize() if WEBHOOK_QUEUE else 0)
+METRICS.gauge("typing_active", TYPING.active)
+METRICS.gauge("graph_outbound_depth", GRAPH.depth)
+METRICS.gauge("model_queue_depth", MODEL_GATE.depth)
+METRICS.gauge("model_inflight", MODEL_GATE.inflight)
+METRICS.gauge("event_loop_tasks", lambda: len(_TASKS))
+
+# =======================================================
+# 📡 ASGI app
+# =======================================================
+async def _read_body(receive):
+    chunks = []
+    while True:
+        msg = await receive()
+        chunks.append(msg.get("body", b""))
+        if not msg.get("more_body"):
+            return b"".join(chunks)
+
+async def _respond(send, status, body, content_type="text/plain; charset=utf-8"):
+    if isinstance(body, str):
+        body = body.encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def _startup():
+    global HTTP, AOPENAI, LOOP, LEAD_WAKE, WEBHOOK_QUEUE
+    loop = LOOP = asyncio.get_running_loop()
+    limits = httpx.Limits(
+        max_connections=HTTP_POOL_HOSTS * HTTP_POOL_PER_HOST, max_keepalive_connections=HTTP_POOL_PER_HOST
+    )
+    HTTP = httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT)
+    AOPENAI = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    LEAD_WAKE = asyncio.Event()
+    WEBHOOK_QUEUE = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    spawn(webhook_consumer())
+    spawn(lead_sender())
+    spawn(loop_lag_monitor())
+    start_snapshot(loop)
+
+async def _shutdown():
+    if SNAPSHOT is not None:
+        await asyncio.to_thread(SNAPSHOT.flush)
+    if HTTP is not None:
+        await HTTP.aclose()
+        await AOPENAI.close()
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            await _startup()
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await _shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+def accept_webhook(body, signature):
+    """على الـ loop وبدون SQLite: التوقيع وبعدين الطابور. الطابور مليان → 503 وفيسبوك يعيد."""
+    if not valid_signature(body, signature):
+        METRICS.inc("webhook_rejected_total")
+        log("webhook signature mismatch")
+        return "Error", 403
+    try:
+        WEBHOOK_QUEUE.put_nowait((time.time(), body))
+    except asyncio.QueueFull:
+        METRICS.inc("webhook_retry_requested_total")
+        return "Busy", 503
+    return "OK", 200
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    path, method = scope["path"], scope["method"]
+
+    if path == "/webhook" and method == "GET":
+        query = dict(parse_qsl(scope.get("query_string", b"").decode()))
+        if query.get("hub.verify_token") == VERIFY_TOKEN:
+            return await _respond(send, 200, query.get("hub.challenge", ""))
+        return await _respond(send, 403, "Error")
+
+    if path == "/webhook" and method == "POST":
+        body = await _read_body(receive)
+        headers = dict(scope.get("headers") or [])
+        signature = headers.get(b"x-hub-signature-256", b"").decode()
+        with METRICS.timer("stage_seconds", stage="webhook"):
+            text, status = accept_webhook(body, signature)
+        return await _respond(send, status, text)
+
+    if path == "/stats" and method == "GET":
+        return await _respond(send, 200, json.dumps(await stats(), ensure_ascii=False), "application/json")
+
+    if path == "/metrics" and method == "GET":
+        # الـ gauges تقرا الـ store والـ leads (SQLite) → بـ thread
+        return await _respond(send, 200, await asyncio.to_thread(METRICS.render),
+                              "text/plain; version=0.0.4; charset=utf-8")
+
+    return await _respond(send, 404, "Not Found")
@@ -0,0 +1,81 @@
+"""
+كم محادثة سوية يتحمل worker واحد: gunicorn (bot.py، thread لكل رد) ضد uvicorn (asgi_bot.py، event loop).
+يشغل bench/loadtest.py بـ burst متزايد لكل وضع ويوقف أول ما يفشل الـ SLO:
+كل المراجعين انرد عليهم و p95 مال time-to-reply تحت --slo.
+
+حد الموديل (OPENAI_CONCURRENCY) ينرفع لكل الوضعين وطابوره بلا load shedding، حتى المقارنة تكون
+على الـ server نفسه والـ p95 يبين الانتظار الحقيقي؛ بوضع gunicorn الحد يبقى REPLY_WORKERS (threads الرد).
+كاش الأجوبة ينطفي، لأن نسبة الـ hits تعتمد على ترتيب الردود (مو على الوضع) وتخرب المقارنة.
+
+    python bench/capacity.py
+    python bench/capacity.py --steps 200,400,800,1600 --llm-latency fixed:3 --slo 12
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+FIELDS = {
+    "replied": re.compile(r"replied\s+(\d+)/(\d+)"),
+    "p95": re.compile(r"time-to-reply p95\s+([\d.]+|nan)s"),
+    "ack_p99": re.compile(r"webhook ack p99\s+([\d.]+|nan)ms"),
+    "threads": re.compile(r"peak threads\s+(\d+)"),
+    "rss": re.compile(r"peak RSS\s+([\d.]+) MiB"),
+}
+
+
+def run(server, users, args):
+    cmd = [
+        sys.executable, os.path.join(HERE, "loadtest.py"), "--server", server, "--users", str(users), "--burst",
+        "--messages", str(args.messages), "--llm-latency", args.llm_latency, "--buffer-delay", str(args.buffer_delay),
+        "--drain-timeout", str(args.drain_timeout),
+        "--env", f"OPENAI_CONCURRENCY={args.model_concurrency}", "OPENAI_QUEUE_MAX=100000", "ANSWER_CACHE_SIZE=0",
+        *args.env,
+    ]
+    out = subprocess.run(cmd, capture_output=True, text=True).stdout
+    row = {"server": server, "users": users}
+    for name, rx in FIELDS.items():
+        m = rx.search(out)
+        row[name] = m.groups() if name == "replied" and m else (m.group(1) if m else None)
+    replied = int(row["replied"][0]) if row["replied"] else 0
+    p95 = float(row["p95"]) if row["p95"] not in (None, "nan") else float("inf")
+    row["ok"] = replied == users and p95 <= args.slo
+    return row
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--servers", default="gunicorn,uvicorn")
+    ap.add_argument("--steps", default="100,200,400,800")
+    ap.add_argument("--messages", type=int, default=2)
+    ap.add_argument("--llm-latency", default="fixed:2")
+    ap.add_argument("--buffer-delay", type=float, default=2.0)
+    ap.add_argument("--slo", type=float, default=10.0, help="أقصى p95 لوقت الرد (ثواني)")
+    ap.add_argument("--model-concurrency", type=int, default=256)
+    ap.add_argument("--drain-timeout", type=float, default=90)
+    ap.add_argument("--env", nargs="*", default=[], help="متغيرات إضافية للبوت KEY=VALUE")
+    args = ap.parse_args()
+
+    print(f"{'server':<10}{'users':>7}{'replied':>10}{'p95':>9}{'ack p99':>10}{'threads':>9}{'RSS MiB':>9}  SLO")
+    capacity = {}
+    for server in args.servers.split(","):
+        capacity[server] = 0
+        for users in (int(s) for s in args.steps.split(",")):
+            row = run(server, users, args)
+            replied = "/".join(row["replied"]) if row["replied"] else "-"
+            print(f"{server:<10}{users:>7}{replied:>10}{row['p95'] or '-':>9}{row['ack_p99'] or '-':>10}"
+                  f"{row['threads'] or '-':>9}{row['rss'] or '-':>9}  {'ok' if row['ok'] else 'FAIL'}", flush=True)
+            if not row["ok"]:
+                break
+            capacity[server] = users
+
+    print()
+    for server, users in capacity.items():
+        print(f"{server}: {users} concurrent conversations per worker within p95 <= {args.slo:g}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Load test كامل على مكينة وحدة وبدون إنترنت.
+
+يشغل bot.py (gunicorn مثل الـ Procfile) موجه على stubs محلية لـ Graph و OpenAI و CallMeBot،
+ويرمي webhooks موقعة بـ X-Hub-Signature-256 بالمعدل أو الـ burst المطلوب، وبعدين يطبع
+throughput و p50/p95/p99 لوقت الرد (من آخر رسالة للمراجع لحد ما توصل رسالة الرد للـ Graph)،
+وأقصى عدد threads و RSS للبوت.
+
+    python bench/loadtest.py --users 200 --messages 3 --rate 20
+    python bench/loadtest.py --users 500 --burst --llm-latency lognormal:2:0.6 --workers 2
+    python bench/loadtest.py --users 500 --burst --server uvicorn     # وضع asgi_bot
+    python bench/loadtest.py --users 300 --burst --pages 4            # 4 عيادات ببروسس واحد (TENANTS_FILE)
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from stubs import start_stub_server  # noqa: E402
+
+APP_SECRET = "loadtest-secret"
+QUESTIONS = [
+    "هلا عندي سن مكسور من جوه شنو الحل",
+    "اريد ابتسامة بس خايف من الوجع",
+    "شنو الفرق بين الزاركون والايماكس",
+    "عندي اسنان مفقودة وما اعرف شسوي",
+    "الحشوة تطيح بعد فترة لو لا",
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def proc_tree(pid):
+    """pid + كل الأبناء (workers الـ gunicorn) من /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    out, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        out.append(p)
+        stack.extend(children.get(p, []))
+    return out
+
+
+def tree_usage(pid):
+    threads = rss = 0
+    for p in proc_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return threads, rss
+
+
+def page_ids(n):
+    return [f"page-{i}" for i in range(max(1, n))]
+
+
+def page_token(page_id):
+    return f"loadtest-{page_id}"
+
+
+def write_tenants(path, n):
+    pages = [{"page_id": p, "name": p, "access_token": page_token(p)} for p in page_ids(n)]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"pages": pages}, f)
+
+
+def start_bot(args, stub_base, port):
+    # ملفات الـ snapshot والـ leads بمجلد مؤقت، حتى كل تشغيل يبدي نظيف
+    data_dir = tempfile.mkdtemp(prefix="loadtest-")
+    env = dict(os.environ)
+    env.update({
+        "SESSION_SNAPSHOT": os.path.join(data_dir, "sessions.db"),
+        "LEAD_DB": os.path.join(data_dir, "leads.db"),
+        "PORT": str(port),
+        "PAGE_ACCESS_TOKEN": "loadtest",
+        "OPENAI_API_KEY": "loadtest",
+        "OPENAI_BASE_URL": f"{stub_base}/v1",
+        "GRAPH_API_BASE": stub_base,
+        "CALLMEBOT_URL": f"{stub_base}/text.php",
+        "APP_SECRET": APP_SECRET,
+        "BUFFER_DELAY": str(args.buffer_delay),
+        "TYPING_DELAY": str(min(args.buffer_delay / 2, 4)),
+        "TYPING_REFRESH": "8",
+    })
+    if args.pages > 1:
+        env["TENANTS_FILE"] = os.path.join(data_dir, "tenants.json")
+        write_tenants(env["TENANTS_FILE"], args.pages)
+    env.update(dict(kv.split("=", 1) for kv in args.env))
+    if args.server == "uvicorn":
+        # asgi_bot: كل المحادثات على event loop واحد لكل worker
+        cmd = [
+            sys.executable, "-m", "uvicorn", "asgi_bot:app", "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(args.workers), "--log-level", "warning",
+        ]
+    elif args.server == "gunicorn":
+        cmd = [
+            sys.executable, "-m", "gunicorn", "bot:app", "--bind", f"127.0.0.1:{port}",
+            "--workers", str(args.workers), "--threads", str(args.threads), "--log-level", "warning",
+        ]
+    else:
+        cmd = [sys.executable, "bot.py"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, start_new_session=True)
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f"{url}/stats", timeout=1)
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise SystemExit("bot did not start")
+
+
+def signed_post(session, url, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode()
+    sig = "sha256=" + hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return session.post(
+        f"{url}/webhook", data=body, timeout=10,
+        headers={"Content-Type": "application/json", "X-Hub-Signature-256": sig},
+    )
+
+
+def run_user(session, url, user_id, page_id, n_messages, gap, last_sent, ack_times):
+    for i in range(n_messages):
+        text = random.choice(QUESTIONS)
+        payload = {"object": "page", "entry": [{"id": page_id, "messaging": [{
+            "sender": {"id": user_id},
+            "recipient": {"id": page_id},
+            "timestamp": int(time.time() * 1000),
+            "message": {"mid": f"{user_id}-{i}-{random.random()}", "text": text},
+        }]}]}
+        t0 = time.time()
+        r = signed_post(session, url, payload)
+        ack_times.append(time.time() - t0)
+        if r.status_code != 200:
+            print("webhook rejected:", r.status_code)
+        last_sent[user_id] = time.time()
+        if i < n_messages - 1:
+            time.sleep(random.uniform(0.5, 1.5) * gap)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--messages", type=int, default=2, help="رسائل لكل مراجع (تتجمع بباتش واحد)")
+    ap.add_argument("--gap", type=float, default=0.5, help="الفاصل بين رسائل نفس المراجع")
+    ap.add_argument("--rate", type=float, default=10.0, help="مراجعين جدد بالثانية")
+    ap.add_argument("--burst", action="store_true", help="كل المراجعين سوية (حملة إعلانية)")
+    ap.add_argument("--llm-latency", default="lognormal:1.5:0.5")
+    ap.add_argument("--graph-latency", default="fixed:0.05")
+    ap.add_argument("--callmebot-latency", default="fixed:0.3")
+    ap.add_argument("--graph-error-rate", type=float, default=0.0, help="نسبة إرسالات Graph ترجع rate limit")
+    ap.add_argument("--buffer-delay", type=float, default=2.0)
+    ap.add_argument("--server", choices=["gunicorn", "uvicorn", "flask"], default="gunicorn")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--threads", type=int, default=1, help="1 = sync worker مثل الـ Procfile")
+    ap.add_argument("--pages", type=int, default=1, help="عدد الصفحات (العيادات)، المراجعين يتوزعون عليها")
+    ap.add_argument("--env", nargs="*", default=[], help="متغيرات إضافية للبوت KEY=VALUE")
+    ap.add_argument("--drain-timeout", type=float, default=120)
+    args = ap.parse_args()
+
+    stub, rec, stub_base = start_stub_server(
+        args.llm_latency, args.graph_latency, args.callmebot_latency, args.graph_error_rate
+    )
+    port = free_port()
+    proc, url = start_bot(args, stub_base, port)
+
+    peak = {"threads": 0, "rss": 0}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.is_set():
+            threads, rss = tree_usage(proc.pid)
+            peak["threads"] = max(peak["threads"], threads)
+            peak["rss"] = max(peak["rss"], rss)
+            stop.wait(0.25)
+
+    threading.Thread(target=sample, daemon=True).start()
+
+    users = [f"lt-{i}" for i in range(args.users)]
+    pages = page_ids(args.pages)
+    page_of = {uid: pages[i % len(pages)] for i, uid in enumerate(users)}
+    last_sent, ack_times = {}, []
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=256))
+    t_start = time.time()
+    with ThreadPoolExecutor(max_workers=min(256, args.users)) as pool:
+        for i, uid in enumerate(users):
+            if not args.burst:
+                time.sleep(max(0.0, t_start + i / args.rate - time.time()))
+            pool.submit(run_user, session, url, uid, page_of[uid], args.messages, args.gap, last_sent, ack_times)
+
+    # ننتظر لحد ما كل مراجع يوصله رد بعد آخر رسالة منه
+    deadline = time.time() + args.drain_timeout
+    ttr = {}
+    while time.time() < deadline and len(ttr) < len(users):
+        for ts, rid in rec.replies():
+            sent = last_sent.get(rid)
+            if sent and ts >= sent and rid not in ttr:
+                ttr[rid] = ts - sent
+        time.sleep(0.2)
+    t_end = max((last_sent[u] + ttr[u] for u in ttr), default=time.time())
+    stop.set()
+
+    os.killpg(proc.pid, signal.SIGTERM)
+    proc.wait(timeout=10)
+    stub.shutdown()
+
+    values = list(ttr.values())
+    graph_calls = len(rec.graph)
+    # كل إرسال لمراجع لازم يطلع بتوكن صفحته (بصفحة وحدة التوكن هو PAGE_ACCESS_TOKEN)
+    expected = {uid: {page_token(page_of[uid]) if args.pages > 1 else "loadtest"} for uid in users}
+    wrong_token = sorted(uid for uid, toks in rec.tokens.items() if toks != expected.get(uid))
+    print(f"users={args.users} messages/user={args.messages} {'burst' if args.burst else f'rate={args.rate}/s'} "
+          f"server={args.server} workers={args.workers} threads={args.threads} pages={args.pages}")
+    print(f"llm={args.llm_latency} buffer_delay={args.buffer_delay}s")
+    print(f"replied            {len(values)}/{len(users)}")
+    print(f"throughput         {len(values) / max(1e-9, t_end - t_start):.2f} replies/s")
+    print(f"time-to-reply p50  {percentile(values, 50):.2f}s")
+    print(f"time-to-reply p95  {percentile(values, 95):.2f}s")
+    print(f"time-to-reply p99  {percentile(values, 99):.2f}s")
+    print(f"webhook ack p99    {percentile(ack_times, 99) * 1000:.1f}ms")
+    print(f"openai calls       {rec.openai_calls}")
+    print(f"graph calls        {graph_calls} ({rec.graph_requests} HTTP requests)")
+    print(f"callmebot calls    {len(rec.callmebot)}")
+    print(f"wrong page token   {len(wrong_token)}  {wrong_token[:5]}")
+    print(f"peak threads       {peak['threads']}")
+    print(f"peak RSS           {peak['rss'] / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+بنچمارك ذاكرة الجلسات: 100 ألف مراجع وهمي، كل واحد بيه كم رسالة.
+
+يقيس الـ RSS بعد ما نبني الجلسات عن طريق الـ store، ويقارن حجم الحاويات
+بين الشكل القديم (dict لكل جلسة و dict لكل رسالة) والـ SessionRecord
+(__slots__ + deque محدود + tuple لكل رسالة)، ويقيس وقت تنظيف الجلسات المنتهية.
+
+    python bench/memory_bench.py --users 100000 --turns 4
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ["SESSION_STORE_URL"] = "memory"
+os.environ["SESSION_SNAPSHOT"] = ""      # نقيس الـ store نفسه بدون الكتابة للملف
+os.environ.setdefault("LEAD_DB", ":memory:")
+
+import bot  # noqa: E402
+
+TURNS = [
+    ("user", "هلا بيش تغليف الزاركون؟"),
+    ("assistant", "تغليف الزاركون 50 ألف للسن، بمواد ألمانية وضمان مدى الحياة 🌹"),
+    ("user", "اريد احجز يوم الخميس"),
+    ("assistant", "تدلل، انطيني الاسم ورقم الهاتف حتى نثبتلك الحجز"),
+]
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def record_overhead(st):
+    return sys.getsizeof(st) + sys.getsizeof(st.history) + sum(sys.getsizeof(t) for t in st.history)
+
+
+def legacy_overhead(st):
+    # نفس الحقول بس بالشكل القديم: dict للجلسة و dict لكل رسالة
+    as_dict = {key: getattr(st, key) for key in st.__slots__}
+    turns = [{"role": r, "text": t, "ts": ts} for r, t, ts in st.history]
+    return sys.getsizeof(as_dict) + sys.getsizeof(turns) + sum(sys.getsizeof(t) for t in turns)
+
+
+def build(users, turns, prefix="user"):
+    for i in range(users):
+        uid = f"{prefix}-{i}"
+        bot.ensure_session(uid)
+        for role, text in (TURNS * turns)[:turns]:
+            bot.append_history(uid, role, text)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--turns", type=int, default=4)
+    args = ap.parse_args()
+    bot.STORE.max_sessions = max(bot.STORE.max_sessions, args.users)
+
+    rss0 = rss_bytes()
+    t0 = time.perf_counter()
+    build(args.users, args.turns)
+    build_time = time.perf_counter() - t0
+    rss = rss_bytes() - rss0
+
+    sessions = bot.STORE.values()
+    compact = sum(record_overhead(st) for st in sessions)
+    legacy = sum(legacy_overhead(st) for st in sessions)
+
+    print(f"users={args.users} turns/user={args.turns}")
+    print(f"RSS growth              {rss / 2**20:8.1f} MiB  ({rss / args.users:6.0f} B/session)")
+    print(f"containers, legacy dict {legacy / 2**20:8.1f} MiB  ({legacy / args.users:6.0f} B/session)")
+    print(f"containers, record      {compact / 2**20:8.1f} MiB  ({compact / args.users:6.0f} B/session)")
+    print(f"build through store     {build_time:8.2f} s")
+
+    # كل الجلسات تنتهي: التنظيف يمشي من راس الترتيب ويمسح بس اللي انتهى
+    t0 = time.perf_counter()
+    bot.STORE.cleanup(time.time() + bot.SESSION_CLEAN_AFTER + 1)
+    print(f"evict all expired       {time.perf_counter() - t0:8.3f} s  (left={bot.STORE.count()})")
+
+    # ماكو شي منتهي: التنظيف لازم يكون فوري مهما كان عدد الجلسات
+    build(args.users // 10, 1, prefix="live")
+    t0 = time.perf_counter()
+    for _ in range(1000):
+        bot.STORE.cleanup(time.time())
+    print(f"1000 sweeps, 0 expired  {time.perf_counter() - t0:8.4f} s  (left={bot.STORE.count()})")
+
+    # سقف LRU: نزيد جلسات فوك السقف والأقدم تطلع أول بأول
+    bot.STORE.max_sessions = args.users // 20
+    build(args.users // 10, 1, prefix="burst")
+    print(f"LRU cap {bot.STORE.max_sessions:<8}        left={bot.STORE.count()} evicted={bot.STORE.evicted}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Stress للـ session store: مراجع واحد ينضرب من هواي threads سوية ونتأكد ماكو باتش يضيع أو يتكرر.
+
+- writers: كل واحد يسجل رسائل بنصوص مميزة عن طريق record_user_message (نفس طريق الـ webhook)
+- repliers: مثل الـ ReplyScheduler، ياخذون msg_version ويسحبون بـ drain_pending_batch (compare-and-set)
+  وبعدين يصفرون الـ inflight مثل ما يسوي الرد
+- cleaner: ينظف كأن كل الجلسات انتهت، وفوكها مراجعين ثانيين يعبرون السقف حتى الـ LRU يشتغل
+
+الـ writers يكملون لحد ما يصير --drains سحب ناجح على الأقل (مو بس --messages رسالة)،
+حتى الـ compare-and-set ينضرب آلاف المرات بكل تشغيل.
+بالنهاية كل نص لازم ينسحب مرة وحدة بالضبط.
+
+    python bench/session_race.py
+    python bench/session_race.py --writers 32 --messages 500 --repliers 8 --drains 20000 --stripes 1
+    python bench/session_race.py --store sqlite --drains 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def race(bot, *, writers=16, messages=300, repliers=8, drains=5000, timeout=120, fillers=2):
+    """
+    يشغل السباق على bot.STORE ويرجع النتيجة (dict). tests/test_session_race.py يشغله قصير،
+    وهذا السكربت طويل.
+    """
+    # الباتش ما ينقص (حتى أي نص ناقص يكون ضياع حقيقي) والسقف صغير حتى الـ eviction يصير طول الوقت
+    bot.PENDING_MAX = 10 ** 9
+    if hasattr(bot.STORE, "max_sessions"):
+        bot.STORE.max_sessions = 1
+    uid = "race-user"
+    sent, drained = [], []
+    out_lock = threading.Lock()
+    writers_done = threading.Event()
+    enough = threading.Event()      # وصلنا drains
+    errors = []
+
+    def guard(fn):
+        def run(*a):
+            try:
+                fn(*a)
+            except Exception as e:   # أي KeyError/TypeError من race = فشل
+                errors.append(repr(e))
+        return run
+
+    @guard
+    def writer(w):
+        i = 0
+        while i < messages or not enough.is_set():
+            if time.perf_counter() - t0 > timeout:
+                return
+            text = f"w{w}-m{i}"
+            bot.record_user_message(uid, text)
+            with out_lock:
+                sent.append(text)
+            i += 1
+            # نفسح مجال للـ repliers حتى الباتشات تطلع صغيرة وهواي
+            time.sleep(0)
+
+    def drain(expected_version):
+        batch = bot.drain_pending_batch(uid, expected_version=expected_version)
+        if batch:
+            bot.update_session(uid, inflight_texts=[])
+            with out_lock:
+                drained.append(batch.split("\n"))
+                if len(drained) >= drains:
+                    enough.set()
+
+    @guard
+    def replier():
+        while not writers_done.is_set():
+            st = bot.get_session(uid) or {}
+            drain(st.get("msg_version"))
+
+    @guard
+    def cleaner():
+        while not writers_done.is_set():
+            bot.STORE.cleanup(time.time() + bot.SESSION_CLEAN_AFTER + 1)
+            time.sleep(0.001)
+
+    @guard
+    def filler(f):
+        i = 0
+        while not writers_done.is_set():
+            other = f"filler-{f}-{i}"
+            bot.ensure_session(other)
+            bot.append_history(other, "user", "هلا")
+            bot.context_signature(uid)
+            i += 1
+
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(writers)]
+    others = [threading.Thread(target=replier) for _ in range(repliers)]
+    others += [threading.Thread(target=filler, args=(f,)) for f in range(fillers)]
+    others.append(threading.Thread(target=cleaner))
+
+    t0 = time.perf_counter()
+    for t in threads + others:
+        t.start()
+    for t in threads:
+        t.join()
+    writers_done.set()
+    for t in others:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    drain(None)   # اللي بقى بالباتش بعد آخر رسالة
+
+    counts = Counter(text for batch in drained for text in batch)
+    return {
+        "sent": len(sent),
+        "elapsed": elapsed,
+        "drained": len(drained),
+        "enough": enough.is_set(),
+        "lost": [t for t in sent if t not in counts],
+        "duplicated": [t for t, n in counts.items() if n > 1],
+        "errors": errors,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--writers", type=int, default=16)
+    ap.add_argument("--messages", type=int, default=300, help="أقل عدد رسائل لكل writer")
+    ap.add_argument("--repliers", type=int, default=8)
+    ap.add_argument("--drains", type=int, default=5000, help="نكمل لحد ما ينسحب هالعدد من الباتشات")
+    ap.add_argument("--timeout", type=float, default=120, help="إذا ما وصلنا --drains بهالثواني = FAIL")
+    ap.add_argument("--fillers", type=int, default=2, help="threads تسوي مراجعين ثانيين (ضغط على السقف)")
+    ap.add_argument("--stripes", type=int, default=None, help="SESSION_LOCK_STRIPES (الافتراضي مال البوت)")
+    ap.add_argument("--store", choices=("memory", "sqlite"), default="memory")
+    args = ap.parse_args()
+    if args.stripes:
+        os.environ["SESSION_LOCK_STRIPES"] = str(args.stripes)
+    tmp = tempfile.mkdtemp()
+    os.environ["SESSION_STORE_URL"] = "memory" if args.store == "memory" else f"sqlite:///{tmp}/sessions.db"
+    os.environ["SESSION_SNAPSHOT"] = ""
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("LEAD_DB", ":memory:")
+
+    import bot
+
+    r = race(bot, writers=args.writers, messages=args.messages, repliers=args.repliers, drains=args.drains,
+             timeout=args.timeout, fillers=args.fillers)
+    print(f"writers={args.writers} messages/writer>={args.messages} repliers={args.repliers} "
+          f"fillers={args.fillers} store={args.store} stripes={len(getattr(bot.STORE, 'stripes', [None]))}")
+    print(f"messages sent      {r['sent']}  ({r['sent'] / r['elapsed']:,.0f}/s)")
+    print(f"batches drained    {r['drained']}  (target {args.drains})")
+    print(f"sessions evicted   {getattr(bot.STORE, 'evicted', 0)}")
+    print(f"lost               {len(r['lost'])}  {r['lost'][:5]}")
+    print(f"duplicated         {len(r['duplicated'])}  {r['duplicated'][:5]}")
+    print(f"thread errors      {len(r['errors'])}  {r['errors'][:3]}")
+    ok = not r["lost"] and not r["duplicated"] and not r["errors"] and r["enough"]
+    print("OK" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
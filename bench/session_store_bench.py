@@ -0,0 +1,87 @@
+"""
+بنچمارك الـ session store: كم رسالة بالثانية نكدر نعالج لما يزيد عدد الـ workers.
+
+كل worker (process منفصل مثل gunicorn) يسوي نفس خطوات الـ webhook لكل رسالة:
+dedup بالـ mid → ensure_session → append_history → push_pending → bump_versions
+→ drain_pending_batch (compare-and-set على msg_version).
+
+    python bench/session_store_bench.py --store sqlite:////tmp/bench.db --workers 1 2 4 8
+
+ملاحظة: الـ memory store مو مشترك بين البروسسات، فأرقامه تنفع بس كـ baseline لـ worker واحد.
+الـ scaling يبين بس على مكينة بيها cores بقدر عدد الـ workers.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def worker(store_url, worker_id, messages, users, ready, start_evt, out):
+    os.environ["SESSION_STORE_URL"] = store_url
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["SESSION_SNAPSHOT"] = ""
+    os.environ.setdefault("LEAD_DB", ":memory:")
+    import bot
+
+    ready.put(worker_id)
+    start_evt.wait()
+    t0 = time.perf_counter()
+    for i in range(messages):
+        # نفس المستخدم ممكن توصل رسائله لأكثر من worker
+        user_id = f"user-{(worker_id * 7919 + i) % users}"
+        if not bot.STORE.mark_processed(f"mid-{worker_id}-{i}"):
+            continue
+        bot.ensure_session(user_id)
+        bot.append_history(user_id, "user", "بيش التغليف")
+        bot.push_pending(user_id, "بيش التغليف")
+        version, _ = bot.bump_versions(user_id)
+        bot.drain_pending_batch(user_id, expected_version=version)
+    out.put(time.perf_counter() - t0)
+
+
+def run(store_url, workers, messages, users):
+    ready = mp.Queue()
+    start_evt = mp.Event()
+    out = mp.Queue()
+    procs = [
+        mp.Process(target=worker, args=(store_url, w, messages, users, ready, start_evt, out))
+        for w in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    for _ in procs:
+        ready.get()  # خلي كل الـ workers يخلصون import قبل ما نبدي الوقت
+    t0 = time.perf_counter()
+    start_evt.set()
+    for p in procs:
+        p.join()
+    wall = time.perf_counter() - t0
+    return workers * messages / wall
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--store", default="sqlite:////tmp/clinic-bot-bench.db")
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--messages", type=int, default=2000, help="رسائل لكل worker")
+    ap.add_argument("--users", type=int, default=500)
+    args = ap.parse_args()
+
+    base = None
+    print(f"store={args.store} messages/worker={args.messages} users={args.users}")
+    for n in args.workers:
+        if args.store.startswith("sqlite:///"):
+            path = args.store[len("sqlite:///"):]
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        rate = run(args.store, n, args.messages, args.users)
+        base = base or rate
+        print(f"workers={n:<3} {rate:10.0f} msg/s   x{rate / base:.2f}")
+
+
+if __name__ == "__main__":
+    main()
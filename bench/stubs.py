@@ -0,0 +1,205 @@
+"""
+سيرفرات وهمية محلية لـ Graph API و OpenAI و CallMeBot حتى نشغل الـ load test
+بدون إنترنت وبدون ما نصرف tokens.
+
+    GRAPH_API_BASE=http://127.0.0.1:PORT
+    OPENAI_BASE_URL=http://127.0.0.1:PORT/v1
+    CALLMEBOT_URL=http://127.0.0.1:PORT/text.php
+
+كل شي يوصل للـ Graph ينسجل مع وقته، حتى الـ harness يحسب time-to-reply.
+الـ Graph batch (POST /v18.0 بـ batch=[...]) مدعوم مع depends_on، و graph_error_rate
+يخلي نسبة من الإرسالات ترجع rate limit (code 613) حتى نجرب الإعادة.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Latency:
+    """
+    توزيع تأخير من نص:
+        fixed:2            ثانيتين دايماً
+        uniform:1:3        بين 1 و 3
+        lognormal:1.5:0.5  median 1.5 ثانية و sigma 0.5 (ذيل طويل مثل الواقع)
+    """
+
+    def __init__(self, spec="lognormal:1.5:0.5"):
+        kind, *args = spec.split(":")
+        self.kind = kind
+        self.args = [float(a) for a in args]
+
+    def sample(self):
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return random.uniform(self.args[0], self.args[1])
+        if self.kind == "lognormal":
+            median, sigma = self.args
+            return random.lognormvariate(0, sigma) * median
+        raise ValueError(f"unknown latency spec: {self.kind}")
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.graph = []        # (ts, recipient, kind, payload)
+        self.openai_calls = 0
+        self.callmebot = []    # (ts, text)
+        self.graph_requests = 0
+        self.tokens = {}       # recipient -> {access_token} (لازم يكون توكن صفحته بس)
+
+    def add_graph(self, recipient, kind, payload, token=None):
+        with self.lock:
+            self.graph.append((time.time(), recipient, kind, payload))
+            self.tokens.setdefault(recipient, set()).add(token)
+
+    def replies(self):
+        with self.lock:
+            return [(ts, rid) for ts, rid, kind, _ in self.graph if kind == "message"]
+
+
+REPLIES = [
+    "هلا بيك، التغليف عدنا بمواد ألمانية وضمان مدى الحياة، ونحدد الأنسب إلك بالمعاينة المجانية 🌹",
+    "تدلل، انطيني اسمك ورقم هاتفك ويا يوم يناسبك حتى نثبتلك الحجز",
+    "الزراعة الفورية السن الواحد 200 التركي و275 الالماني، وتخلص خلال 72 ساعة",
+]
+
+
+THROTTLED = {"error": {"message": "Calls to this api have exceeded the rate limit.", "code": 613}}
+
+
+def make_handler(rec, llm_latency, graph_latency, callmebot_latency, graph_error_rate=0.0):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            n = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(n) if n else b""
+
+        def _json(self, code, obj):
+            raw = json.dumps(obj, ensure_ascii=False).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.endswith("/text.php"):
+                time.sleep(callmebot_latency.sample())
+                text = parse_qs(url.query).get("text", [""])[0]
+                with rec.lock:
+                    rec.callmebot.append((time.time(), text))
+                return self._json(200, {"ok": True})
+            self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self._body()
+            if url.path.endswith("/chat/completions"):
+                return self._chat(json.loads(body or b"{}"))
+            if url.path.endswith("/me/messages"):
+                with rec.lock:
+                    rec.graph_requests += 1
+                time.sleep(graph_latency.sample())
+                if random.random() < graph_error_rate:
+                    return self._json(400, THROTTLED)
+                self._graph_item(json.loads(body or b"{}"), self._token(url.query))
+                return self._json(200, {"recipient_id": "x", "message_id": "m"})
+            if url.path.rstrip("/").endswith("/v18.0"):
+                return self._graph_batch(parse_qs(body.decode()), self._token(url.query))
+            self._json(404, {"error": "not found"})
+
+        @staticmethod
+        def _token(query, default=None):
+            return parse_qs(query).get("access_token", [default])[0]
+
+        def _graph_item(self, payload, token):
+            recipient = (payload.get("recipient") or {}).get("id")
+            kind = payload.get("sender_action") or ("message" if "message" in payload else "other")
+            rec.add_graph(recipient, kind, payload, token)
+
+        def _graph_batch(self, form, token):
+            with rec.lock:
+                rec.graph_requests += 1
+            time.sleep(graph_latency.sample())
+            out, ok = [], {}
+            for req in json.loads(form.get("batch", ["[]"])[0]):
+                dep = req.get("depends_on")
+                if dep and not ok.get(dep):
+                    # مثل الـ Graph: إذا الـ request اللي نعتمد عليه فشل، هذا ما يتنفذ
+                    ok[req.get("name")] = False
+                    out.append(None)
+                    continue
+                if random.random() < graph_error_rate:
+                    ok[req.get("name")] = False
+                    out.append({"code": 400, "body": json.dumps(THROTTLED)})
+                    continue
+                fields = {k: v[0] for k, v in parse_qs(req.get("body", "")).items()}
+                payload = {k: v if k == "sender_action" else json.loads(v) for k, v in fields.items()}
+                # توكن الـ request (بالـ relative_url) يغلب توكن الـ batch
+                self._graph_item(payload, self._token(urlparse(req.get("relative_url", "")).query, token))
+                ok[req.get("name")] = True
+                out.append({"code": 200, "body": json.dumps({"recipient_id": "x", "message_id": "m"})})
+            self._json(200, out)
+
+        def _chat(self, req):
+            with rec.lock:
+                rec.openai_calls += 1
+            time.sleep(llm_latency.sample())
+            text = random.choice(REPLIES)
+            if not req.get("stream"):
+                return self._json(200, {
+                    "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                    "model": req.get("model", "gpt-4o"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 1500, "completion_tokens": 60, "total_tokens": 1560},
+                })
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                chunk = {
+                    "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": req.get("model", "gpt-4o"),
+                    "choices": [{"index": 0, "delta": {"content": word + (" " if i < len(words) - 1 else "")},
+                                 "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                time.sleep(0.01)
+            done = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": req.get("model", "gpt-4o"),
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            self.wfile.write(f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode())
+            self.wfile.flush()
+            self.close_connection = True
+
+    return Handler
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # الافتراضي 5: مع مئات الـ connections سوية (وضع async) الـ connect يفشل ويبين كأنه عطل بالـ API
+    request_queue_size = 1024
+
+
+def start_stub_server(llm_latency="lognormal:1.5:0.5", graph_latency="fixed:0.05", callmebot_latency="fixed:0.3",
+                      graph_error_rate=0.0):
+    """يشغل سيرفر واحد يخدم الثلاث APIs على port عشوائي. يرجع (server, recorder, base_url)."""
+    rec = Recorder()
+    handler = make_handler(
+        rec, Latency(llm_latency), Latency(graph_latency), Latency(callmebot_latency), graph_error_rate
+    )
+    server = StubServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, rec, f"http://127.0.0.1:{server.server_address[1]}"
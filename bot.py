@@ -1,180 +1,1385 @@
 from flask import Flask, request
 import requests
-from openai import OpenAI
+from requests.adapters import HTTPAdapter
+from openai import OpenAI, APIConnectionError, APIStatusError
 import time
 import os
 import threading
+import queue
 import json
-from datetime import datetime, timedelta
+import re
+import hashlib
+import hmac
+import zlib
+import sqlite3
+import heapq
+import itertools
+import bisect
+import atexit
+import signal
+import random
+import contextvars
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
 
 app = Flask(__name__)
 
 # =======================================================
 # 🔑 TOKENS & CONFIG
 # =======================================================
-VERIFY_TOKEN = "goldenline_secret"
+VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "goldenline_secret")
 PAGE_ACCESS_TOKEN = os.getenv("PAGE_ACCESS_TOKEN")
+APP_SECRET = os.getenv("APP_SECRET")    # إذا محدد، نتحقق من X-Hub-Signature-256 لكل webhook
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+# OPENAI_BASE_URL يوجهه لسيرفر ثاني (مثلاً stub الـ load test).
+# max_retries=0 لأن الإعادة والـ backoff يصيرون بـ resilient_call مثل باقي الـ endpoints
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
 # =======================================================
 # ⚙️ SETTINGS
 # =======================================================
-BUFFER_DELAY = 15
+BUFFER_DELAY = float(os.getenv("BUFFER_DELAY", "15"))
 MEMORY_TIMEOUT = 3600   # ساعة 
 HISTORY_LIMIT = 24      # limit للـ history (structured)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "450"))   # فوكاها نلخص الرسائل القديمة
+PENDING_MAX = 8         # أقصى رسائل بباتش واحد (الأقدم تنشال)
 REQUEST_TIMEOUT = 10    # seconds (Meta + OpenAI)
 SESSION_CLEAN_AFTER = 3600   # ساعة
 DUP_MSG_CLEAN_AFTER = 600    # 10 دقائق
 CLEANER_SLEEP = 600          # كل 10 دقائق
-TYPING_DELAY = 4        # بعد 4 ثواني يبين typing
-TYPING_REFRESH = 8      # كل 8 ثواني نعيد typing_on حتى ما ينطفي
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "50000"))      # سقف الجلسات بالذاكرة (LRU)
+PROCESSED_MAX_ENTRIES = int(os.getenv("PROCESSED_MAX_ENTRIES", "200000")) # سقف سجل الـ mid
+TYPING_DELAY = float(os.getenv("TYPING_DELAY", "4"))        # بعد 4 ثواني يبين typing
+TYPING_REFRESH = float(os.getenv("TYPING_REFRESH", "8"))    # كل 8 ثواني نعيد typing_on حتى ما ينطفي
+TYPING_SENDERS = int(os.getenv("TYPING_SENDERS", "4"))     # threads ترسل typing_on الدوري (Graph بطيء ما يوكف الـ loop)
+DEBOUNCE_POLICIES = os.getenv("DEBOUNCE_POLICIES", "fixed")   # مثلاً "adaptive" أو "fixed:50,adaptive:50" (A/B)
+DEBOUNCE_MIN = float(os.getenv("DEBOUNCE_MIN", "3"))
+DEBOUNCE_MAX = float(os.getenv("DEBOUNCE_MAX", str(BUFFER_DELAY)))
+DEBOUNCE_FOLLOWUP = 30  # رسالة توصل خلال 30 ثانية من الرد = ردّينا قبل ما يكمّل
+REPLY_WORKERS = int(os.getenv("REPLY_WORKERS", "48"))   # حد الـ threads اللي تنفذ الردود (أغلبهم ينتظرون دور الموديل)
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "8"))   # أقصى calls لـ OpenAI سوية
+OPENAI_QUEUE_MAX = int(os.getenv("OPENAI_QUEUE_MAX", "32"))      # فوكها نرد رد جاهز بدل ما نطول الطابور
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "4"))        # عدد الـ hosts اللي نحتفظ إلهم بـ pool
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "32")) # أقصى connections مفتوحة لكل host
+GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com")
+GRAPH_MESSAGES_URL = f"{GRAPH_API_BASE}/v18.0/me/messages"
+CALLMEBOT_URL = os.getenv("CALLMEBOT_URL", "http://api.callmebot.com/text.php")
+CALLMEBOT_USER = os.getenv("CALLMEBOT_USER", "ahmedalnafy")
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))     # أول backoff، ويتضاعف كل محاولة
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+CALL_BUDGET = float(os.getenv("CALL_BUDGET", "20"))      # أقصى وقت لـ call واحد بكل محاولاته
+REPLY_BUDGET = float(os.getenv("REPLY_BUDGET", "25"))    # أقصى وقت لرد واحد (الموديل + الإرسال)
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))         # فشل متتالي يفتح الـ breaker
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))      # شكد يبقى مفتوح قبل call تجريبي
+METRICS_PREFIX = "clinicbot_"
+# "threads" = Flask/gunicorn (الافتراضي). "asyncio" = asgi_bot.py يستورد هذا الملف
+# ويشغل الرد والتايمرات والـ HTTP على event loop، فهنا ما نشغل الـ threads الخلفية
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "threads")
+THREADED = BOT_RUNTIME == "threads"
+
+# =======================================================
+# 📏 Metrics + Trace Logging
+# =======================================================
+class Metrics:
+    """
+    counters و histograms و gauges بالذاكرة، تطلع بصيغة Prometheus على /metrics.
+    المراحل (webhook / ingest_wait / debounce / model / graph_send / notify) كلها
+    بـ histogram واحد stage_seconds{stage=...} حتى نقارن وين راح الوقت.
+    كل worker مال gunicorn إله أرقامه؛ Prometheus يجمعهم حسب الـ instance.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._hists = {}       # (name, labels) -> [counts لكل bucket + Inf, sum, count]
+        self._gauges = {}      # (name, labels) -> fn() (تنقرا وقت الـ scrape)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            h[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - t0, **labels)
+
+    def gauge(self, name, fn, **labels):
+        self._gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    @staticmethod
+    def _escape(value):
+        # صيغة الـ exposition: \ و " و سطر جديد داخل قيمة الـ label لازم escape
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @classmethod
+    def _labels(cls, pairs):
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{cls._escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        p = self.prefix
+        with self._lock:
+            counters = sorted(self._counters.items())
+            hists = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._hists.items())
+
+        out, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                out.append(f"# TYPE {p}{name} counter")
+            out.append(f"{p}{name}{self._labels(labels)} {value}")
+
+        for (name, labels), (counts, total, n) in hists:
+            if name not in typed:
+                typed.add(name)
+                out.append(f"# TYPE {p}{name} histogram")
+            cum = 0
+            for le, c in zip(self.BUCKETS + ("+Inf",), counts):
+                cum += c
+                out.append(f"{p}{name}_bucket{self._labels(labels + (('le', le),))} {cum}")
+            out.append(f"{p}{name}_sum{self._labels(labels)} {round(total, 6)}")
+            out.append(f"{p}{name}_count{self._labels(labels)} {n}")
+
+        for (name, labels), fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if name not in typed:
+                typed.add(name)
+                out.append(f"# TYPE {p}{name} gauge")
+            out.append(f"{p}{name}{self._labels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+
+# trace id لكل رسالة: ينولد بالـ webhook ويمشي وياها للـ ingest والرد،
+# فكل سطر log يخص نفس الرسالة يبدي بنفس الـ [trace].
+# ContextVar مو thread-local: كل thread إله قيمته، وكل task بالـ event loop (asgi_bot) هم
+_TRACE = contextvars.ContextVar("trace", default=None)
+
+def new_trace_id():
+    return os.urandom(4).hex()
+
+def set_trace(trace_id):
+    _TRACE.set(trace_id)
+
+def current_trace():
+    return _TRACE.get()
+
+def log(*args):
+    print(f"[{current_trace() or '-'}]", *args, flush=True)
 
 # =======================================================
 # 📊 MEMORY
 # =======================================================
-SESSIONS = {}
-PROCESSED_MESSAGES = {}  # لمنع تكرار الردود
+SESSION_LOCK_STRIPES = int(os.getenv("SESSION_LOCK_STRIPES", "64"))   # locks الجلسات (كل مراجع إله stripe واحد)
+SESSION_STALE_AFTER = 2 * SESSION_CLEAN_AFTER   # جلسة "نشطة" ما تحركت كل هالمدة = عالكة (رد فشل بالنص)، تنمسح عادي
+
+
+class SessionStripe:
+    """جزء من الجلسات بـ lock خاص بيه: مراجعين بـ stripes مختلفة ما ينتظرون بعض."""
+
+    __slots__ = ("lock", "sessions", "processed", "dirty", "evicted")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.sessions = OrderedDict()   # مرتبة حسب آخر رسالة (الأقدم أول) → التنظيف يبدي من الراس
+        self.processed = OrderedDict()  # لمنع تكرار الردود (مرتبة حسب وقت الوصول)
+        self.dirty = set()              # جلسات تغيرت (أو انمسحت) من آخر snapshot
+        self.evicted = 0
 
 # =======================================================
-# 🔥 AUTO CLEANER
+# 🗄️ Session Store (memory أو مشترك بين workers)
 # =======================================================
-def cleaner_daemon():
-    while True:
+# memory                       → dict داخل البروسس (worker واحد)
+# sqlite:///var/data/bot.db    → ملف SQLite (WAL) مشترك بين كل workers الـ gunicorn
+SESSION_STORE_URL = os.getenv("SESSION_STORE_URL", "memory")
+
+def new_session(now=None):
+    return {
+        "history": [],
+        "last_message_time": now or time.time(),   # وقت آخر رسالة مستخدم
+        "msg_version": 0,
+        "last_reply": "",
+        "pending_texts": [],
+        "pending_since": None,
+        "inflight_texts": [],  # الباتش اللي انسحب وبعده ما انرد عليه (يرجع بعد restart)
+        # السياق المرسوم للموديل (يتضاف عليه بدل ما ينعاد بناؤه كل مرة)
+        "ctx": "",
+        "ctx_lines": [],       # [(طول السطر, tokens), ...]
+        "ctx_tokens": 0,
+        "summary_turns": 0,    # كم رسالة قديمة انضغطت بالملخص
+        "summary_topics": [],
+        "facts": {},           # الخدمة/الاسم/الرقم/اليوم — ما تنحذف أبداً
+        "page": None,          # page id مال العيادة (Tenant) اللي يراسلها المراجع
+    }
+
+
+class SessionRecord:
+    """
+    جلسة بالذاكرة بـ __slots__ بدل dict (أصغر بكثير مع آلاف المراجعين)،
+    والـ history deque محدود بـ HISTORY_LIMIT.
+    تدعم نفس طريقة الوصول مال الـ dict (st["x"], st.get) حتى نفس الـ ops
+    تشتغل على الـ memory والـ SQLite.
+    """
+
+    __slots__ = (
+        "history", "last_message_time", "msg_version", "last_reply", "pending_texts", "pending_since",
+        "ctx", "ctx_lines", "ctx_tokens", "summary_turns", "summary_topics", "facts",
+        "gaps", "batch_since", "last_reply_at", "inflight_texts", "page",
+    )
+
+    def __init__(self, data):
+        for key in self.__slots__:
+            setattr(self, key, None)
+        self.update(data)
+        self.history = deque(self.history or (), maxlen=HISTORY_LIMIT)
+
+    def __getitem__(self, key):
         try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def setdefault(self, key, default):
+        value = getattr(self, key, None)
+        if value is None:
+            setattr(self, key, default)
+            value = default
+        return value
+
+    def update(self, data):
+        for key, value in data.items():
+            setattr(self, key, value)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__ if getattr(self, key) is not None}
+
+
+def session_active(st, now):
+    """باتش ينتظر الـ debounce أو رد بالطريق → الجلسة ما تنمسح (إلا إذا عالكة من زمان)."""
+    if not (st.get("pending_texts") or st.get("inflight_texts")):
+        return False
+    return now - (st.get("last_message_time") or 0) <= SESSION_STALE_AFTER
+
+
+class MemorySessionStore:
+    """
+    الجلسات بـ dicts داخل البروسس، مقسمة على SESSION_LOCK_STRIPES stripe حسب hash الـ user_id.
+    كل modify يصير تحت lock الـ stripe مال المراجع، فالـ read-modify-write (مثل drain + فحص
+    msg_version) يكون atomic، ومراجعين بـ stripes مختلفة يشتغلون سوية بدون lock عام.
+    locked(user_id) يمسك نفس الـ lock لكم modify ورا بعض (تسجيل رسالة كاملة).
+
+    كل stripe مرتب حسب last_message_time، فالجلسات المنتهية دايماً بالراس: التنظيف يمسح
+    بس اللي انتهى (O(expired)) بدل ما يفحص الكل، وإذا الـ stripe عبر حصته من
+    SESSION_MAX_ENTRIES نطلع الأقدم بيه (LRU تقريبي). الجلسات النشطة (session_active)
+    ما تنمسح أبداً، لا بالتنظيف ولا بالسقف.
+
+    إذا إله snapshot (SessionSnapshot)، كل جلسة تتغير تنسجل بـ dirty حتى تنحفظ،
+    وجلسة مو موجودة بالذاكرة تنقرا من الـ snapshot لحد ما التحميل الكامل يخلص.
+    """
+
+    def __init__(self, stripes=SESSION_LOCK_STRIPES, max_sessions=SESSION_MAX_ENTRIES,
+                 max_processed=PROCESSED_MAX_ENTRIES):
+        self.stripes = [SessionStripe() for _ in range(max(1, stripes))]
+        self.max_sessions = max_sessions
+        self.max_processed = max_processed
+        self.snapshot = None
+
+    def stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def _share(self, total):
+        # حصة كل stripe من السقف
+        return -(-total // len(self.stripes))
+
+    @property
+    def evicted(self):
+        return sum(stripe.evicted for stripe in self.stripes)
+
+    def _lookup(self, stripe, user_id):
+        st = stripe.sessions.get(user_id)
+        if st is None and self.snapshot is not None and not self.snapshot.loaded and user_id not in stripe.dirty:
+            st = self.snapshot.fault(stripe, user_id)
+        return st
+
+    def get(self, user_id):
+        stripe = self.stripe(user_id)
+        st = stripe.sessions.get(user_id)
+        if st is None and self.snapshot is not None and not self.snapshot.loaded:
+            with stripe.lock:
+                return self._lookup(stripe, user_id)
+        return st
+
+    def locked(self, user_id):
+        """lock المراجع (RLock): الـ modify اللي داخله يصيرون خطوة وحدة بالنسبة للردود والتنظيف."""
+        return self.stripe(user_id).lock
+
+    def view(self, user_id, fn):
+        """fn(st) تحت lock المراجع، للقراءات اللي تلف على الـ history وهو ممكن يتغير."""
+        stripe = self.stripe(user_id)
+        with stripe.lock:
+            return fn(self._lookup(stripe, user_id))
+
+    def modify(self, user_id, fn):
+        """
+        ينفذ fn(st) بشكل atomic. fn ترجع (st_جديد, نتيجة)؛
+        إذا st_جديد None تنمسح الجلسة.
+        """
+        stripe = self.stripe(user_id)
+        with stripe.lock:
+            old = self._lookup(stripe, user_id)
+            last = old["last_message_time"] if old is not None else None
+            st, result = fn(old)
+            if self.snapshot is not None:
+                stripe.dirty.add(user_id)
+            if st is None:
+                stripe.sessions.pop(user_id, None)
+                return result
+            if not isinstance(st, SessionRecord):
+                st = SessionRecord(st)
+            if st is not old:
+                stripe.sessions[user_id] = st
+            if st is not old or st["last_message_time"] != last:
+                # رسالة جديدة → الجلسة تروح لذيل الترتيب
+                stripe.sessions.move_to_end(user_id)
+                self._evict(stripe, time.time())
+            return result
+
+    def mark_processed(self, mid):
+        """True إذا الـ mid جديد (أول مرة نشوفه)."""
+        stripe = self.stripe(mid)
+        with stripe.lock:
+            if mid in stripe.processed:
+                return False
             now = time.time()
+            stripe.processed[mid] = now
+            self._expire_processed(stripe, now)
+            return True
+
+    def unmark_processed(self, mid):
+        """الحدث ما وصل الطابور: ننسى الـ mid حتى إعادة فيسبوك تنقبل."""
+        stripe = self.stripe(mid)
+        with stripe.lock:
+            stripe.processed.pop(mid, None)
+
+    def _expire_processed(self, stripe, now):
+        cap = self._share(self.max_processed)
+        while stripe.processed:
+            first, ts = next(iter(stripe.processed.items()))
+            if now - ts <= DUP_MSG_CLEAN_AFTER and len(stripe.processed) <= cap:
+                break
+            del stripe.processed[first]
+
+    def _evict(self, stripe, now):
+        # تحت lock الـ stripe. النشطة نتعداها ونكمل على اللي وراها، حتى لو بقينا فوك السقف
+        over = len(stripe.sessions) - self._share(self.max_sessions)
+        victims = []
+        for uid, st in stripe.sessions.items():
+            if over <= 0 and now - st["last_message_time"] <= SESSION_CLEAN_AFTER:
+                break
+            if session_active(st, now):
+                continue
+            victims.append(uid)
+            over -= 1
+        for uid in victims:
+            del stripe.sessions[uid]
+            if self.snapshot is not None:
+                stripe.dirty.add(uid)
+        stripe.evicted += len(victims)
+
+    def cleanup(self, now):
+        # stripe ورا stripe: الـ cleaner ما يوكف غير المراجعين اللي بنفس الـ stripe ولفترة قصيرة
+        for stripe in self.stripes:
+            with stripe.lock:
+                self._evict(stripe, now)
+                self._expire_processed(stripe, now)
+
+    def values(self):
+        out = []
+        for stripe in self.stripes:
+            with stripe.lock:
+                out.extend(stripe.sessions.values())
+        return out
+
+    def dirty_count(self):
+        return sum(len(stripe.dirty) for stripe in self.stripes)
 
-            # تنظيف الجلسات القديمة
-            for uid in list(SESSIONS.keys()):
-                st = SESSIONS.get(uid) or {}
-                last = st.get("last_message_time", 0)
-                if now - last > SESSION_CLEAN_AFTER:
-                    del SESSIONS[uid]
+    def count(self):
+        return sum(len(stripe.sessions) for stripe in self.stripes)
 
-            # تنظيف سجل الرسائل المكررة
-            for mid in list(PROCESSED_MESSAGES.keys()):
-                if now - PROCESSED_MESSAGES[mid] > DUP_MSG_CLEAN_AFTER:
-                    del PROCESSED_MESSAGES[mid]
+
+class SQLiteSessionStore:
+    """
+    جلسات مشتركة بين كل الـ workers بملف SQLite (WAL).
+    كل modify يصير داخل BEGIN IMMEDIATE، يعني الـ compare-and-set على
+    msg_version والـ dedup بالـ mid يكونون atomic حتى بين البروسسات.
+    locked() يلم أكثر من modify بـ transaction وحدة (مثل تسجيل الرسالة).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id TEXT PRIMARY KEY, data TEXT NOT NULL, last_message_time REAL NOT NULL)"
+        )
+        db.execute("CREATE TABLE IF NOT EXISTS processed (mid TEXT PRIMARY KEY, ts REAL NOT NULL)")
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=REQUEST_TIMEOUT, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _load(raw):
+        st = json.loads(raw)
+        # جلسات قديمة كانت تخزن كل رسالة كـ dict
+        st["history"] = [
+            [h["role"], h["text"], h["ts"]] if isinstance(h, dict) else h for h in st.get("history") or []
+        ]
+        return st
+
+    def get(self, user_id):
+        row = self._db().execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return self._load(row[0]) if row else None
+
+    @contextmanager
+    def locked(self, user_id):
+        """
+        مثل lock المراجع بالـ memory store: transaction وحدة (BEGIN IMMEDIATE) تلم الـ modify اللي داخله،
+        فالرد (حتى من بروسس ثاني) ما يسحب الباتش بين تسجيل الرسالة وزيادة الـ msg_version.
+        الـ lock على كل الملف مو على المراجع بس، فيبقى قصير.
+        """
+        db = self._db()
+        depth = getattr(self._local, "depth", 0)
+        if not depth:
+            db.execute("BEGIN IMMEDIATE")
+        self._local.depth = depth + 1
+        try:
+            yield
+        except BaseException:
+            self._local.depth = depth
+            if not depth:
+                db.execute("ROLLBACK")
+            raise
+        self._local.depth = depth
+        if not depth:
+            db.execute("COMMIT")
+
+    def view(self, user_id, fn):
+        return fn(self.get(user_id))
+
+    def modify(self, user_id, fn):
+        # لوحده = transaction خاص بيه؛ داخل locked() = جزء من الـ transaction مالته
+        with self.locked(user_id):
+            db = self._db()
+            row = db.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            st, result = fn(self._load(row[0]) if row else None)
+            if st is None:
+                db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+            else:
+                db.execute(
+                    "INSERT OR REPLACE INTO sessions (user_id, data, last_message_time) VALUES (?, ?, ?)",
+                    (user_id, json.dumps(st, ensure_ascii=False, default=list), st.get("last_message_time", 0)),
+                )
+            return result
+
+    def mark_processed(self, mid):
+        cur = self._db().execute("INSERT OR IGNORE INTO processed (mid, ts) VALUES (?, ?)", (mid, time.time()))
+        return cur.rowcount == 1
+
+    def unmark_processed(self, mid):
+        self._db().execute("DELETE FROM processed WHERE mid = ?", (mid,))
+
+    def cleanup(self, now):
+        db = self._db()
+        # مثل session_active: الجلسة اللي بيها باتش معلق تبقى، إلا إذا عالكة
+        db.execute(
+            "DELETE FROM sessions WHERE last_message_time < ? AND (last_message_time < ?"
+            " OR (COALESCE(json_array_length(data, '$.pending_texts'), 0) = 0"
+            " AND COALESCE(json_array_length(data, '$.inflight_texts'), 0) = 0))",
+            (now - SESSION_CLEAN_AFTER, now - SESSION_STALE_AFTER),
+        )
+        db.execute("DELETE FROM processed WHERE ts < ?", (now - DUP_MSG_CLEAN_AFTER,))
+
+    def count(self):
+        return self._db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def make_session_store(url):
+    if url.startswith("sqlite:///"):
+        return SQLiteSessionStore(url[len("sqlite:///"):])
+    return MemorySessionStore()
+
+STORE = make_session_store(SESSION_STORE_URL)
+
+# =======================================================
+# 🔥 AUTO CLEANER
+# =======================================================
+def cleaner_daemon():
+    while True:
+        try:
+            # تنظيف الجلسات القديمة + سجل الرسائل المكررة
+            STORE.cleanup(time.time())
 
         except Exception as e:
-            print("Cleaner error:", e)
+            log("Cleaner error:", e)
 
         time.sleep(CLEANER_SLEEP)
 
 threading.Thread(target=cleaner_daemon, daemon=True).start()
 
 # =======================================================
-# 🧱 Helpers (timeouts + error handling)
+# 🛡️ Resilience (backoff + circuit breaker + deadline)
 # =======================================================
-def safe_post(url, *, params=None, json=None, data=None, timeout=REQUEST_TIMEOUT, retries=1):
-    last_err = None
-    for _ in range(max(1, retries + 1)):
+GRAPH_THROTTLE_CODES = {4, 17, 32, 613, 80006}   # أكواد rate limit مال Graph (ترجع 400/403)
+GRAPH_TRANSIENT_CODES = {1, 2}
+
+
+class RetryableError(Exception):
+    """فشل مؤقت (timeout، 5xx، rate limit) — نعيد بعد wait ثانية أو backoff."""
+
+    def __init__(self, message, wait=None):
+        super().__init__(message)
+        self.wait = wait
+
+
+class CircuitOpenError(Exception):
+    """الـ endpoint معطل والـ breaker مفتوح — نفشل فوراً بدل ما ننتظر timeout."""
+
+
+class CircuitBreaker:
+    """
+    breaker لكل endpoint (graph / openai / callmebot):
+        closed → (BREAKER_FAILURES فشل متتالي) → open → (BREAKER_COOLDOWN) → half_open
+    بالـ half_open يعبر call تجريبي واحد: إذا نجح يرجع closed، وإذا فشل يرجع open.
+    rate limit أطول من ميزانية الـ call يفتحه للمدة اللي طلبها السيرفر (hold).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now < self.open_until or self._probing:
+                return False
+            # call تجريبي واحد بس: _probing يرفض أي call ثاني لحد ما هذا يخلص
+            # بـ record_success (→ closed) أو record_failure (→ open لـ cooldown جديد)
+            self.state = self.HALF_OPEN
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self._trip(self.cooldown)
+
+    def hold(self, seconds):
+        with self._lock:
+            self._trip(seconds)
+
+    def _trip(self, seconds):
+        if self.state != self.OPEN:
+            self.opened += 1
+            log(f"circuit {self.name} open for {seconds:.0f}s")
+        self.state = self.OPEN
+        self.open_until = max(self.open_until, time.monotonic() + seconds)
+
+    def is_open(self):
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() < self.open_until
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "opened": self.opened}
+
+
+BREAKERS = {name: CircuitBreaker(name) for name in ("graph", "openai", "callmebot", "other")}
+
+# deadline الرد الحالي (لكل thread أو task): كل call داخل الرد ياخذ أقل شي من ميزانيته
+# وباقي ميزانية الرد، فالإعادات كلها ما تعبر REPLY_BUDGET
+_DEADLINE = contextvars.ContextVar("deadline", default=None)
+
+@contextmanager
+def deadline_budget(seconds):
+    token = _DEADLINE.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+def call_deadline(budget):
+    at = time.monotonic() + budget
+    outer = _DEADLINE.get()
+    return min(at, outer) if outer is not None else at
+
+def backoff_delay(attempt):
+    # exponential backoff مع full jitter حتى الـ threads ما يرجعون كلهم بنفس اللحظة
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+def retry_after_seconds(value):
+    """Retry-After يا بالثواني يا تاريخ HTTP."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _graph_regain_seconds(headers):
+    # Graph يحط estimated_time_to_regain_access (بالدقائق) بـ X-Business-Use-Case-Usage
+    raw = headers.get("X-Business-Use-Case-Usage")
+    if not raw:
+        return None
+    try:
+        minutes = max(
+            (u.get("estimated_time_to_regain_access") or 0) for items in json.loads(raw).values() for u in items
+        )
+    except (ValueError, TypeError, AttributeError):
+        return None
+    return minutes * 60 if minutes else None
+
+def classify_graph_error(status, err, wait=None):
+    """(نعيد؟, شكد ننتظر قبل الإعادة أو None للـ backoff) لـ status + جسم error مال Graph."""
+    if status == 429 or status >= 500:
+        return True, wait
+    if err.get("code") in GRAPH_THROTTLE_CODES:
+        return True, wait
+    if err.get("is_transient") or err.get("code") in GRAPH_TRANSIENT_CODES:
+        return True, wait
+    # 4xx ثاني (token غلط، المستخدم ما يستقبل...) → الإعادة ما تفيد
+    return False, None
+
+def classify_response(r):
+    """رد HTTP فاشل → (نعيد؟, شكد ننتظر)."""
+    wait = retry_after_seconds(r.headers.get("Retry-After"))
+    try:
+        err = r.json().get("error") or {}
+    except (ValueError, AttributeError):
+        err = {}
+    if err.get("code") in GRAPH_THROTTLE_CODES and wait is None:
+        wait = _graph_regain_seconds(r.headers)
+    return classify_graph_error(r.status_code, err, wait)
+
+class RetryPlan:
+    """
+    قرارات resilient_call (الـ breaker، الميزانية، الـ backoff، الـ metrics) بدون أي انتظار،
+    حتى نسخة الـ threads ونسخة asgi_bot يمشون بنفس القواعد ويختلفون بس بـ sleep أو await.
+    """
+
+    def __init__(self, endpoint, retries=1, budget=CALL_BUDGET):
+        self.endpoint = endpoint
+        self.breaker = BREAKERS.get(endpoint) or BREAKERS["other"]
+        self.deadline = call_deadline(budget)
+        self.retries = retries
+        self.attempts = 0
+        self.err = None
+
+    def start(self):
+        """قبل كل محاولة: الوقت الباقي إلها، أو None إذا الميزانية خلصت. الـ breaker مفتوح → CircuitOpenError."""
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0.05:
+            self.err = self.err or TimeoutError(f"{self.endpoint}: deadline budget spent")
+            return None
+        if not self.breaker.allow():
+            METRICS.inc("breaker_rejected_total", endpoint=self.endpoint)
+            raise CircuitOpenError(self.endpoint)
+        if self.attempts:
+            METRICS.inc("http_retries_total", endpoint=self.endpoint)
+        return remaining
+
+    def succeeded(self):
+        self.breaker.record_success()
+
+    def rejected(self):
+        # السيرفر جاوب (بس الطلب نفسه غلط) → مو عطل بالـ endpoint
+        self.breaker.record_success()
+        METRICS.inc("http_failures_total", endpoint=self.endpoint)
+
+    def failed(self, err):
+        """فشل مؤقت: يرجع شكد ننتظر قبل المحاولة الجاية، أو None إذا نوكف."""
+        self.breaker.record_failure()
+        self.err = err
+        n = self.attempts
+        self.attempts += 1
+        if n >= self.retries:
+            return None
+        wait = err.wait if err.wait is not None else backoff_delay(n)
+        if time.monotonic() + wait >= self.deadline:
+            if err.wait is not None:
+                # السيرفر طلب ننتظر أكثر من ميزانيتنا → باقي الـ calls تفشل فوراً لحد ذاك الوقت
+                self.breaker.hold(err.wait)
+            return None
+        return wait
+
+    def give_up(self):
+        METRICS.inc("http_failures_total", endpoint=self.endpoint)
+        return self.err
+
+
+def resilient_call(endpoint, attempt, *, retries=1, budget=CALL_BUDGET):
+    """
+    ينفذ attempt(timeout) لحد retries+1 مرات ضمن ميزانية وقت وحدة.
+    attempt يرمي RetryableError للفشل المؤقت (نعيد بعد Retry-After أو backoff)؛
+    أي exception ثاني يطلع مباشرة. إذا الـ breaker مفتوح نرمي CircuitOpenError فوراً.
+    """
+    plan = RetryPlan(endpoint, retries, budget)
+    while (remaining := plan.start()) is not None:
         try:
-            r = requests.post(url, params=params, json=json, data=data, timeout=timeout)
+            result = attempt(remaining)
+        except RetryableError as e:
+            wait = plan.failed(e)
+            if wait is None:
+                break
+            time.sleep(wait)
+        except Exception:
+            plan.rejected()
+            raise
+        else:
+            plan.succeeded()
+            return result
+    raise plan.give_up()
+
+# =======================================================
+# 🧱 Helpers (timeouts + error handling)
+# =======================================================
+class MessengerClient:
+    """
+    كلاينت واحد لكل البروسس يحتفظ بـ connections مفتوحة (keep-alive)
+    لـ graph.facebook.com و CallMeBot، حتى كل typing/رسالة تكون round-trip واحد
+    بدل TLS handshake جديد كل مرة. مشترك بين كل العيادات: token لكل إرسال
+    (توكن الصفحة)، والافتراضي self.token.
+    """
+
+    def __init__(self, token, *, pool_hosts=HTTP_POOL_HOSTS, pool_per_host=HTTP_POOL_PER_HOST):
+        self.token = token
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_per_host)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.batcher = None     # GraphBatcher اختياري يجمع الإرسالات بـ batch requests
+
+    @staticmethod
+    def endpoint(url):
+        """اسم قصير للـ host (label للـ metrics)."""
+        if url.startswith(CALLMEBOT_URL):
+            return "callmebot"
+        if url.startswith(GRAPH_API_BASE):
+            return "graph"
+        return "other"
+
+    def request(self, method, url, *, params=None, json=None, data=None, timeout=REQUEST_TIMEOUT, retries=1,
+                budget=CALL_BUDGET):
+        """يرجع الـ response، أو None إذا فشلت كل المحاولات أو الـ breaker مفتوح."""
+        endpoint = self.endpoint(url)
+
+        def attempt(remaining):
+            t0 = time.monotonic()
+            try:
+                r = self.session.request(
+                    method, url, params=params, json=json, data=data, timeout=min(timeout, remaining)
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise RetryableError(str(e)) from e
+            METRICS.observe("http_request_seconds", time.monotonic() - t0, endpoint=endpoint)
             if r.status_code >= 400:
-                raise requests.HTTPError(f"HTTP {r.status_code}: {r.text[:200]}")
+                retryable, wait = classify_response(r)
+                msg = f"HTTP {r.status_code}: {r.text[:200]}"
+                if retryable:
+                    raise RetryableError(msg, wait)
+                raise requests.HTTPError(msg)
             return r
+
+        try:
+            return resilient_call(endpoint, attempt, retries=retries, budget=budget)
+        except CircuitOpenError:
+            return None
         except Exception as e:
-            last_err = e
-            time.sleep(0.4)
-    print("safe_post failed:", last_err)
-    return None
+            log(f"{method} {url} failed:", e)
+            return None
+
+    def send(self, receiver, payload, retries=1, wait=True, token=None):
+        """
+        wait=False (typing) ما ينتظر النتيجة إذا الـ batcher شغال؛
+        الترتيب بعده محفوظ لأن الـ batcher يطلع رسائل كل مستخدم بالترتيب.
+        """
+        token = token or self.token
+        if not token:
+            return None
+        body = {"recipient": {"id": receiver}}
+        body.update(payload)
+        if self.batcher is not None:
+            return self.batcher.submit(body, wait=wait, token=token)
+        return self.post_message(body, retries=retries, token=token)
+
+    def post_message(self, body, retries=1, token=None):
+        return self.request(
+            "POST", GRAPH_MESSAGES_URL, params={"access_token": token or self.token}, json=body, retries=retries
+        )
+
+    def send_action(self, receiver, action, token=None):
+        return self.send(receiver, {"sender_action": action}, wait=False, token=token)
+
+    def send_text(self, receiver, text, token=None):
+        return self.send(receiver, {"message": {"text": text}}, token=token)
+
+
+MESSENGER = MessengerClient(PAGE_ACCESS_TOKEN)
+
+# =======================================================
+# 📦 Graph Batch (typing + رسائل بـ request واحد وقت الزحمة)
+# =======================================================
+GRAPH_BATCH = os.getenv("GRAPH_BATCH", "1") == "1"
+GRAPH_BATCH_WINDOW = float(os.getenv("GRAPH_BATCH_WINDOW", "0.05"))   # شكد نجمع قبل ما نطلع
+GRAPH_BATCH_MAX = 50           # حد الـ Graph لكل batch
+GRAPH_BATCH_WORKERS = int(os.getenv("GRAPH_BATCH_WORKERS", "4"))     # batches بالطريق سوية
+GRAPH_BATCH_RETRIES = 2        # كم مرة نعيد item فشل لوحده
+GRAPH_BATCH_URL = f"{GRAPH_API_BASE}/v18.0"
+
+# نتيجة submit إذا الوقت خلص والـ item بالطريق (ما نقدر نسحبه): ممكن يوصل، فالمنادي ما يعيد الإرسال.
+# truthy حتى `if not sent` ما يحسبه فشل
+SEND_PENDING = object()
+
+
+class GraphBatcher:
+    """
+    يجمع الإرسالات للـ Graph (typing + رسائل) لمدة GRAPH_BATCH_WINDOW ويطلعهن
+    بـ batch request واحد (لحد GRAPH_BATCH_MAX)، بدل request لكل إرسال.
+
+    ترتيب كل مستخدم محفوظ: داخل الـ batch كل item يعتمد (depends_on) على اللي قبله
+    لنفس المستخدم، والمستخدم اللي عنده batch بالطريق تنتظر إرسالاته الجديدة لحد ما يخلص.
+    batch واحد ممكن يخلط صفحات (عيادات): كل item يحمل توكن صفحته.
+    كل item ينقرا رده لوحده: اللي فشل مؤقتاً (rate limit، 5xx، اعتماده فشل) يرجع لراس
+    الطابور وينعاد بعد backoff، واللي فشل نهائياً نتيجته None.
+    """
+
+    class _Item:
+        __slots__ = ("recipient", "body", "token", "future", "attempts", "due")
+
+        def __init__(self, body, token):
+            self.recipient = body["recipient"]["id"]
+            self.body = body
+            self.token = token
+            self.future = Future()
+            self.attempts = 0
+            self.due = 0.0
+
+    def __init__(self, messenger, window=GRAPH_BATCH_WINDOW, max_items=GRAPH_BATCH_MAX,
+                 workers=GRAPH_BATCH_WORKERS, retries=GRAPH_BATCH_RETRIES):
+        self.messenger = messenger
+        self.window = window
+        self.max_items = max_items
+        self.retries = retries
+        self._pending = deque()
+        self._inflight = set()      # مستخدمين عندهم batch بالطريق
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="graph-batch")
+        self._thread = None
+        self.batches = 0
+        self.items = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def submit(self, body, wait=True, token=None):
+        item = self._Item(body, token or self.messenger.token)
+        with self._cond:
+            self._pending.append(item)
+            self._cond.notify()
+        if not wait:
+            return item.future
+        try:
+            return item.future.result(timeout=max(0.1, call_deadline(CALL_BUDGET) - time.monotonic()))
+        except FutureTimeout:
+            return self._cancel(item)
+
+    def _cancel(self, item):
+        """الوقت خلص: إذا بعده بالطابور نسحبه (None = ما انبعث، إعادته آمنة)، وإلا SEND_PENDING."""
+        with self._cond:
+            try:
+                self._pending.remove(item)
+            except ValueError:
+                pass
+            else:
+                item.future.cancel()
+                METRICS.inc("graph_batch_items_total", status="cancelled")
+                return None
+        try:
+            # يمكن نتيجته طلعت بهاللحظة
+            return item.future.result(timeout=0)
+        except FutureTimeout:
+            return SEND_PENDING
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _next_ready(self, now):
+        """None إذا أكو item جاهز هسه، وإلا كم ننتظر (أو None = لحد ما يوصل شي)."""
+        blocked, soonest = set(), None
+        for item in self._pending:
+            if item.recipient in blocked or item.recipient in self._inflight:
+                blocked.add(item.recipient)
+                continue
+            if item.due <= now:
+                return 0
+            blocked.add(item.recipient)
+            soonest = item.due if soonest is None else min(soonest, item.due)
+        return None if soonest is None else soonest - now
+
+    def _take(self, now):
+        batch, chosen, blocked, keep = [], set(), set(), deque()
+        while self._pending and len(batch) < self.max_items:
+            item = self._pending.popleft()
+            rid = item.recipient
+            if rid in blocked or rid in self._inflight or item.due > now:
+                blocked.add(rid)
+                keep.append(item)
+                continue
+            chosen.add(rid)
+            batch.append(item)
+        keep.extend(self._pending)
+        self._pending = keep
+        self._inflight |= chosen
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    wait = self._next_ready(time.monotonic())
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+            # نخلي الرسائل اللي توصل بنفس اللحظة تلحك نفس الـ batch
+            time.sleep(self.window)
+            while True:
+                with self._cond:
+                    batch = self._take(time.monotonic())
+                if not batch:
+                    break
+                self._pool.submit(self._flush, batch)
+
+    @staticmethod
+    def batch_form(bodies, tokens=None):
+        """
+        أجسام الرسائل → form الـ batch request (كل رسالة تعتمد على اللي قبلها لنفس المستخدم).
+        tokens (لكل رسالة): الـ batch ينبعث بتوكن الأولى، واللي توكنها غيره ياخذه بالـ relative_url
+        (توكن الـ request الواحد يغلب توكن الـ batch).
+        """
+        reqs, last_name = [], {}
+        for i, body in enumerate(bodies):
+            recipient = body["recipient"]["id"]
+            url = "me/messages"
+            if tokens and tokens[i] != tokens[0]:
+                url += "?" + urlencode({"access_token": tokens[i]})
+            req = {
+                "method": "POST",
+                "relative_url": url,
+                "name": f"m{i}",
+                "omit_response_on_success": False,
+                "body": urlencode({
+                    k: v if isinstance(v, str) else json.dumps(v, ensure_ascii=False) for k, v in body.items()
+                }),
+            }
+            if recipient in last_name:
+                req["depends_on"] = last_name[recipient]
+            last_name[recipient] = req["name"]
+            reqs.append(req)
+        return {"batch": json.dumps(reqs, ensure_ascii=False), "include_headers": "false"}
+
+    @staticmethod
+    def batch_results(results, n):
+        """رد الـ batch (list) → لكل item: (نتيجة أو None, نعيد؟, wait)."""
+        if not isinstance(results, list) or len(results) != n:
+            # الـ batch كله فشل (resilient_call عاد عليه) → كل الـ items تفشل
+            return [(None, False, None)] * n
+
+        out = []
+        for res in results:
+            if not res:
+                # null = ما انعالج (اعتماده فشل أو timeout) → نعيده
+                out.append((None, True, None))
+                continue
+            code = res.get("code") or 0
+            try:
+                body = json.loads(res.get("body") or "{}")
+            except ValueError:
+                body = {}
+            if code < 400:
+                out.append((body or True, False, None))
+                continue
+            err = (body.get("error") or {}) if isinstance(body, dict) else {}
+            retryable, wait = classify_graph_error(code, err)
+            out.append((None, retryable, wait))
+        return out
+
+    def _post(self, batch):
+        """يرجع لكل item: (نتيجة أو None, نعيد؟, wait)."""
+        if len(batch) == 1:
+            # item واحد → request عادي (ما نحتاج غلاف الـ batch)
+            r = self.messenger.post_message(batch[0].body, token=batch[0].token)
+            return [(r, False, None)]
+
+        tokens = [item.token for item in batch]
+        r = self.messenger.request(
+            "POST", GRAPH_BATCH_URL, params={"access_token": tokens[0]},
+            data=self.batch_form([item.body for item in batch], tokens),
+        )
+        try:
+            results = r.json() if r is not None else None
+        except ValueError:
+            results = None
+        return self.batch_results(results, len(batch))
+
+    def _flush(self, batch):
+        try:
+            results = self._post(batch)
+        except Exception as e:
+            log("Graph batch error:", e)
+            results = [(None, False, None)] * len(batch)
+
+        retry, failed = [], 0
+        for item, (res, retryable, wait) in zip(batch, results):
+            if res:
+                item.future.set_result(res)
+                METRICS.inc("graph_batch_items_total", status="ok")
+            elif retryable and item.attempts < self.retries:
+                item.attempts += 1
+                item.due = time.monotonic() + (wait if wait is not None else backoff_delay(item.attempts))
+                retry.append(item)
+                METRICS.inc("graph_batch_items_total", status="retried")
+            else:
+                item.future.set_result(None)
+                failed += 1
+                METRICS.inc("graph_batch_items_total", status="failed")
+
+        with self._cond:
+            self.batches += 1
+            self.items += len(batch)
+            self.retried += len(retry)
+            self.failed += failed
+            # المعادة ترجع لراس الطابور حتى تبقى قبل أي إرسال أحدث لنفس المستخدم
+            self._pending.extendleft(reversed(retry))
+            self._inflight.difference_update(item.recipient for item in batch)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": len(self._pending),
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "retried": self.retried,
+                "failed": self.failed,
+            }
+
+
+GRAPH_BATCHER = GraphBatcher(MESSENGER)
+if GRAPH_BATCH and THREADED:
+    GRAPH_BATCHER.start()
+    MESSENGER.batcher = GRAPH_BATCHER
 
 def ensure_session(user_id: str):
     now = time.time()
-    st = SESSIONS.get(user_id)
-
-    if (not st) or (now - (st.get("last_message_time", 0)) > MEMORY_TIMEOUT):
-        SESSIONS[user_id] = {
-            "history": [],
-            "last_message_time": now,   # وقت آخر رسالة مستخدم
-            "msg_version": 0,
-            "last_reply": "",
-            "pending_texts": [],
-            "pending_since": None,      # ✅ فاصلة هنا
-            "is_typing": False,
-            "typing_version": 0
-        }
-    return
+    page = current_tenant().page_id
+
+    def op(st):
+        if (not st) or (now - (st.get("last_message_time", 0)) > MEMORY_TIMEOUT):
+            st = new_session(now)
+        if st.get("page") is None:
+            st["page"] = page
+        return st, None
 
+    STORE.modify(user_id, op)
 
+def get_session(user_id: str):
+    return STORE.get(user_id)
 
+def update_session(user_id: str, **fields):
+    def op(st):
+        if st:
+            st.update(fields)
+        return st, None
 
+    STORE.modify(user_id, op)
 
 def append_history(user_id: str, role: str, text: str):
-    st = SESSIONS[user_id]
-    st["history"].append({"role": role, "text": (text or "").strip(), "ts": int(time.time())})
+    def op(st):
+        st = st or new_session()
+        # كل رسالة (role, text, ts) — tuple أصغر من dict
+        st["history"].append((role, (text or "").strip(), int(time.time())))
+
+        # limit
+        if len(st["history"]) > HISTORY_LIMIT:
+            st["history"] = st["history"][-HISTORY_LIMIT:]
+
+        _context_append(st, role, (text or "").strip())
+        return st, None
+
+    STORE.modify(user_id, op)
+
+# =======================================================
+# 🧵 Incremental Context (سياق يتضاف عليه + ملخص للقديم)
+# =======================================================
+# بس "اسمي"/"الاسم" ككلمة كاملة: "انا" تجي ويا أي شي ("انا عندي سن مكسور")، وبدون حدود
+# الكلمة "الضمانات" تطلع اسم "ت ..."
+_NAME_RE = re.compile(r"(?<!\S)(?:اسمي|الاسم)(?:\s*[:：]\s*|\s+)([^\s\d،,.:：]+(?:\s+[^\s\d،,.]+)?)")
+_DAY_WORDS = {
+    "السبت": "السبت", "الاحد": "الأحد", "الاثنين": "الاثنين", "الاتنين": "الاثنين",
+    "الثلاثاء": "الثلاثاء", "الثلاثا": "الثلاثاء", "الاربعاء": "الأربعاء", "الاربعا": "الأربعاء",
+    "الخميس": "الخميس", "الجمعه": "الجمعة", "باجر": "باجر", "اليوم": "اليوم",
+}
+# اليوم ينحسب "مطلوب" بس ويا كلمة حجز/موعد بنفس الرسالة: "اليوم سني يوجعني" مو طلب موعد
+_BOOKING_HINTS = {"حجز", "احجز", "نحجز", "موعد", "موعدي", "اجي", "اجيكم", "نجي", "اراجع", "اراجعكم", "مراجعه"}
+
+def estimate_tokens(text: str):
+    # تقريب: العربي بـ gpt-4o تقريباً token لكل 3 حروف
+    return max(1, (len(text) + 2) // 3)
+
+def topic_name(group: str):
+    grp = SERVICE_GROUPS.get(group)
+    if grp:
+        return grp["name"]
+    return next((svc["name"] for svc in SERVICES if svc["group"] == group), group)
+
+def _extract_facts(st, text: str):
+    facts = st.setdefault("facts", {})
+    phone = extract_iraqi_phone(text)
+    if phone:
+        facts["phone"] = phone
+    topic = detect_topic(text)
+    if topic:
+        facts["service"] = topic_name(topic)
+    m = _NAME_RE.search(text)
+    if m and not extract_iraqi_phone(m.group(1)):
+        facts["name"] = m.group(1).strip()
+    toks = normalize_arabic(text).split()
+    if any(_stem(tok) in _BOOKING_HINTS for tok in toks):
+        for tok in toks:
+            if tok in _DAY_WORDS:
+                facts["day"] = _DAY_WORDS[tok]
+
+def _context_append(st, role: str, text: str):
+    """
+    يضيف سطر واحد للسياق المرسوم. إذا عبرنا CONTEXT_TOKEN_BUDGET، أقدم الأسطر
+    تنضغط بملخص (المواضيع اللي انسألت) والسياق ينعاد رسمه مرة وحدة بس.
+    """
+    if not text:
+        return
+    who = "المراجع" if role == "user" else "علي"
+    line = f"{who}: {text}"
+    tokens = estimate_tokens(line)
+    if role == "user":
+        _extract_facts(st, text)
+
+    # ctx_lines بيها بس (طول السطر, tokens) — النص نفسه موجود مرة وحدة بـ ctx
+    lines = st.setdefault("ctx_lines", [])
+    lines.append((len(line), tokens))
+    st["ctx_tokens"] = st.get("ctx_tokens", 0) + tokens
+    st["ctx"] = f"{st['ctx']}\n{line}" if st.get("ctx") else line
+
+    if st["ctx_tokens"] <= CONTEXT_TOKEN_BUDGET or len(lines) <= 2:
+        return
 
-    # limit
-    if len(st["history"]) > HISTORY_LIMIT:
-        st["history"] = st["history"][-HISTORY_LIMIT:]
+    # نضغط لحد 3/4 الميزانية حتى ما نعيد الضغط مع كل رسالة
+    topics = st.setdefault("summary_topics", [])
+    ctx = st["ctx"]
+    while len(lines) > 2 and st["ctx_tokens"] > CONTEXT_TOKEN_BUDGET * 3 // 4:
+        length, old_tokens = lines.pop(0)
+        old_line, ctx = ctx[:length], ctx[length + 1:]
+        st["ctx_tokens"] -= old_tokens
+        st["summary_turns"] = st.get("summary_turns", 0) + 1
+        topic = detect_topic(old_line)
+        if topic and topic_name(topic) not in topics:
+            topics.append(topic_name(topic))
+    del topics[:-6]
+    st["ctx"] = ctx
 
 def format_context(user_id: str):
-    st = SESSIONS[user_id]
-    if not st["history"]:
+    st = get_session(user_id)
+    if not st.get("ctx"):
         return "لا يوجد سياق سابق"
 
-    lines = []
-    for item in st["history"]:
-        who = "المراجع" if item["role"] == "user" else "علي"
-        lines.append(f"{who}: {item['text']}")
-    return "\n".join(lines)
+    header = []
+    facts = st.get("facts") or {}
+    labels = (("service", "الخدمة"), ("name", "الاسم"), ("phone", "الرقم"), ("day", "اليوم المطلوب"))
+    known = [f"{label}: {facts[key]}" for key, label in labels if facts.get(key)]
+    if known:
+        header.append("معلومات المراجع: " + " | ".join(known))
+    if st.get("summary_turns"):
+        topics = "، ".join(st.get("summary_topics") or []) or "أسئلة عامة"
+        header.append(f"ملخص الكلام الأقدم ({st['summary_turns']} رسالة): سأل عن {topics}")
+    return "\n".join(header + [st["ctx"]])
+
+def last_reply_of(user_id: str):
+    st = get_session(user_id) or {}
+    return (st.get("last_reply") or "").strip()
 
 def last_user_message(user_id: str):
-    st = SESSIONS[user_id]
-    for item in reversed(st["history"]):
-        if item["role"] == "user" and item["text"]:
-            return item["text"]
+    st = get_session(user_id)
+    for role, text, _ in reversed(st["history"]):
+        if role == "user" and text:
+            return text
     return None
 def push_pending(user_id: str, text: str):
-    st = SESSIONS[user_id]
     t = (text or "").strip()
     if not t:
         return
 
-    if st.get("pending_since") is None:
-        st["pending_since"] = time.time()
+    def op(st):
+        st = st or new_session()
+        if st.get("pending_since") is None:
+            st["pending_since"] = time.time()
 
-    st["pending_texts"].append(t)
+        st["pending_texts"].append(t)
 
-    # limit للباتش حتى ما يصير سبام
-    if len(st["pending_texts"]) > 8:
-        st["pending_texts"] = st["pending_texts"][-8:]
+        # limit للباتش حتى ما يصير سبام
+        if len(st["pending_texts"]) > PENDING_MAX:
+            st["pending_texts"] = st["pending_texts"][-PENDING_MAX:]
+        return st, None
 
+    STORE.modify(user_id, op)
 
-def drain_pending_batch(user_id: str):
-    st = SESSIONS[user_id]
-    items = st.get("pending_texts") or []
 
-    # فرّغ الباتش
-    st["pending_texts"] = []
-    st["pending_since"] = None
+def drain_pending_batch(user_id: str, expected_version=None, quiet_for=0):
+    """
+    يسحب الباتش ويفرغه بخطوة وحدة atomic.
+    إذا expected_version محدد: يسحب بس إذا msg_version بعده نفسه (compare-and-set)
+    وآخر رسالة صار إلها quiet_for ثانية على الأقل، حتى worker واحد بس يرد.
+    """
+    now = time.time()
 
+    def op(st):
+        if not st:
+            return st, None
+        if expected_version is not None:
+            if st.get("msg_version") != expected_version:
+                return st, None
+            if now - st.get("last_message_time", 0) < quiet_for:
+                return st, None
+
+        items = st.get("pending_texts") or []
+
+        # فرّغ الباتش (ونحتفظ ببداية الباتش لحساب time-to-first-reply)
+        st["batch_since"] = st.get("pending_since")
+        st["pending_texts"] = []
+        st["pending_since"] = None
+        # يبقى بالـ snapshot لحد ما نرد، حتى restart بالنص ما يضيعه
+        if items:
+            st["inflight_texts"] = items
+        return st, items
+
+    items = STORE.modify(user_id, op)
     if not items:
         return None
 
     merged = "\n".join(items).strip()
     return merged if merged else None
-def safe_get(url, *, params=None, timeout=REQUEST_TIMEOUT, retries=1):
-    last_err = None
-    for _ in range(max(1, retries + 1)):
-        try:
-            r = requests.get(url, params=params, timeout=timeout)
-            if r.status_code >= 400:
-                raise requests.HTTPError(f"HTTP {r.status_code}: {r.text[:200]}")
-            return r
-        except Exception as e:
-            last_err = e
-            time.sleep(0.4)
-    print("safe_get failed:", last_err)
-    return None
 
+def bump_versions(user_id: str):
+    """
+    يسجل وصول رسالة: يحدث last_message_time ويزيد msg_version.
+    يسجل الفاصل عن الرسالة السابقة (للـ debounce المتكيف)، ويرجع
+    (msg_version, followup) — followup=True إذا الرسالة وصلت بعد رد قريب.
+    """
+    def op(st):
+        now = time.time()
+        st = st or new_session(now)
+        prev = st.get("last_message_time") or 0
+        if st["msg_version"] and now - prev < 2 * DEBOUNCE_MAX:
+            st["gaps"] = (st.get("gaps") or [])[-7:] + [round(now - prev, 2)]
+
+        followup = bool(st.get("last_reply_at")) and now - st["last_reply_at"] < DEBOUNCE_FOLLOWUP
+        if followup:
+            st["last_reply_at"] = None
+
+        st["last_message_time"] = now
+        st["msg_version"] += 1
+        return st, (st["msg_version"], followup)
+
+    return STORE.modify(user_id, op)
 
 _AR_DIGITS = str.maketrans({
     "٠":"0","١":"1","٢":"2","٣":"3","٤":"4","٥":"5","٦":"6","٧":"7","٨":"8","٩":"9",
     "۰":"0","۱":"1","۲":"2","۳":"3","۴":"4","۵":"5","۶":"6","۷":"7","۸":"8","۹":"9",
 })
 
+# كتلة أرقام طولها 11 بالضبط تبدي بـ 07 (إنكليزي/عربي/فارسي) — مرور واحد على النص
+_DIGIT = "[0-9\u0660-\u0669\u06f0-\u06f9]"
+_PHONE_RE = re.compile(rf"(?<!\d)[0\u0660\u06f0][7\u0667\u06f7]{_DIGIT}{{9}}(?!\d)")
+_NUMBER_RE = re.compile(r"\d+")
+
+def _numbers(text):
+    return set(_NUMBER_RE.findall((text or "").translate(_AR_DIGITS)))
+
 def extract_iraqi_phone(text: str):
     """
     يلتقط رقم عراقي 11 رقم يبدأ 07
@@ -182,75 +1387,785 @@ def extract_iraqi_phone(text: str):
     """
     if not text:
         return None
+    m = _PHONE_RE.search(text)
+    return m.group().translate(_AR_DIGITS) if m else None
 
-    t = text.translate(_AR_DIGITS)
 
-    # خلي كل غير الأرقام مسافات حتى نلقط تسلسلات أرقام
-    cleaned = []
-    for ch in t:
-        cleaned.append(ch if ch.isdigit() else " ")
-    cleaned = "".join(cleaned)
+def notify_callmebot(text: str, user=CALLMEBOT_USER):
+    """
+    يرسل إشعار الى CallMeBot (واتساب صاحب العيادة). يرجع True إذا وصل.
+    """
+    params = {
+        "user": user,
+        "text": text
+    }
+    with METRICS.timer("stage_seconds", stage="notify"):
+        r = MESSENGER.request("GET", CALLMEBOT_URL, params=params, retries=1)
+    METRICS.inc("notifications_total", status="ok" if r else "failed")
+    return bool(r)
 
-    # لقط أي كتلة أرقام وفتّش عن 07 + 9 أرقام (11 رقم)
-    for part in cleaned.split():
-        if len(part) == 11 and part.startswith("07") and part.isdigit():
-            return part
+# =======================================================
+# 📇 Lead Outbox (أرقام الحجز → CallMeBot بدون تكرار وبدون ضياع)
+# =======================================================
+# الافتراضي جنب bot.py، مو بالمجلد اللي انشغل منه البروسس
+LEAD_DB = os.getenv("LEAD_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "leads.db")
+LEAD_DEDUP_WINDOW = int(os.getenv("LEAD_DEDUP_WINDOW", "21600"))   # نفس الرقم من نفس المراجع خلال 6 ساعات = lead واحد
+LEAD_MIN_INTERVAL = float(os.getenv("LEAD_MIN_INTERVAL", "5"))     # بين رسالة CallMeBot والثانية (rate limit)
+LEAD_BATCH_MAX = 5             # أرقام برسالة وحدة
+LEAD_MAX_ATTEMPTS = 20
+LEAD_LEASE = 60                # الـ worker اللي سحب lead عنده دقيقة يرسله قبل ما غيره ياخذه
 
-    return None
+
+def format_leads(leads):
+    """leads: [(id, user_id, phone, name, service, page), ...] → نص رسالة CallMeBot."""
+    lines = []
+    for _, _, phone, name, service, *_ in leads:
+        hints = " - ".join(h for h in (name and f"الاسم: {name}", service and f"الخدمة: {service}") if h)
+        lines.append(f"{phone} ({hints})" if hints else phone)
+    if len(lines) == 1:
+        return f"يرجى الاتصال على الرقم {lines[0]} لتثبيت الحجز النهائي"
+    return "يرجى الاتصال على الأرقام التالية لتثبيت الحجز النهائي:\n" + "\n".join(lines)
+
+
+def lead_recipient(leads):
+    """رقم CallMeBot لصاحب العيادة (كل leads الدفعة من نفس الصفحة، شوف claim)."""
+    return TENANTS.get(leads[0][5]).callmebot_user
 
 
-def notify_callmebot(phone: str):
+class LeadOutbox:
     """
-    يرسل إشعار الى CallMeBot يحتوي الرقم ونص تثبيت الحجز
+    كل رقم ينلقط ينكتب بـ SQLite أول، وthread بالخلفية يرسله لـ CallMeBot.
+    - نفس المراجع + نفس الرقم خلال LEAD_DEDUP_WINDOW → lead واحد (الاسم/الخدمة تتحدث عليه إذا بعده ما طلع)
+    - أكثر من lead جاهز → رسالة وحدة (لحد LEAD_BATCH_MAX)، وبين الرسائل LEAD_MIN_INTERVAL
+    - الفشل يرجع بـ backoff لحد LEAD_MAX_ATTEMPTS، والباقي يطلع بعد إعادة التشغيل
+    الملف مشترك بين workers الـ gunicorn: السحب يصير بـ lease حتى ما ينرسل lead مرتين.
+    كل lead يحمل صفحته (page)، والدفعة الوحدة ما تخلط عيادات.
     """
-    url = "http://api.callmebot.com/text.php"
-    msg = f"يرجى الاتصال على الرقم {phone} لتثبيت الحجز النهائي"
-    params = {
-        "user": "ahmedalnafy",
-        "text": msg
-    }
-    safe_get(url, params=params, retries=1)
+
+    def __init__(self, path=LEAD_DB, window=LEAD_DEDUP_WINDOW, min_interval=LEAD_MIN_INTERVAL,
+                 batch_max=LEAD_BATCH_MAX, max_attempts=LEAD_MAX_ATTEMPTS):
+        self.window = window
+        self.min_interval = min_interval
+        self.batch_max = batch_max
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.queued = 0
+        self.duplicates = 0
+        self.sent = 0
+        self.failed = 0
+        # الملف ينفتح بأول استعمال، مو بالـ import
+        self.path = path
+        self._conn = None
+        self._open = threading.Lock()
+
+    @property
+    def _db(self):
+        if self._conn is None:
+            with self._open:
+                if self._conn is None:
+                    self._conn = self._connect()
+        return self._conn
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=REQUEST_TIMEOUT, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS leads ("
+            " id INTEGER PRIMARY KEY, user_id TEXT NOT NULL, phone TEXT NOT NULL, name TEXT, service TEXT,"
+            " created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL, sent_at REAL)"
+        )
+        try:
+            # ملفات قبل تعدد الصفحات: leads بدون page تروح للعيادة الافتراضية
+            db.execute("ALTER TABLE leads ADD COLUMN page TEXT")
+        except sqlite3.OperationalError:
+            pass
+        db.execute("CREATE INDEX IF NOT EXISTS leads_user_phone ON leads (user_id, phone, created)")
+        db.execute("CREATE INDEX IF NOT EXISTS leads_due ON leads (sent_at, next_at)")
+        return db
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def add(self, user_id, phone, name=None, service=None, page=None):
+        """يرجع True إذا انضاف lead جديد، False إذا مكرر."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id, sent_at FROM leads WHERE user_id = ? AND phone = ? AND created > ?"
+                    " ORDER BY id DESC LIMIT 1",
+                    (user_id, phone, now - self.window),
+                ).fetchone()
+                if row and row[1] is None and (name or service):
+                    self._db.execute(
+                        "UPDATE leads SET name = COALESCE(?, name), service = COALESCE(?, service) WHERE id = ?",
+                        (name, service, row[0]),
+                    )
+                elif not row:
+                    self._db.execute(
+                        "INSERT INTO leads (user_id, phone, name, service, page, created, next_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (user_id, phone, name, service, page, now, now),
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            if row:
+                self.duplicates += 1
+            else:
+                self.queued += 1
+        METRICS.inc("leads_total", status="duplicate" if row else "queued")
+        if not row:
+            self._wake.set()
+        return not row
+
+    def claim(self, now):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # صفحة أقدم lead جاهز، وبعدين الجاهزين من نفس الصفحة بس (رسالة وحدة = عيادة وحدة)
+                first = self._db.execute(
+                    "SELECT page FROM leads WHERE sent_at IS NULL AND next_at <= ? ORDER BY id LIMIT 1", (now,)
+                ).fetchone()
+                rows = first and self._db.execute(
+                    "SELECT id, user_id, phone, name, service, page FROM leads"
+                    " WHERE sent_at IS NULL AND next_at <= ? AND page IS ? ORDER BY id LIMIT ?",
+                    (now, first[0], self.batch_max),
+                ).fetchall() or []
+                if rows:
+                    self._db.executemany(
+                        "UPDATE leads SET next_at = ? WHERE id = ?", [(now + LEAD_LEASE, r[0]) for r in rows]
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return rows
+
+    def finish(self, rows, ok, now):
+        with self._lock:
+            if ok:
+                self._db.executemany("UPDATE leads SET sent_at = ? WHERE id = ?", [(now, r[0]) for r in rows])
+                self.sent += len(rows)
+                return
+            # backoff: 15 ثانية وتتضاعف لحد 10 دقائق؛ بعد LEAD_MAX_ATTEMPTS يوكف (next_at = 1e18)
+            self._db.executemany(
+                "UPDATE leads SET attempts = attempts + 1,"
+                " next_at = CASE WHEN attempts + 1 >= ? THEN 1e18 ELSE ? + MIN(600, 15 * (1 << attempts)) END"
+                " WHERE id = ?",
+                [(self.max_attempts, now, r[0]) for r in rows],
+            )
+            self.failed += len(rows)
+        log(f"lead notification failed ({len(rows)} leads), will retry")
+
+    def purge(self, now):
+        # المرسلة نحتفظ بيها لحد ما تخلص نافذة الـ dedup
+        with self._lock:
+            self._db.execute("DELETE FROM leads WHERE sent_at IS NOT NULL AND created < ?", (now - self.window,))
+
+    def next_wait(self, now):
+        with self._lock:
+            row = self._db.execute("SELECT MIN(next_at) FROM leads WHERE sent_at IS NULL").fetchone()
+        due = row[0] if row and row[0] is not None else now + 60
+        return max(0.5, min(60, due - now))
+
+    def _run(self):
+        while True:
+            try:
+                while True:
+                    rows = self.claim(time.time())
+                    if not rows:
+                        break
+                    self.finish(rows, notify_callmebot(format_leads(rows), lead_recipient(rows)), time.time())
+                    time.sleep(self.min_interval)
+                self.purge(time.time())
+                wait = self.next_wait(time.time())
+            except Exception as e:
+                log("Lead outbox error:", e)
+                wait = 5
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def pending(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM leads WHERE sent_at IS NULL AND next_at < 1e18").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            out = {"queued": self.queued, "duplicates": self.duplicates, "sent": self.sent, "failed": self.failed}
+        out["pending"] = self.pending()
+        return out
+
+
+LEADS = LeadOutbox()
+if THREADED:
+    LEADS.start()
 
 # =======================================================
 # ✍️ Typing Indicator
 # =======================================================
 def send_typing(receiver):
-    if not PAGE_ACCESS_TOKEN:
-        return
-    url = "https://graph.facebook.com/v18.0/me/messages"
-    params = {"access_token": PAGE_ACCESS_TOKEN}
-    payload = {"recipient": {"id": receiver}, "sender_action": "typing_on"}
-    safe_post(url, params=params, json=payload, retries=1)
+    MESSENGER.send_action(receiver, "typing_on", token=tenant_of(receiver).token)
 def send_typing_off(receiver):
-    if not PAGE_ACCESS_TOKEN:
-        return
-    url = "https://graph.facebook.com/v18.0/me/messages"
-    params = {"access_token": PAGE_ACCESS_TOKEN}
-    payload = {"recipient": {"id": receiver}, "sender_action": "typing_off"}
-    safe_post(url, params=params, json=payload, retries=1)
+    MESSENGER.send_action(receiver, "typing_off", token=tenant_of(receiver).token)
+
+
+class TypingManager:
+    """
+    مالك واحد لحالة الـ typing لكل مستخدم:
+        idle → pending (وصلت رسالة، ننتظر TYPING_DELAY)
+             → typing (typing_on طلع، نعيده كل TYPING_REFRESH)
+             → replying (نحضّر الرد) → idle
+    loop واحد يحدّث كل المستخدمين الفعالين بدل timer لكل واحد، والإرسال نفسه يصير
+    برا الـ lock (pool صغير)، فـ Graph بطيء لمستخدم ما يأخر typing الباقين.
+    كل مستخدم إله lock صغير و sending: finish ينتظر typing_on اللي بالطريق يخلص،
+    فـ typing_on ما يطلع أبداً بعد ما بدأ إرسال الرد.
+    """
+
+    IDLE, PENDING, TYPING, REPLYING = "idle", "pending", "typing", "replying"
+    MAX_TYPING = 120    # أمان: ما نبقى نعيد typing أكثر من دقيقتين بدون رد
+
+    class _Entry:
+        __slots__ = ("lock", "sent", "sending", "state", "due", "since")
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.sent = threading.Condition(self.lock)   # ينطلق لمن sending يرجع False
+            self.sending = False
+            self.state = TypingManager.IDLE
+            self.due = 0.0
+            self.since = 0.0
+
+    def __init__(self, delay=TYPING_DELAY, refresh=TYPING_REFRESH, senders=TYPING_SENDERS):
+        self.delay = delay
+        self.refresh = refresh
+        self._entries = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="typing")
+        self.sent_on = 0
+        self.sent_off = 0
+        self.saved = 0      # typing_off اللي ما طلعت لأن الرسالة نفسها تطفي الـ typing
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _entry(self, user_id):
+        with self._cond:
+            e = self._entries.get(user_id)
+            if e is None:
+                e = self._entries[user_id] = self._Entry()
+            return e
+
+    def on_message(self, user_id):
+        """وصلت رسالة: إذا typing بعده ما اشتغل، أجّل تشغيله لبعد TYPING_DELAY."""
+        e = self._entry(user_id)
+        now = time.monotonic()
+        with e.lock:
+            if e.state in (self.IDLE, self.PENDING):
+                e.state = self.PENDING
+                e.due = now + self.delay
+                e.since = now
+        with self._cond:
+            self._cond.notify()
+
+    def begin_reply(self, user_id):
+        """قبل ما نحضّر الرد: إذا typing مو شغال، شغله هسه."""
+        e = self._entry(user_id)
+        now = time.monotonic()
+        with e.lock:
+            send = e.state not in (self.TYPING, self.REPLYING) and not e.sending
+            if send:
+                e.sending = True
+                e.due = now + self.refresh
+            if e.state == self.IDLE:
+                e.since = now
+            e.state = self.REPLYING
+        if send:
+            self._send(user_id, e)
+        with self._cond:
+            self._cond.notify()
+
+    def finish(self, user_id, message_follows: bool):
+        """
+        خلص الرد. إذا راح نرسل رسالة، Messenger يطفي الـ typing وحده
+        فما نرسل typing_off. إذا ماكو رسالة، نطفيه صراحة.
+        لازم تنادى قبل send_message حتى أي refresh بالطريق يخلص قبلها.
+        """
+        with self._cond:
+            e = self._entries.pop(user_id, None)
+        if e is None:
+            return
+        with e.lock:
+            active = e.state in (self.TYPING, self.REPLYING)
+            e.state = self.IDLE
+            # refresh بالطريق لازم يوصل قبل الرسالة (أو typing_off)؛ اللي بعده ما بدأ يشوف IDLE ويطلع
+            while e.sending:
+                e.sent.wait()
+        if not active:
+            return
+        if message_follows:
+            self.saved += 1
+        else:
+            send_typing_off(user_id)
+            self.sent_off += 1
+
+    def release(self, user_id):
+        """
+        هذا الـ worker مو هو اللي راح يرد (الباتش سحبه worker ثاني): نبطل typing مالتنا
+        بصمت. اللي يرد عنده typing خاص بيه، ورسالته أو typing_off مالته تطفيه.
+        """
+        with self._cond:
+            e = self._entries.pop(user_id, None)
+        if e is not None:
+            with e.lock:
+                e.state = self.IDLE
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            with self._cond:
+                entries = list(self._entries.items())
+            next_due = now + self.refresh
+
+            for user_id, e in entries:
+                with e.lock:
+                    if e.state == self.IDLE:
+                        continue
+                    if now - e.since > self.MAX_TYPING:
+                        e.state = self.IDLE
+                        with self._cond:
+                            if self._entries.get(user_id) is e:
+                                del self._entries[user_id]
+                        continue
+                    if e.due <= now and not e.sending:
+                        e.sending = True
+                        if e.state == self.PENDING:
+                            e.state = self.TYPING
+                        e.due = now + self.refresh
+                        self._pool.submit(self._refresh_one, user_id, e)
+                    next_due = min(next_due, e.due)
+
+            with self._cond:
+                self._cond.wait(max(0.05, next_due - time.monotonic()))
+
+    def _refresh_one(self, user_id, e):
+        with e.lock:
+            if e.state == self.IDLE:
+                # finish أو release سبقونا
+                e.sending = False
+                e.sent.notify_all()
+                return
+        self._send(user_id, e)
+
+    def _send(self, user_id, e):
+        """typing_on برا الـ lock؛ sending يبقى True لحد ما يخلص حتى finish ينتظره."""
+        try:
+            send_typing(user_id)
+            self.sent_on += 1
+        except Exception as ex:
+            log("typing_on failed:", ex)
+        finally:
+            with e.lock:
+                e.sending = False
+                e.sent.notify_all()
+
+    def active(self):
+        with self._cond:
+            return len(self._entries)
+
+    def stats(self):
+        return {
+            "active": self.active(),
+            "sent_on": self.sent_on,
+            "sent_off": self.sent_off,
+            "saved_calls": self.saved,
+        }
+
+
+TYPING = TypingManager()
+if THREADED:
+    TYPING.start()
 
 # =======================================================
 # ✉️ Send Message
 # =======================================================
 def send_message(receiver, text):
-    if not PAGE_ACCESS_TOKEN:
-        print("Missing PAGE_ACCESS_TOKEN")
+    tenant = tenant_of(receiver)
+    if not tenant.token:
+        log(f"Missing page access token ({tenant.name})")
         return
-    url = "https://graph.facebook.com/v18.0/me/messages"
-    params = {"access_token": PAGE_ACCESS_TOKEN}
-    payload = {"recipient": {"id": receiver}, "message": {"text": text}}
-    r = safe_post(url, params=params, json=payload, retries=1)
+    with METRICS.timer("stage_seconds", stage="graph_send"):
+        r = MESSENGER.send_text(receiver, text, token=tenant.token)
     if not r:
-        print("Failed to send message")
+        log("Failed to send message")
+    return r
 
 # =======================================================
-# 🤖 Chat Engine (Ali)
+# 🗃️ Answer Cache (أسئلة متكررة بدون OpenAI)
 # =======================================================
-def ask_openai_chat(user_id, text):
-    ensure_session(user_id)
-    context = format_context(user_id)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "21600"))   # 6 ساعات
+ANSWER_CACHE_MAX_CHARS = 80    # الأسئلة الطويلة غالباً حالة خاصة، ما نخزنها
+
+_AR_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+_AR_LETTERS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه", "ک": "ك", "ی": "ي"})
+_NON_WORD = re.compile(r"[^\w\s]|_")
+# بس الحروف العربية (التطويل ينشال ويا التشكيل): "1000" أو "0777" تبقى مثل ما هي
+_ELONGATION = re.compile(r"([\u0621-\u064a])\1{2,}")
+
+def normalize_arabic(text: str):
+    """
+    يوحّد النص حتى نفس السؤال بصيغ مختلفة يطلع نفس الـ key:
+    يشيل التشكيل والتطويل، يوحّد الألف/الياء/التاء المربوطة، يحول الأرقام العربية،
+    يشيل علامات الترقيم ويختصر الحروف المكررة (هلاااا → هلا).
+    """
+    t = (text or "").translate(_AR_DIGITS)
+    t = _AR_DIACRITICS.sub("", t).translate(_AR_LETTERS).lower()
+    t = _NON_WORD.sub(" ", t)
+    t = _ELONGATION.sub(r"\1", t)
+    return " ".join(t.split())
+
+def context_signature(user_id: str):
+    """
+    بصمة تقريبية للسياق: هل المحادثة جديدة، وآخر خدمة انذكرت.
+    نفس السؤال (مثلاً "بيش") بسياق تغليف غير عن سياق زراعة.
+    """
+    # نسخة من الـ history تحت lock المراجع (رسالة جديدة ممكن تتضاف بنص اللفة)
+    history = STORE.view(user_id, lambda st: list((st or {}).get("history") or ()))
+    stage = "cont" if any(role == "assistant" for role, _, _ in history) else "new"
+    topic = ""
+    for role, text, _ in reversed(history):
+        if role != "user":
+            continue
+        topic = detect_topic(text)
+        if topic:
+            break
+    return f"{stage}:{topic}"
+
+
+class AnswerCache:
+    """
+    LRU + TTL للأجوبة. الـ key = بصمة الـ prompt + السؤال بعد التوحيد + بصمة السياق،
+    فأي تعديل على نص الـ prompt يلغي كل الأجوبة القديمة تلقائياً.
+    """
+
+    def __init__(self, size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()    # key -> (expires_at, answer)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def prompt_digest(prompt: str):
+        return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def make_key(prompt_digest: str, question: str, signature: str):
+        """prompt_digest من prompt_digest() (كل عيادة تحسبه مرة وحدة بالتشغيل)."""
+        q = normalize_arabic(question)
+        if not q or len(q) > ANSWER_CACHE_MAX_CHARS or any(ch.isdigit() for ch in q):
+            # رقم هاتف/عدد أسنان/سؤال طويل → جواب خاص بالمراجع، ما يتخزن
+            return None
+        return (prompt_digest, q, signature)
+
+    def get(self, key):
+        if key is None:
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] > now:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item:
+                del self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, answer):
+        if key is None or not answer:
+            return
+        with self._lock:
+            self._items[key] = (time.time() + self.ttl, answer)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+ANSWER_CACHE = AnswerCache()
+
+# =======================================================
+# 📋 Clinic Catalog (مصدر واحد للأسعار والمعلومات)
+# =======================================================
+# نفس الكتالوج يولّد قسم الأسعار بالـ prompt ويجاوب الأسئلة البسيطة مباشرة،
+# حتى ما يصير فرق بين اللي يعرفه الموديل واللي يرد بيه الـ fast path.
+CLINIC_INFO = {
+    "hours": "يومياً 4م–9م، الجمعة عطلة",
+    "location": "بغداد / زيونة / شارع الربيعي الخدمي / داخل كراج مجمع اسطنبول",
+    "phone": "07728802820",
+    "installments": "نظام الاقساط متوفر على مصرف الرافدين تقسيط لمدة 10 اشهر بدون مقدمة",
+}
+
+_LIFETIME_NOTE = "بمواد ألمانية وضمان حقيقي على جودة العمل مدى الحياة"
+
+# match: عبارات تدل على الخدمة بالضبط (فارغة = الموديل بس يجاوب عليها)
+# note: تنضاف لرد السعر الجاهز، بس للخدمات اللي فعلاً عليها هالضمان (اختيارية)
+SERVICES = [
+    {"key": "zircon", "group": "crown", "name": "تغليف الزاركون", "price": "50 ألف", "match": ["زاركون"], "note": _LIFETIME_NOTE},
+    {"key": "zircon_emax", "group": "crown", "name": "تغليف الزاركون ايماكس", "price": "75 ألف", "match": ["زاركون ايماكس"], "note": _LIFETIME_NOTE},
+    {"key": "emax", "group": "crown", "name": "تغليف الايماكس", "price": "125 ألف", "match": ["ايماكس"], "note": _LIFETIME_NOTE},
+    {"key": "cosmetic_filling", "group": "filling", "name": "حشوة تجميلية", "price": "35 ألف", "match": ["حشوه تجميليه"]},
+    {"key": "root_canal", "group": "filling", "name": "حشوة جذر", "price": "125 ألف", "match": ["حشوه جذر", "علاج جذر"]},
+    {"key": "extraction", "group": "extraction", "name": "قلع", "price": "25 ألف", "match": ["قلع", "شلع"]},
+    {"key": "cleaning", "group": "cleaning", "name": "تنظيف", "price": "25 ألف", "match": ["تنظيف", "تنظيف اسنان"]},
+    {"key": "whitening", "group": "whitening", "name": "تبييض ليزر", "price": "75 ألف", "match": ["تبييض", "تبيض", "تبييض ليزر"]},
+    {"key": "braces", "group": "braces", "name": "تقويم", "price": "450 ألف للفك", "match": ["تقويم"]},
+    {"key": "implant_arch", "group": "implant", "name": "فك كامل زرعات فورية", "price": "مليون وربع", "match": [], "note": _LIFETIME_NOTE},
+    {"key": "implant_arches", "group": "implant", "name": "فكين كامل زرعات فورية", "price": "مليونين ونص", "match": [], "note": _LIFETIME_NOTE},
+    {"key": "smile_zircon", "group": "smile", "name": "ابتسامة زاركون 20 سن", "price": "مليون دينار", "match": []},
+    {"key": "smile_zircon_emax", "group": "smile", "name": "ابتسامة زاركون ايماكس 20 سن", "price": "مليون و 500 الف دينار", "match": []},
+    {"key": "smile_emax", "group": "smile", "name": "ابتسامة الايماكس 20 سن", "price": "مليونين و 500 الف دينار", "match": []},
+    {"key": "implant_classic", "group": "implant", "name": "الزراعة التقليدية", "price": "السن الواحد 350 الف الكوري و 450 الف الالماني", "match": [], "note": _LIFETIME_NOTE},
+    {"key": "implant_immediate", "group": "implant", "name": "الزراعة الفورية", "price": "السن الواحد 200 التركي , 275 الالماني.", "match": [], "note": _LIFETIME_NOTE},
+    {"key": "implant_offer", "group": "implant", "name": "عروض الزراعة", "price": "للفك الواحد مليون وربع للفكين مليونين ونص", "match": [], "note": _LIFETIME_NOTE},
+    {"key": "crown_arch", "group": "crown", "name": "تغليف فك زاركون 14 سن", "price": "700 الف دينار , فكين 28 سن مليون و 400 (ممكن يكون السؤال ابتسامة لفك واحد )", "match": [], "note": _LIFETIME_NOTE},
+    {"key": "denture", "group": "denture", "name": "الفك المتحرك او الاسنان المتحركة", "price": "للفك الواحد 450 الف اما اذا اسنان فردية يحدد بعد المعاينة", "match": []},
+]
+
+# كلمات عامة للمجموعة (بدون تحديد النوع)
+SERVICE_GROUPS = {
+    "crown": {"name": "تغليف", "synonyms": ["تركيب", "تغليف", "تقبيق", "قبق", "قالب"]},
+    "implant": {"name": "زراعة", "synonyms": ["زراعه", "زرعه", "زرعات"]},
+    "smile": {"name": "ابتسامة", "synonyms": ["ابتسامه"]},
+    "filling": {"name": "حشوة", "synonyms": ["حشوه", "حشوات"]},
+    "denture": {"name": "فك متحرك", "synonyms": ["فك متحرك", "اسنان متحركه"]},
+}
+
+PRICE_WORDS = ["بيش", "شكد", "ابيش", "السعر", "سعر", "اسعار", "التكلفه", "كلفه"]
+DISCOUNT_WORDS = ["هواي", "مابيها مجال", "غالي", "شدعوة", "هله هلة بينة", "ماعندي"]
+
+# كلمات تخلي الـ fast path يتراجع ويخلي الموديل يجاوب
+# (ترحيب، حجز، شكوى، تخفيض، سؤال عن الطبيب/الحالة)
+HANDOFF_WORDS = DISCOUNT_WORDS + [
+    "هلا", "هلو", "مرحبا", "السلام", "سلام", "شلونكم", "حجز", "احجز", "موعد", "دكتور", "دكتوره",
+    "طبيب", "طبيبه", "وجع", "الم", "يوجعني", "مشكله", "زعلان", "ليش", "شكد يطول",
+    "فك", "فكين", "سنين",
+]
+
+INTENT_PHRASES = {
+    "hours": ["دوام", "الدوام", "اوقات الدوام", "شوكت تفتحون", "ساعات الدوام", "شوكت دوامكم"],
+    # "وين" وحدها ما تكفي ("وين صرتو"، "وين الرد") → لازم وياها اسم مكان
+    "location": ["مكانكم", "موقعكم", "العنوان", "عنوانكم", "لوكيشن", "وين العياده", "وين مكانكم", "وين محلكم"],
+    "phone": ["رقمكم", "رقم العياده", "رقم تلفون", "رقم الهاتف"],
+    "installments": ["اقساط", "تقسيط", "بالتقسيط", "بالاقساط"],
+}
+
+FAST_PATH_MAX_WORDS = 7
+
+# كلمات حشو يتحملها الـ fast path. أي كلمة غيرها ما يعرفها الكتالوج ("تقويم شفاف"، "ضرس العقل")
+# ممكن تغيّر السؤال → يروح للموديل
+FAST_PATH_FILLERS = [
+    "شنو", "شني", "اكو", "عدكم", "عندكم", "ممكن", "اريد", "اعرف", "بالله", "لو سمحت", "رجاءا",
+    "هو", "هي", "مال", "مالت", "مالكم", "يا", "شوكت", "اسنان", "السن", "الواحد", "السن الواحد",
+]
+
+
+def catalog_prompt_section(clinic=CLINIC_INFO, services=SERVICES):
+    """قسم (تفاصيل العيادة + الأسعار) اللي ينحط بالـ prompt، يتولد من الكتالوج."""
+    lines = [
+        "تفاصيل العيادة:",
+        f"الدوام: {clinic['hours']}",
+        f"الموقع: {clinic['location']}",
+        f"الهاتف: {clinic['phone']}",
+        "",
+        "الأسعار:",
+    ]
+    lines += [f"- {svc['name']}: {svc['price']}" for svc in services]
+    return "\n".join(lines)
+
+
+_PREFIXES = ("وبال", "وال", "بال", "فال", "لل", "ال", "و")
+
+def _stem(token: str):
+    # يشيل أدوات التعريف والعطف الملتصقة (والتغليف → تغليف) بس إذا بقت كلمة معقولة
+    for p in _PREFIXES:
+        if token.startswith(p) and len(token) - len(p) >= 3:
+            return token[len(p):]
+    return token
 
-    prompt = """
+
+class IntentMatcher:
+    """
+    trie على كلمات النص بعد التوحيد. كل عبارة (كلمة أو أكثر) تأشر على (نوع, قيمة):
+    ("price", None) / ("service", key) / ("group", key) / ("info", hours|location|...) / ("handoff", None)
+    / ("filler", None)
+    المطابقة تاخذ أطول عبارة من كل موقع.
+    """
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, phrase, label):
+        node = self._root
+        for tok in normalize_arabic(phrase).split():
+            node = node.setdefault(_stem(tok), {})
+        node[None] = label
+
+    def scan(self, text):
+        """مثل match، بس يرجع كمان الكلمات اللي ما دخلت بأي عبارة (rest)."""
+        toks = [_stem(t) for t in normalize_arabic(text).split()]
+        found, rest = [], []
+        i = 0
+        while i < len(toks):
+            node, j, hit = self._root, i, None
+            while j < len(toks) and toks[j] in node:
+                node = node[toks[j]]
+                j += 1
+                if None in node:
+                    hit = (node[None], j)
+            if hit:
+                found.append(hit[0])
+                i = hit[1]
+            else:
+                rest.append(toks[i])
+                i += 1
+        return toks, found, rest
+
+    def match(self, text):
+        toks, found, _ = self.scan(text)
+        return toks, found
+
+
+def build_intent_matcher(services=SERVICES, groups=SERVICE_GROUPS):
+    m = IntentMatcher()
+    for w in HANDOFF_WORDS:
+        m.add(w, ("handoff", None))
+    for w in PRICE_WORDS:
+        m.add(w, ("price", None))
+    for key, grp in groups.items():
+        for w in grp["synonyms"]:
+            m.add(w, ("group", key))
+    for svc in services:
+        for w in svc["match"]:
+            m.add(w, ("service", svc["key"]))
+    for intent, phrases in INTENT_PHRASES.items():
+        for w in phrases:
+            m.add(w, ("info", intent))
+    for w in FAST_PATH_FILLERS:
+        m.add(w, ("filler", None))
+    return m
+
+
+def detect_topic(text: str):
+    """آخر خدمة/مجموعة انذكرت بالنص (للسياق والكاش)، حسب كتالوج العيادة الحالية."""
+    tenant = current_tenant()
+    _, found = tenant.intents.match(text)
+    for kind, value in reversed(found):
+        if kind == "service":
+            return tenant.services_by_key[value]["group"]
+        if kind == "group":
+            return value
+    return ""
+
+
+_CROWN_OFFER = ("zircon", "zircon_emax", "emax")
+
+def _with_note(text, note):
+    return f"{text}، {note} 🌹" if note else f"{text} 🌹"
+
+
+def _group_price_reply(group, services_by_key):
+    if group == "crown" and all(k in services_by_key for k in _CROWN_OFFER):
+        z, ze, e = (services_by_key[k] for k in _CROWN_OFFER)
+        return _with_note(
+            f"عدنا هسه عرض حصري على {z['name']} بـ {z['price']} للسن الواحد، "
+            f"و{ze['name']} {ze['price']} و{e['name']} {e['price']}",
+            z.get("note"),
+        )
+    return None
+
+
+def fast_path_reply(text: str):
+    """
+    يجاوب من الكتالوج مباشرة إذا الباتش سؤال واحد واضح (سعر خدمة محددة، الدوام، الموقع...).
+    أي شي ثاني (أكثر من نية، ترحيب، حجز، أرقام، سؤال طويل) يرجع None ويروح للموديل.
+    الكتالوج مال العيادة الحالية (current_tenant).
+    """
+    tenant = current_tenant()
+    clinic, by_key = tenant.clinic, tenant.services_by_key
+    toks, found, rest = tenant.intents.scan(text)
+    if not toks or len(toks) > FAST_PATH_MAX_WORDS or any(ch.isdigit() for ch in "".join(toks)):
+        return None
+    # كلمة ما يعرفها الكتالوج ممكن تغيّر السؤال ("بيش قلع ضرس العقل") → الموديل يقرر
+    if rest:
+        return None
+
+    kinds = {kind for kind, _ in found}
+    if "handoff" in kinds:
+        return None
+
+    infos = {v for k, v in found if k == "info"}
+    services = {v for k, v in found if k == "service"}
+    groups = {v for k, v in found if k == "group"}
+    # "تغليف زاركون" → الخدمة المحددة تغطي المجموعة مالتها
+    groups -= {by_key[k]["group"] for k in services}
+
+    if infos:
+        if len(infos) > 1 or services or groups or "price" in kinds:
+            return None
+        intent = infos.pop()
+        if intent == "hours":
+            return f"دوامنا {clinic['hours']} 🌹"
+        if intent == "location":
+            return f"موقعنا {clinic['location']} 📍"
+        if intent == "phone":
+            return f"تكدر تتصل بينا على {clinic['phone']} 🌹"
+        # معلومة اختيارية (مثلاً الأقساط): إذا العيادة ما محددتها، يجاوب الموديل
+        return clinic[intent] + " 🌹" if clinic.get(intent) else None
+
+    if "price" not in kinds or len(services) + len(groups) != 1:
+        return None
+
+    if services:
+        svc = by_key[services.pop()]
+        return _with_note(f"سعر {svc['name']} {svc['price']}", svc.get("note"))
+    return _group_price_reply(groups.pop(), by_key)
+
+# =======================================================
+# 🤖 Chat Engine (Ali)
+# =======================================================
+# الـ prompt الافتراضي (كولدن لاين). العيادات الثانية تجيب prompt خاص بيها بملف الـ tenants،
+# ويترسم بنفس الحقول: {catalog} {price_words} {discount_words} {crown_synonyms} {installments} {phone} {clinic_name}
+SYSTEM_PROMPT_TEMPLATE = """
 اسمك علي، موظف ومساعد طبي في عيادة كولدن لاين لطب الاسنان. 
 مهمتك: الرد على رسائل بلهجة عراقية عامة وبطريقة عفوية وودودة , باستخدام 'السياق السابق' لربط وفهم سياق المحادثة والاطلاع.
 ملاحظة مهمة :- يمكنك تجاوز القواعد بحدود واستعمال الذكاء الصناعي لفهم وترغيب واضافة المزيد من الطمئنينة للمراجع
@@ -263,43 +2178,19 @@ def ask_openai_chat(user_id, text):
 5. اقرأ سياق المحادثة فقط للفهم، وجاوب حصراً على السؤال الموجود بآخر رسالة، ولا تعيد أسعار أو معلومات ذُكرت سابقاً إلا إذا طُلبت صراحة.
 6. لا تقم بالترحيب إلا إذا العميل قام بالترحيب.
 7. تعامل كشخص عادي مو ريبوت وخليك انساني وراعي مشاعر المقابيلك بالجواب , ورد بطريقة محترمة , وحاول تكتسب المقابيلك بردود علمية حتى وان لم تكن موجودة بالتعليمات
-8. ( بيش , شكد , ابيش , السعر = يطلب سعر ))
-9. ( هواي , مابيها مجال , غالي , شدعوة , هله هلة بينة , ماعندي = يطلب تخفيض )
-10. نظام الاقساط متوفر على مصرف الرافدين تقسيط لمدة 10 اشهر بدون مقدمة
+8. ( {price_words} = يطلب سعر ))
+9. ( {discount_words} = يطلب تخفيض )
+10. {installments}
 11- إذا ما عندك معلومة دقيقة: ابلغ العميل بطريقة ودودة مثال "نحددها بعد المعاينة المجانية.
 إذا المراجع:
-12. اذا العميل عصبي أو يشتكي → اعتذر بلطف واطلب الاسم والرقم، وإذا استمر وجّهه للاتصال: 07728802820
+12. اذا العميل عصبي أو يشتكي → اعتذر بلطف واطلب الاسم والرقم، وإذا استمر وجّهه للاتصال: {phone}
 13. العميل يريد حجز → اطلب الاسم ويا يوم يناسبة للحجز ورقم الهاتف ، وقم بتثبيت الحجز للعميل 
 14. العميل يطلب تخفيض →ترد بطريقة ودودة وترغيبية مثل هاي اسعار عروض، والطبيب ميقصر وياكم ان شاء الله. ( يمكنك تغيير الاجابة لكل جواب حسب ما تراه مناسب هذا الجواب على سبيل المثال )
 15. الرد يقتصر فقط على جواب السؤال بدون اي اضافات حتى ميحس ان الجواب من الذكاء الصناعي ....
 *سياسة الإقناع:
 اربط السعر بطريقة ودودة بـ (مواد ألمانية + ضمان حقيقي على جودة العمل مدى الحياة). على سبيل المثال لا الحصر
 
-تفاصيل العيادة:
-الدوام: يومياً 4م–9م، الجمعة عطلة
-الموقع: بغداد / زيونة / شارع الربيعي الخدمي / داخل كراج مجمع اسطنبول
-الهاتف: 07728802820
-
-الأسعار:
-- تغليف الزاركون : 50 ألف
-- تغليف الزاركون ايماكس: 75 ألف
-- تغليف الايماكس : 125 ألف
-- حشوة تجميلية: 35 ألف
-- حشوة جذر: 125 ألف
-- قلع: 25 ألف
-- تنظيف: 25 ألف
-- تبييض ليزر: 75 ألف
-- تقويم: 450 ألف للفك
-- فك كامل زرعات فورية: مليون وربع
-- فكين كامل زرعات فورية: مليونين ونص
-- ابتسامة زاركون 20 سن: مليون دينار
-- ابتسامة زاركون ايماكس 20 سن: مليون و 500 الف دينار
-- ابتسامة الايماكس 20 سن: مليونين و 500 الف دينار
-- الزراعة التقليدية: السن الواحد 350 الف الكوري و 450 الف الالماني
-- الزراعة الفورية: السن الواحد 200 التركي , 275 الالماني.
-- (عروض الزراعة للفك الواحد مليون وربع للفكين مليونين ونص )
-- تغليف فك زاركون 14 سن 700 الف دينار , فكين 28 سن مليون و 400 (ممكن يكون السؤال ابتسامة لفك واحد )
-- سعر الفك المتحرك او الاسنان المتحركة للفك الواحد 450 الف اما اذا اسنان فردية يحدد بعد المعاينة
+{catalog}
 
 اذا العميل كال ( مثال , عندي سنين زراعة و 8 تغليفات , تجمع اله سعر زرعتين 500 والتغليف 600 وهكذا  حسب طلب العميل ) 
 
@@ -323,7 +2214,7 @@ def ask_openai_chat(user_id, text):
 
 -ملاحظة مهمة افهم صياغ الجملة جيدا وافهمها وقم بالاتزام بالمواضيع اذا سال بموضوع لا تجاوب بموضوع ثاني الا اذا هو من قام بطلب ذلك
 
-- تركيب , تغليف , تقبيق , قبق ,قالب = تغليف
+- {crown_synonyms} = تغليف
 
 - في بعض الاحيان العميل يسال بخصوص تغيلف الاسنان هل الاسنان منفصلة ( يقصد ان التغليف متصل او كل سن على  حدى ) وبصيغ مختلفة الجواب يكون ممكن تكون منفصلة وممكن متصلة حسب الحالة ورغبة المراجع
 
@@ -337,79 +2228,1035 @@ def ask_openai_chat(user_id, text):
 
 """
 
+
+# بس الحقول المعروفة تنبدل؛ أي { أو } ثاني بـ prompt العيادة (مثلاً مثال JSON) يبقى مثل ما هو
+_PROMPT_FIELD = re.compile(r"\{(\w+)\}")
+
+def render_prompt(template, clinic=CLINIC_INFO, services=SERVICES, groups=SERVICE_GROUPS):
+    fields = {
+        "catalog": catalog_prompt_section(clinic, services),
+        "price_words": " , ".join(PRICE_WORDS),
+        "discount_words": " , ".join(DISCOUNT_WORDS),
+        "crown_synonyms": " , ".join((groups.get("crown") or {}).get("synonyms") or []),
+        "installments": clinic.get("installments", ""),
+        "phone": clinic["phone"],
+        "clinic_name": clinic.get("name", ""),
+    }
+    return _PROMPT_FIELD.sub(lambda m: fields.get(m.group(1), m.group(0)), template)
+
+# =======================================================
+# 🏥 Tenants (كم صفحة/عيادة ببروسس واحد)
+# =======================================================
+# بدون TENANTS_FILE: صفحة وحدة من الـ env (PAGE_ACCESS_TOKEN، CALLMEBOT_USER) بالكتالوج والـ prompt اللي فوك.
+# وياه: كل webhook entry يروح للعيادة حسب الـ page id مالته، وصفحة مو بالملف تنرفض (شوف tenants.example.json).
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+TENANT_MODEL_SHARE = float(os.getenv("TENANT_MODEL_SHARE", "0.5"))   # حصة العيادة الافتراضية من OPENAI_CONCURRENCY
+
+
+class Tenant:
+    """
+    عيادة (صفحة فيسبوك) وحدة: التوكن، الكتالوج، الـ prompt، هدف إشعارات الحجز وحصتها من الموديل.
+    كل شي يتحضر مرة وحدة هنا بالتشغيل (الـ prompt مرسوم، بصمته للكاش، أرقامه، الـ intent trie)،
+    فمسار الرد ما يبني ولا شي. الـ HTTP pool والـ workers مشتركين بين كل العيادات.
+    """
+
+    def __init__(self, page_id, name, token, *, clinic=CLINIC_INFO, services=SERVICES, groups=SERVICE_GROUPS,
+                 prompt_template=SYSTEM_PROMPT_TEMPLATE, callmebot_user=CALLMEBOT_USER,
+                 model_concurrency=OPENAI_CONCURRENCY):
+        self.page_id = page_id
+        self.name = name
+        self.token = token
+        self.clinic = clinic
+        self.services = services
+        self.groups = groups
+        self.callmebot_user = callmebot_user
+        self.model_concurrency = max(1, int(model_concurrency))
+        self.services_by_key = {svc["key"]: svc for svc in services}
+        self.intents = build_intent_matcher(services, groups)
+        self.prompt = render_prompt(prompt_template, clinic, services, groups)
+        self.prompt_digest = AnswerCache.prompt_digest(self.prompt)
+        # الأرقام المسموح للموديل يذكرها: اللي بالـ prompt (أسعار، دوام، هاتف) + اللي كتبها المراجع
+        self.prompt_numbers = _numbers(self.prompt)
+
+
+class TenantRegistry:
+    def __init__(self, tenants, strict):
+        self.tenants = tenants
+        self.by_page = {t.page_id: t for t in tenants}
+        self.default = tenants[0]
+        self.strict = strict     # من ملف: صفحة مو معروفة = None
+
+    def for_page(self, page_id):
+        """العيادة مال webhook entry (None إذا الصفحة مو بالملف)."""
+        tenant = self.by_page.get(str(page_id)) if page_id is not None else None
+        if tenant is None and not self.strict:
+            return self.default
+        return tenant
+
+    def get(self, page_id):
+        """مثل for_page بس للجلسات والـ leads المخزونة: صفحة ما معروفة (قديمة) → الافتراضية."""
+        return self.by_page.get(page_id) or self.default
+
+
+def load_tenants(path):
+    """
+    {"pages": [{"page_id": "...", "name": "...", "access_token_env": "...", "callmebot_user": "...",
+                "prompt_file": "...", "clinic": {...}, "services": [...], "service_groups": {...},
+                "model_concurrency": 4}, ...]}
+    access_token مباشرة أو access_token_env (اسم متغير env)، و prompt_file نسبةً لمكان الملف (أو prompt نص).
+    الحقول الناقصة تاخذ الافتراضي (كتالوج وprompt كولدن لاين).
+    """
+    with open(path, encoding="utf-8") as f:
+        conf = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    pages = conf.get("pages") or []
+    if not pages:
+        raise ValueError(f"{path}: no pages")
+    quota = max(1, round(OPENAI_CONCURRENCY * TENANT_MODEL_SHARE)) if len(pages) > 1 else OPENAI_CONCURRENCY
+    tenants = []
+    for page in pages:
+        page_id = str(page["page_id"])
+        missing = [k for k in ("hours", "location", "phone") if page.get("clinic") and not page["clinic"].get(k)]
+        if missing:
+            raise ValueError(f"{path}: page {page_id} clinic is missing {', '.join(missing)}")
+        template = page.get("prompt") or SYSTEM_PROMPT_TEMPLATE
+        if page.get("prompt_file"):
+            with open(os.path.join(base, page["prompt_file"]), encoding="utf-8") as f:
+                template = f.read()
+        token = page.get("access_token") or os.getenv(page.get("access_token_env") or "")
+        if not token:
+            log(f"tenant {page_id}: no access token, replies will not be sent")
+        tenants.append(Tenant(
+            page_id, page.get("name") or page_id, token,
+            clinic=page.get("clinic") or CLINIC_INFO,
+            services=page.get("services") or SERVICES,
+            groups=page.get("service_groups") or SERVICE_GROUPS,
+            prompt_template=template,
+            callmebot_user=page.get("callmebot_user") or CALLMEBOT_USER,
+            model_concurrency=page.get("model_concurrency") or quota,
+        ))
+    if len({t.page_id for t in tenants}) != len(tenants):
+        raise ValueError(f"{path}: duplicate page_id")
+    return TenantRegistry(tenants, strict=True)
+
+
+def make_tenants(path):
+    if path:
+        return load_tenants(path)
+    return TenantRegistry([Tenant(None, "default", PAGE_ACCESS_TOKEN)], strict=False)
+
+TENANTS = make_tenants(TENANTS_FILE)
+
+_TENANT = contextvars.ContextVar("tenant", default=None)
+
+def current_tenant():
+    return _TENANT.get() or TENANTS.default
+
+@contextmanager
+def use_tenant(tenant):
+    """العيادة الحالية (الكتالوج، الـ prompt، الحصة) لكل اللي يصير داخل الـ with."""
+    token = _TENANT.set(tenant)
     try:
-        rsp = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "system", "content": f"السياق السابق للمحادثة:\n{context}"},
-                {"role": "user", "content": f"الرسالة الجديدة المطلوب الرد عليها الآن: {text}"}
-            ],
-            temperature=0.3,
-            timeout=REQUEST_TIMEOUT
-        )
-        out = rsp.choices[0].message.content.strip()
-        if not out:
-            return "ممكن توضحلي شنو تقصد حتى أخدمك 🌹"
+        yield tenant
+    finally:
+        _TENANT.reset(token)
+
+def tenant_of(user_id):
+    """عيادة المراجع من جلسته (PSID مال فيسبوك خاص بالصفحة، فالمراجع إله عيادة وحدة)."""
+    return TENANTS.get((get_session(user_id) or {}).get("page"))
+
+# =======================================================
+# 🔌 OpenAI Calls
+# =======================================================
+
+OPENAI_MODEL = "gpt-4o"
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "1") == "1"
+OPENAI_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "180"))   # 40 كلمة عراقي ≈ 120 token + هامش
+REPLY_WORD_BUDGET = 45      # القاعدة 4 بالـ prompt = 40 كلمة، ونقص أي شي يعبر هذا
+
+_SENTENCE_END = re.compile(r"[.!؟?\n…🌹♥❤]")
+
+def trim_to_sentence(text: str, words: int = REPLY_WORD_BUDGET):
+    """
+    يقص الرد لحد آخر نهاية جملة ضمن ميزانية الكلمات. إذا ماكو نهاية جملة (رد كله فوارز)
+    يرجع النص مقصوص على الميزانية، حتى ما يصير رد fallback أو تصعيد على الفاضي.
+    """
+    toks = text.split()
+    if len(toks) > words:
+        text = " ".join(toks[:words])
+    ends = [m.end() for m in _SENTENCE_END.finditer(text)]
+    return text[:ends[-1]].strip() if ends else text.strip()
+
+
+class LLMStats:
+    """زمن أول token وزمن التوليد الكامل لكل call، وكم مرة قصّينا أو خلص الوقت."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.ttft_sum = 0.0
+        self.ttft_max = 0.0
+        self.total_sum = 0.0
+        self.total_max = 0.0
+        self.cutoffs = 0
+        self.timeouts = 0
+
+    def record(self, ttft, total, cut=False, timed_out=False):
+        with self._lock:
+            self.calls += 1
+            self.ttft_sum += ttft or total
+            self.ttft_max = max(self.ttft_max, ttft or total)
+            self.total_sum += total
+            self.total_max = max(self.total_max, total)
+            self.cutoffs += int(cut)
+            self.timeouts += int(timed_out)
+
+    def stats(self):
+        with self._lock:
+            n = self.calls or 1
+            return {
+                "calls": self.calls,
+                "ttft_avg": round(self.ttft_sum / n, 3),
+                "ttft_max": round(self.ttft_max, 3),
+                "total_avg": round(self.total_sum / n, 3),
+                "total_max": round(self.total_max, 3),
+                "cutoffs": self.cutoffs,
+                "timeouts": self.timeouts,
+            }
+
+
+LLM_STATS = LLMStats()
+
+def fill_usage(usage, reported, messages, out):
+    # OpenAI يرجع usage بآخر chunk؛ إذا قطعنا الـ stream قبله (أو الـ API ما رجعه) نقدّر
+    if usage is None:
+        return
+    if reported is not None:
+        usage["prompt_tokens"] = reported.prompt_tokens
+        usage["completion_tokens"] = reported.completion_tokens
+    else:
+        usage["prompt_tokens"] = sum(estimate_tokens(m["content"]) for m in messages)
+        usage["completion_tokens"] = estimate_tokens(out) if out else 0
+
+def completion_args(model, messages, timeout, stream=OPENAI_STREAM):
+    args = dict(model=model, messages=messages, temperature=0.3, max_tokens=OPENAI_MAX_TOKENS, timeout=timeout)
+    if stream:
+        args.update(stream=True, stream_options={"include_usage": True})
+    return args
+
+
+def plain_reply(rsp, messages, usage, t0):
+    """رد OpenAI بدون streaming → نص الرد (مع الـ stats والـ usage)."""
+    LLM_STATS.record(None, time.monotonic() - t0)
+    METRICS.observe("stage_seconds", time.monotonic() - t0, stage="model")
+    out = rsp.choices[0].message.content or ""
+    fill_usage(usage, rsp.usage, messages, out)
+    return out
+
+
+class ReplyStream:
+    """
+    يجمع chunks الـ stream ويقرر وين نوكف القراءة (ميزانية الكلمات أو الوقت).
+    ما يقرا من الشبكة بنفسه، فنفس القواعد تمشي على الـ client العادي و AsyncOpenAI.
+    """
+
+    def __init__(self, messages, timeout, usage=None):
+        self.messages = messages
+        self.timeout = timeout
+        self.usage = usage
+        self.t0 = time.monotonic()
+        self.parts = []
+        self.ttft = None
+        self.cut = self.timed_out = self.finished = False
+        self.reported = None
+
+    def feed(self, chunk):
+        """يرجع True إذا لازم نوكف القراءة هنا."""
+        if getattr(chunk, "usage", None):
+            self.reported = chunk.usage
+        if not chunk.choices or self.finished:
+            return False
+        choice = chunk.choices[0]
+        delta = choice.delta.content or ""
+        if delta:
+            if self.ttft is None:
+                self.ttft = time.monotonic() - self.t0
+            self.parts.append(delta)
+        if choice.finish_reason:
+            # نكمل القراءة بس حتى ناخذ chunk الـ usage اللي يجي بعده مباشرة
+            self.finished = True
+            return False
+        if len("".join(self.parts).split()) > REPLY_WORD_BUDGET:
+            self.cut = True
+            return True
+        if time.monotonic() - self.t0 > self.timeout:
+            self.timed_out = True
+            return True
+        return False
+
+    def result(self):
+        out = "".join(self.parts)
+        if self.cut or self.timed_out:
+            out = trim_to_sentence(out)
+        fill_usage(self.usage, self.reported, self.messages, out)
+        elapsed = time.monotonic() - self.t0
+        LLM_STATS.record(self.ttft, elapsed, cut=self.cut, timed_out=self.timed_out)
+        METRICS.observe("stage_seconds", elapsed, stage="model")
+        if self.ttft is not None:
+            METRICS.observe("openai_ttft_seconds", self.ttft)
+        if self.timed_out and not out:
+            raise TimeoutError("OpenAI stream timed out")
         return out
+
+
+def complete_chat(messages, *, model=OPENAI_MODEL, timeout=REQUEST_TIMEOUT, usage=None):
+    """
+    ينادي OpenAI ويرجع نص الرد.
+    بوضع الـ streaming نقرا الـ tokens أول بأول: نوقف الـ stream أول ما يعبر
+    REPLY_WORD_BUDGET كلمة أو يخلص الوقت، ونقص الرد على آخر جملة كاملة.
+    إذا انطى usage (dict) نعبيه بـ prompt_tokens و completion_tokens.
+    """
+    if not OPENAI_STREAM:
+        t0 = time.monotonic()
+        return plain_reply(client.chat.completions.create(**completion_args(model, messages, timeout)), messages, usage, t0)
+
+    reader = ReplyStream(messages, timeout, usage)
+    stream = client.chat.completions.create(**completion_args(model, messages, timeout))
+    try:
+        for chunk in stream:
+            if reader.feed(chunk):
+                break
+    finally:
+        stream.close()
+    return reader.result()
+
+
+# رد جاهز لمن OpenAI واكف (breaker) أو طابور الموديل مليان
+BUSY_REPLY = "هلا بيك 🌹 عدنا ضغط رسائل هسه، اترك اسمك ورقم هاتفك ونتواصل وياك بأقرب وقت"
+
+@contextmanager
+def openai_errors():
+    """أخطاء OpenAI المؤقتة (اتصال، timeout، 429، 5xx) → RetryableError حتى resilient_call يعيد."""
+    try:
+        yield
+    except (APIConnectionError, TimeoutError) as e:
+        raise RetryableError(str(e)) from e
+    except APIStatusError as e:
+        if e.status_code == 429 or e.status_code >= 500:
+            raise RetryableError(str(e), retry_after_seconds(e.response.headers.get("retry-after"))) from e
+        raise
+
+def _openai_attempt(messages, remaining, model=OPENAI_MODEL, usage=None):
+    """محاولة وحدة لـ resilient_call: الفشل المؤقت يصير RetryableError."""
+    with openai_errors():
+        return complete_chat(messages, model=model, timeout=min(REQUEST_TIMEOUT, remaining), usage=usage)
+
+
+class Overloaded(Exception):
+    """طابور الموديل مليان أو انتظارنا بيه خلص ميزانية الرد."""
+
+
+class ModelExecutor:
+    """
+    pool محدود (OPENAI_CONCURRENCY) لكل calls الموديل، بطابور عادل بين المستخدمين:
+    - كل مستخدم إله طابور FIFO، والمستخدمين يتناوبون (round robin)، فمراجع يرسل
+      هواي رسائل ما يأخر غيره
+    - مستخدم واحد ما يصير إله أكثر من call بالطريق، فردوده تطلع بالترتيب
+    - إذا الطابور عبر OPENAI_QUEUE_MAX، أو call انتظر لحد ما خلصت ميزانية الرد، نرمي
+      Overloaded والرد يصير BUSY_REPLY بدل ما الكل ينتظر ويوصل rate limit
+    - كل عيادة ما تاخذ أكثر من model_concurrency مالتها من الـ workers، فصفحة عليها
+      ضغط ما توكف ردود الصفحات الثانية (مستخدمها ينتظر ودوره يروح للي بعده)
+    """
+
+    class _Item:
+        __slots__ = ("future", "fn", "args", "queued_at", "trace", "deadline", "tenant")
+
+        def __init__(self, fn, args):
+            self.future = Future()
+            self.fn = fn
+            self.args = args
+            self.queued_at = time.monotonic()
+            self.trace = current_trace()
+            self.deadline = _DEADLINE.get()
+            self.tenant = current_tenant()
+
+    def __init__(self, workers=OPENAI_CONCURRENCY, max_queue=OPENAI_QUEUE_MAX):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queues = {}          # user_id -> deque[_Item]
+        self._ready = deque()      # مستخدمين عندهم شي بالطابور وماكو إلهم call بالطريق (بالدور)
+        self._busy = set()
+        self._tenant_busy = Counter()   # tenant -> calls بالطريق
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self.submitted = 0
+        self.shed = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.started_calls = 0
+
+    def start(self):
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, user_id, fn, *args):
+        item = self._Item(fn, args)
+        with self._cond:
+            if self._queued >= self.max_queue:
+                self.shed += 1
+                METRICS.inc("model_shed_total", reason="backlog")
+                raise Overloaded(f"model queue full ({self._queued})")
+            q = self._queues.setdefault(user_id, deque())
+            q.append(item)
+            self._queued += 1
+            self.submitted += 1
+            if len(q) == 1 and user_id not in self._busy:
+                self._ready.append(user_id)
+                self._cond.notify()
+        return item.future
+
+    def call(self, user_id, fn, *args):
+        """submit + ينتظر النتيجة ضمن ميزانية الرد."""
+        future = self.submit(user_id, fn, *args)
+        try:
+            return future.result(timeout=max(0.1, call_deadline(CALL_BUDGET) - time.monotonic()))
+        except FutureTimeout:
+            if future.cancel():
+                with self._cond:
+                    self.shed += 1
+                METRICS.inc("model_shed_total", reason="deadline")
+                raise Overloaded("model queue wait exceeded the reply budget") from None
+            # بدا قبل شوية → resilient_call نفسه محدود بالـ deadline
+            return future.result()
+
+    def _pick(self):
+        """أول مستخدم بالدور عيادته بعدها تحت حصتها (None إذا كلهم واكفين)."""
+        for i, user_id in enumerate(self._ready):
+            tenant = self._queues[user_id][0].tenant
+            if self._tenant_busy[tenant] < tenant.model_concurrency:
+                del self._ready[i]
+                return user_id
+        return None
+
+    def _next(self):
+        with self._cond:
+            while (user_id := self._pick()) is None:
+                self._cond.wait()
+            q = self._queues[user_id]
+            item = q.popleft()
+            self._queued -= 1
+            if not q:
+                del self._queues[user_id]
+            self._busy.add(user_id)
+            self._tenant_busy[item.tenant] += 1
+            return user_id, item
+
+    def _done(self, user_id, item):
+        with self._cond:
+            self._busy.discard(user_id)
+            self._tenant_busy[item.tenant] -= 1
+            if user_id in self._queues:
+                # يرجع لآخر الدور حتى غيره ياخذ فرصته
+                self._ready.append(user_id)
+            # مكان فرغ بحصة العيادة: worker واكف على مستخدميها يكدر يكمل
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            user_id, item = self._next()
+            try:
+                if not item.future.set_running_or_notify_cancel():
+                    continue
+                now = time.monotonic()
+                waited = now - item.queued_at
+                METRICS.observe("stage_seconds", waited, stage="model_queue")
+                with self._cond:
+                    self.started_calls += 1
+                    self.wait_sum += waited
+                    self.wait_max = max(self.wait_max, waited)
+                if item.deadline is not None and item.deadline - now <= 0.05:
+                    with self._cond:
+                        self.shed += 1
+                    METRICS.inc("model_shed_total", reason="deadline")
+                    item.future.set_exception(Overloaded("reply budget spent while queued"))
+                    continue
+                set_trace(item.trace)
+                budget = item.deadline - now if item.deadline is not None else CALL_BUDGET
+                try:
+                    with deadline_budget(budget), use_tenant(item.tenant):
+                        item.future.set_result(item.fn(*item.args))
+                except BaseException as e:
+                    item.future.set_exception(e)
+            finally:
+                self._done(user_id, item)
+
+    def depth(self):
+        with self._cond:
+            return self._queued
+
+    def inflight(self):
+        with self._cond:
+            return len(self._busy)
+
+    def tenant_inflight(self, tenant):
+        with self._cond:
+            return self._tenant_busy[tenant]
+
+    def stats(self):
+        with self._cond:
+            n = self.started_calls or 1
+            return {
+                "queued": self._queued,
+                "inflight": len(self._busy),
+                "submitted": self.submitted,
+                "shed": self.shed,
+                "wait_avg": round(self.wait_sum / n, 3),
+                "wait_max": round(self.wait_max, 3),
+            }
+
+
+MODEL_EXECUTOR = ModelExecutor()
+if THREADED:
+    MODEL_EXECUTOR.start()
+
+# =======================================================
+# 🧭 Model Routing (موديل سريع أول، gpt-4o بس لمن نحتاجه)
+# =======================================================
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "1") == "1"
+MODEL_TIERS = {
+    "fast": os.getenv("MODEL_FAST", "gpt-4o-mini"),
+    "strong": os.getenv("MODEL_STRONG", OPENAI_MODEL),
+}
+ROUTE_FAST_MAX_WORDS = int(os.getenv("ROUTE_FAST_MAX_WORDS", "20"))   # باتش أطول = حالة مفصلة
+ROUTE_FAST_MAX_TURNS = int(os.getenv("ROUTE_FAST_MAX_TURNS", "8"))    # محادثة أطول = بيها تفاصيل لازم تنذكر
+ROUTE_FAST_MAX_TOPICS = 2      # أكثر من موضوعين بنفس الباتش → strong
+
+# شكوى/تخفيض/حالة مرضية وحجز: هاي المحادثات اللي تنخسر إذا الرد ضعيف
+COMPLAINT_WORDS = DISCOUNT_WORDS + [
+    "وجع", "الم", "يوجعني", "مشكله", "زعلان", "ليش", "خايف", "التهاب", "ورم", "نزف", "غلط", "ماعجبني",
+]
+BOOKING_WORDS = ["حجز", "احجز", "موعد", "اسمي", "اجيكم", "باجر"]
+# رد بيه تردد أو اعتذار = الموديل الصغير ما عرف يجاوب
+UNSURE_MARKERS = [
+    "ما اعرف", "لا اعرف", "مو متاكد", "ما متاكد", "لا استطيع", "ما اكدر اجاوب",
+    "as an ai", "i'm sorry", "i cannot", "i can't",
+]
+_UNSURE = [normalize_arabic(m) for m in UNSURE_MARKERS]
+_ARABIC_RE = re.compile("[\u0621-\u064a]")
+
+
+def build_route_matcher():
+    m = IntentMatcher()
+    for w in COMPLAINT_WORDS:
+        m.add(w, ("complaint", None))
+    for w in BOOKING_WORDS:
+        m.add(w, ("booking", None))
+    return m
+
+
+ROUTE_SIGNALS = build_route_matcher()
+
+def route_batch(user_id, text):
+    """يختار tier للباتش ويرجع (tier, السبب). أي إشارة لحالة حساسة أو معقدة → strong."""
+    if not MODEL_ROUTING:
+        return "strong", "disabled"
+    toks, found = ROUTE_SIGNALS.match(text)
+    kinds = {kind for kind, _ in found}
+    if "complaint" in kinds:
+        return "strong", "complaint"
+    if "booking" in kinds or extract_iraqi_phone(text):
+        return "strong", "booking"
+    if len(toks) > ROUTE_FAST_MAX_WORDS:
+        return "strong", "long"
+    st = get_session(user_id) or {}
+    if len(st.get("history") or ()) + st.get("summary_turns", 0) > ROUTE_FAST_MAX_TURNS:
+        return "strong", "history"
+    _, intents = current_tenant().intents.match(text)
+    if len({value for kind, value in intents if kind in ("service", "group", "info")}) > ROUTE_FAST_MAX_TOPICS:
+        return "strong", "multi_intent"
+    return "fast", "simple"
+
+
+def validate_reply(reply, messages):
+    """يرجع سبب رفض رد الموديل السريع (حتى نصعّد لـ strong) أو None إذا الرد زين."""
+    norm = normalize_arabic(reply)
+    if not norm:
+        return "empty"
+    if not _ARABIC_RE.search(reply):
+        return "language"
+    padded = f" {norm} "
+    if any(f" {m} " in padded for m in _UNSURE):
+        return "unsure"
+    # رقم ما موجود بالكتالوج ولا بكلام المراجع = سعر أو موعد مألّف
+    said = set().union(*(_numbers(m["content"]) for m in messages[1:]))
+    if _numbers(reply) - current_tenant().prompt_numbers - said:
+        return "unknown_number"
+    return None
+
+
+class ModelRouter:
+    """زمن و tokens كل tier ونسبة التصعيد، حتى نضبط عتبات route_batch من /stats."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tiers = {
+            tier: {"calls": 0, "errors": 0, "seconds_sum": 0.0, "seconds_max": 0.0,
+                   "prompt_tokens": 0, "completion_tokens": 0}
+            for tier in MODEL_TIERS
+        }
+        self.routed = {}         # "tier:reason" → عدد
+        self.escalations = {}    # سبب → عدد
+
+    def record_route(self, tier, reason):
+        with self._lock:
+            key = f"{tier}:{reason}"
+            self.routed[key] = self.routed.get(key, 0) + 1
+        METRICS.inc("model_routes_total", tier=tier, reason=reason)
+
+    def record_call(self, tier, seconds, usage, ok=True):
+        with self._lock:
+            t = self.tiers[tier]
+            t["calls"] += 1
+            t["errors"] += int(not ok)
+            t["seconds_sum"] += seconds
+            t["seconds_max"] = max(t["seconds_max"], seconds)
+            t["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            t["completion_tokens"] += usage.get("completion_tokens", 0)
+        METRICS.observe("model_tier_seconds", seconds, tier=tier)
+        for kind in ("prompt", "completion"):
+            METRICS.inc("model_tokens_total", usage.get(f"{kind}_tokens", 0), tier=tier, kind=kind)
+
+    def record_escalation(self, reason):
+        with self._lock:
+            self.escalations[reason] = self.escalations.get(reason, 0) + 1
+        METRICS.inc("model_escalations_total", reason=reason)
+
+    @contextmanager
+    def recording(self, tier, usage):
+        """يسجل زمن و tokens call واحد على tier (ناجح أو فاشل)."""
+        t0 = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.record_call(tier, time.monotonic() - t0, usage, ok=False)
+            raise
+        self.record_call(tier, time.monotonic() - t0, usage)
+
+    def choose(self, user_id, text):
+        tier, reason = route_batch(user_id, text)
+        self.record_route(tier, reason)
+        return tier
+
+    def accepts(self, user_id, out, messages, error=None):
+        """رد الموديل السريع يمشي؟ إذا لا نسجل سبب التصعيد لـ strong."""
+        if error is not None:
+            why = "error"
+            log("fast model failed, escalating:", error)
+        else:
+            why = validate_reply(out, messages)
+            if why is None:
+                return True
+        self.record_escalation(why)
+        log(f"escalating user={user_id} reason={why}")
+        return False
+
+    def call(self, tier, messages):
+        usage = {}
+        with self.recording(tier, usage):
+            out = resilient_call(
+                "openai", lambda remaining: _openai_attempt(messages, remaining, model=MODEL_TIERS[tier], usage=usage)
+            )
+        return out.strip()
+
+    def complete(self, user_id, text, messages):
+        """
+        يجاوب الباتش بالـ tier المناسب. رد الموديل السريع يتفحص (validate_reply)،
+        وإذا فشل الفحص أو الـ call نفسه، نعيد مرة وحدة على strong ضمن نفس ميزانية الرد.
+        """
+        if self.choose(user_id, text) == "strong":
+            return self.call("strong", messages)
+        try:
+            out, error = self.call("fast", messages), None
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            out, error = "", e
+        if self.accepts(user_id, out, messages, error):
+            return out
+        return self.call("strong", messages)
+
+    def stats(self):
+        with self._lock:
+            out = {}
+            for tier, t in self.tiers.items():
+                n = t["calls"] or 1
+                out[tier] = {
+                    "model": MODEL_TIERS[tier],
+                    "calls": t["calls"],
+                    "errors": t["errors"],
+                    "latency_avg": round(t["seconds_sum"] / n, 3),
+                    "latency_max": round(t["seconds_max"], 3),
+                    "prompt_tokens": t["prompt_tokens"],
+                    "completion_tokens": t["completion_tokens"],
+                }
+            fast_routes = sum(v for k, v in self.routed.items() if k.startswith("fast:"))
+            escalated = sum(self.escalations.values())
+            out["routed"] = dict(self.routed)
+            out["escalations"] = dict(self.escalations)
+            out["escalation_rate"] = round(escalated / fast_routes, 3) if fast_routes else 0.0
+            return out
+
+
+ROUTER = ModelRouter()
+
+
+def chat_messages(user_id, text):
+    context = format_context(user_id)
+
+    # prompt العيادة ثابت ودايماً أول رسالة، حتى الـ prompt caching مال OpenAI
+    # يلكى نفس الـ prefix بكل call؛ الأجزاء المتغيرة (السياق والرسالة) بعده
+    return [
+        {"role": "system", "content": current_tenant().prompt},
+        {"role": "system", "content": f"السياق السابق للمحادثة:\n{context}"},
+        {"role": "user", "content": f"الرسالة الجديدة المطلوب الرد عليها الآن: {text}"}
+    ]
+
+def prepare_answer(user_id, text):
+    """
+    كل اللي يسبق call الموديل: يرجع (cache_key, الجواب من الكاش أو None, messages).
+    messages تكون None إذا الكاش جاوب.
+    """
+    ensure_session(user_id)
+
+    # ✅ سؤال متكرر (بيش التغليف، وين مكانكم...) → جواب من الكاش بدون OpenAI
+    cache_key = AnswerCache.make_key(current_tenant().prompt_digest, text, context_signature(user_id))
+    cached = ANSWER_CACHE.get(cache_key)
+    if cached and cached != last_reply_of(user_id):
+        METRICS.inc("answers_total", source="cache")
+        return cache_key, cached, None
+    return cache_key, None, chat_messages(user_id, text)
+
+def model_answer(cache_key, out):
+    if not out:
+        METRICS.inc("answers_total", source="fallback")
+        return "ممكن توضحلي شنو تقصد حتى أخدمك 🌹"
+    ANSWER_CACHE.put(cache_key, out)
+    METRICS.inc("answers_total", source="openai")
+    return out
+
+def failed_answer(err):
+    """الرد اللي يطلع للمراجع لمن call الموديل يفشل."""
+    if isinstance(err, CircuitOpenError):
+        # OpenAI واكف → رد جاهز فوراً بدل ما كل محادثة تنتظر timeout
+        METRICS.inc("answers_total", source="breaker")
+        return BUSY_REPLY
+    if isinstance(err, Overloaded):
+        METRICS.inc("answers_total", source="shed")
+        return BUSY_REPLY
+    METRICS.inc("answers_total", source="fallback")
+    log("OpenAI error:", err)
+    return "صار خلل بسيط، عاود رسالتك ♥"
+
+def ask_openai_chat(user_id, text):
+    cache_key, cached, messages = prepare_answer(user_id, text)
+    if cached:
+        return cached
+    try:
+        out = MODEL_EXECUTOR.call(user_id, ROUTER.complete, user_id, text, messages)
     except Exception as e:
-        print("OpenAI error:", e)
-        return "صار خلل بسيط، عاود رسالتك ♥"
+        return failed_answer(e)
+    return model_answer(cache_key, out)
 
 # =======================================================
-# 🧠 Chat Delay Reply (منع الردّ المزدوج)
+# ⏱️ Reply Scheduler (تايمر واحد لكل البروسس)
 # =======================================================
-def schedule_reply(user_id, version_snapshot):
-    time.sleep(BUFFER_DELAY)
+class ReplyScheduler:
+    """
+    تايمر واحد (heap) يمسك مواعيد الـ debounce لكل المستخدمين
+    بدل ما نفتح thread نايم لكل رسالة.
+    كل key (مثلاً ("reply", user_id)) إله موعد واحد فعّال، وأي رسالة جديدة
+    تأجّل نفس الموعد بدل ما تضيف تايمر جديد.
+    المواعيد اللي تخلص تنطي لـ pool محدود من الـ workers.
+    """
 
-    st = SESSIONS.get(user_id)
-    if not st:
-        return
+    def __init__(self, workers=REPLY_WORKERS):
+        self._heap = []              # (deadline, seq, key)
+        self._due = {}               # key -> (seq, fn, args)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reply")
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def schedule(self, key, delay, fn, *args):
+        """يسجل (أو يأجّل) موعد الـ key بعد delay ثانية."""
+        deadline = time.monotonic() + delay
+        with self._cond:
+            seq = next(self._seq)
+            self._due[key] = (seq, fn, args)
+            heapq.heappush(self._heap, (deadline, seq, key))
+
+            # الـ entries القديمة تبقى بالـ heap لحد ما توصل؛ إذا كثرت نضغطها
+            if len(self._heap) > 2 * len(self._due) + 64:
+                self._compact()
+
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._due.pop(key, None)
+
+    def scheduled(self, key):
+        with self._cond:
+            return key in self._due
+
+    def pending(self):
+        with self._cond:
+            return len(self._due)
+
+    def _compact(self):
+        self._heap = [e for e in self._heap if self._due.get(e[2], (None,))[0] == e[1]]
+        heapq.heapify(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    deadline, seq, key = self._heap[0]
+                    wait = deadline - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    heapq.heappop(self._heap)
+                    cur = self._due.get(key)
+                    # موعد انعاد جدولته (رسالة أحدث) → نتجاهل القديم
+                    if not cur or cur[0] != seq:
+                        continue
+                    del self._due[key]
+                    break
+            _, fn, args = cur
+            self._pool.submit(self._fire, fn, args)
 
-    # إذا وصلت رسالة أحدث، نلغي هذا الرد
-    if st.get("msg_version") != version_snapshot:
-        return
+    @staticmethod
+    def _fire(fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            log("Scheduler job error:", e)
 
-    now = time.time()
-    # إذا لسه آخر رسالة ضمن فترة التجميع، لا ترد
-    if now - st.get("last_message_time", 0) < BUFFER_DELAY:
-        return
 
-    # اسحب الدفعة المتجمعة كنص واحد
-    batch_text = drain_pending_batch(user_id)
-    if not batch_text:
-        return
+REPLY_SCHEDULER = ReplyScheduler()
+if THREADED:
+    REPLY_SCHEDULER.start()
 
-    # ✅ إذا typing بعده ما اشتغل (مثلاً المستخدم كتب رسالة وحدة وردّنا بسرعة)
-    # شغله هسه قبل ما ننادي OpenAI
-    if not st.get("is_typing"):
-        send_typing(user_id)
-        st["is_typing"] = True
+# =======================================================
+# ⏳ Debounce Policy (شكد ننتظر قبل الرد)
+# =======================================================
+class FixedDebounce:
+    """السلوك القديم: ننتظر BUFFER_DELAY بعد آخر رسالة دايماً."""
+    name = "fixed"
+
+    def delay(self, st, text):
+        return BUFFER_DELAY
+
+
+class AdaptiveDebounce:
+    """
+    ننتظر حسب المراجع نفسه: إذا يكتب رسائل متتالية بسرعة، فترة أقصر؛
+    وإذا الرسالة تبين كاملة (تنتهي بـ ؟، بيها رقم هاتف، طويلة) نرد أسرع.
+    النتيجة دايماً بين DEBOUNCE_MIN و DEBOUNCE_MAX.
+    """
+    name = "adaptive"
+
+    def delay(self, st, text):
+        gaps = sorted((st or {}).get("gaps") or [])
+        if gaps:
+            # فاصل المراجع المعتاد × هامش، حتى نلحك رسالته الجاية إذا بعده يكتب
+            base = gaps[len(gaps) // 2] * 1.5 + 1
+        else:
+            base = DEBOUNCE_MAX * 0.6
+
+        t = (text or "").strip()
+        if t.endswith(("؟", "?")):
+            base *= 0.5
+        if extract_iraqi_phone(t):
+            base *= 0.5
+        if len(t) >= 40:
+            base *= 0.7
+        return max(DEBOUNCE_MIN, min(DEBOUNCE_MAX, base))
+
+
+DEBOUNCE_POLICY_CLASSES = {cls.name: cls for cls in (FixedDebounce, AdaptiveDebounce)}
+
+def register_debounce_policy(cls):
+    DEBOUNCE_POLICY_CLASSES[cls.name] = cls
+    return cls
+
+
+class DebounceRouter:
+    """
+    يوزع المراجعين على الـ policies حسب الأوزان (crc32 للـ user_id، فنفس المراجع
+    ياخذ نفس الـ policy بكل الـ workers) ويجمع إحصائيات لكل policy:
+    time-to-first-reply ونسبة الردود اللي اجتها رسالة تكميلية بعدها مباشرة.
+    """
+
+    def __init__(self, spec=DEBOUNCE_POLICIES):
+        # الأسماء بس؛ الكلاسات تنجاب بأول استعمال حتى register_debounce_policy بعد الـ import يلحك
+        self.spec = []
+        for part in spec.split(","):
+            name, _, weight = part.strip().partition(":")
+            self.spec.append((name, int(weight or 1)))
+        self._policies = None
+        self._total = sum(w for _, w in self.spec)
+        self._lock = threading.Lock()
+        self._stats = {name: {"replies": 0, "ttfr_sum": 0.0, "ttfr_max": 0.0, "followups": 0} for name, _ in self.spec}
+
+    @property
+    def policies(self):
+        if self._policies is None:
+            with self._lock:
+                if self._policies is None:
+                    unknown = [name for name, _ in self.spec if name not in DEBOUNCE_POLICY_CLASSES]
+                    if unknown:
+                        raise KeyError(f"unknown debounce policy: {', '.join(unknown)}")
+                    self._policies = [(DEBOUNCE_POLICY_CLASSES[name](), w) for name, w in self.spec]
+        return self._policies
+
+    def policy_for(self, user_id):
+        slot = zlib.crc32(str(user_id).encode()) % self._total
+        for policy, weight in self.policies:
+            if slot < weight:
+                return policy
+            slot -= weight
+        return self.policies[-1][0]
+
+    def delay_for(self, user_id, st, text):
+        return self.policy_for(user_id).delay(st, text)
+
+    def record_reply(self, user_id, ttfr):
+        with self._lock:
+            s = self._stats[self.policy_for(user_id).name]
+            s["replies"] += 1
+            s["ttfr_sum"] += ttfr
+            s["ttfr_max"] = max(s["ttfr_max"], ttfr)
+
+    def record_followup(self, user_id):
+        with self._lock:
+            self._stats[self.policy_for(user_id).name]["followups"] += 1
+
+    def stats(self):
+        with self._lock:
+            out = {}
+            for name, s in self._stats.items():
+                n = s["replies"]
+                out[name] = {
+                    "replies": n,
+                    "ttfr_avg": round(s["ttfr_sum"] / n, 2) if n else 0.0,
+                    "ttfr_max": round(s["ttfr_max"], 2),
+                    "early_reply_rate": round(s["followups"] / n, 3) if n else 0.0,
+                }
+            return out
+
+
+DEBOUNCE = DebounceRouter()
+
+# =======================================================
+# 🧠 Chat Delay Reply (منع الردّ المزدوج)
+# =======================================================
+def schedule_reply(user_id, version_snapshot, delay=BUFFER_DELAY, trace_id=None):
+    # ينادى من REPLY_SCHEDULER بعد delay (فترة التجميع من DEBOUNCE) من آخر رسالة.
+    # كل الـ calls داخل الرد (الموديل + الإرسال وإعاداتهم) تتشارك REPLY_BUDGET،
+    # وكلها بكتالوج وprompt عيادة المراجع
+    set_trace(trace_id)
+    with deadline_budget(REPLY_BUDGET), use_tenant(tenant_of(user_id)):
+        _reply_batch(user_id, version_snapshot, delay)
+
+def take_batch(user_id, version_snapshot, delay):
+    """
+    اسحب الدفعة المتجمعة كنص واحد، بس إذا ماكو رسالة أحدث (msg_version نفسه)
+    ولسه آخر رسالة مو ضمن فترة التجميع — الفحص والسحب atomic بالـ store.
+    يرجع (النص، batch_since، وقت الانتظار) أو None.
+    """
+    batch_text = drain_pending_batch(user_id, expected_version=version_snapshot, quiet_for=delay - 0.05)
+    if not batch_text:
+        return None
+    batch_since = (get_session(user_id) or {}).get("batch_since") or time.time()
+    waited = time.time() - batch_since
+    METRICS.observe("stage_seconds", waited, stage="debounce")
+    return batch_text, batch_since, waited
+
+def quick_answer(user_id, batch_text):
+    # سؤال واحد واضح (سعر/دوام/موقع) → من الكتالوج مباشرة، غير هيج → الموديل (None)
+    reply = fast_path_reply(batch_text)
+    if not reply or reply == last_reply_of(user_id):
+        return None
+    METRICS.inc("answers_total", source="fast_path")
+    return reply
 
-    reply = ask_openai_chat(user_id, batch_text)
+def settle_reply(user_id, reply):
+    """يثبت الرد بالجلسة قبل الإرسال ويرجع وقته، أو None إذا الرد ما يطلع (فارغ أو مكرر)."""
     if not reply:
-        # طفي typing إذا شغال
-        if st.get("is_typing"):
-            send_typing_off(user_id)
-            st["is_typing"] = False
-        return
+        METRICS.inc("replies_suppressed_total", reason="empty")
+        update_session(user_id, inflight_texts=[])
+        return None
 
     # منع تكرار نفس الرد حرفياً
-    if reply.strip() == (st.get("last_reply") or "").strip():
-        if st.get("is_typing"):
-            send_typing_off(user_id)
-            st["is_typing"] = False
-        return
+    if reply.strip() == (last_reply_of(user_id) or "").strip():
+        METRICS.inc("replies_suppressed_total", reason="duplicate")
+        log("duplicate reply suppressed for", user_id)
+        update_session(user_id, inflight_texts=[])
+        return None
 
     append_history(user_id, "assistant", reply)
-    st["last_reply"] = reply
+    sent_at = time.time()
+    update_session(user_id, last_reply=reply, last_reply_at=sent_at, inflight_texts=[])
+    return sent_at
+
+def note_reply(user_id, sent, batch_since, sent_at, waited, answer_secs, send_secs):
+    ttr = time.time() - batch_since
+    METRICS.inc("replies_sent_total", status="pending" if sent is SEND_PENDING else "ok" if sent else "failed")
+    METRICS.observe("time_to_reply_seconds", ttr)
+    DEBOUNCE.record_reply(user_id, sent_at - batch_since)
+    log(f"reply user={user_id} wait={waited:.2f}s answer={answer_secs:.2f}s send={send_secs:.2f}s total={ttr:.2f}s")
+
+def _reply_batch(user_id, version_snapshot, delay):
+    batch = take_batch(user_id, version_snapshot, delay)
+    if batch is None:
+        # رسالة أحدث وصلت: إذا موعدها عدنا، typing يكمل وياها. إذا ماكو (وصلت لـ worker ثاني
+        # أو الباتش انسحب هناك) فاللي يرد مو إحنا، والـ typing مالتنا لازم يوكف
+        if not REPLY_SCHEDULER.scheduled(("reply", user_id)):
+            TYPING.release(user_id)
+        return
+    batch_text, batch_since, waited = batch
+
+    # ✅ إذا typing بعده ما اشتغل (مثلاً المستخدم كتب رسالة وحدة وردّنا بسرعة)
+    # شغله هسه قبل ما ننادي OpenAI
+    TYPING.begin_reply(user_id)
+
+    t_answer = time.monotonic()
+    reply = quick_answer(user_id, batch_text) or ask_openai_chat(user_id, batch_text)
+    answer_secs = time.monotonic() - t_answer
+    sent_at = settle_reply(user_id, reply)
 
-    # ✅ طفي typing قبل الإرسال
-    if st.get("is_typing"):
-        send_typing_off(user_id)
-        st["is_typing"] = False
+    # ✅ الرسالة نفسها تطفي typing، فما نحتاج typing_off قبل الإرسال
+    TYPING.finish(user_id, message_follows=sent_at is not None)
+    if sent_at is None:
+        return
 
-    send_message(user_id, reply)
+    t_send = time.monotonic()
+    sent = send_message(user_id, reply)
+    note_reply(user_id, sent, batch_since, sent_at, waited, answer_secs, time.monotonic() - t_send)
 
 
 
@@ -417,81 +3264,275 @@ def schedule_reply(user_id, version_snapshot):
 # =======================================================
 # 🧾 add_user_message (كاملة)
 # =======================================================
-def schedule_typing(user_id: str, typing_snapshot: int):
-    # انتظر 4 ثواني
-    time.sleep(TYPING_DELAY)
+def record_user_message(user_id, text):
+    """يسجل الرسالة بالجلسة ويرجع (msg_version, شكد ننتظر قبل الرد)."""
+    # الخطوات كلها تحت lock المراجع: الـ cleaner ما يمسح الجلسة بنصها،
+    # والرد ما يسحب الباتش قبل ما الـ msg_version يزيد
+    with STORE.locked(user_id):
+        ensure_session(user_id)
 
-    st = SESSIONS.get(user_id)
-    if not st:
-        return
+        # خزن بالهيستري (للسياق)
+        append_history(user_id, "user", text)
 
-    # إذا اجت رسالة أحدث، هذا التايمر ينعزل
-    if st.get("typing_version") != typing_snapshot:
-        return
+        # خزن بالباتش (للتجميع الحقيقي)
+        push_pending(user_id, text)
 
-    # إذا خلال الـ 4 ثواني خلص التجميع (يعني ردّينا)، لا تفعل typing
-    # (هنا نعتمد على is_typing يتصفّر بعد الرد)
-    if st.get("is_typing"):
-        return
+        # version counter يلغي أي رد قديم
+        current_version, followup = bump_versions(user_id)
+    if followup:
+        DEBOUNCE.record_followup(user_id)
 
-    # شغّل typing
-    send_typing(user_id)
-    st["is_typing"] = True
+    # المدة يقررها الـ debounce policy
+    return current_version, DEBOUNCE.delay_for(user_id, get_session(user_id), text)
 
-    # ✅ تحديث typing كل فترة حتى ما ينطفي بواجهة المستخدم
-    while True:
-        time.sleep(TYPING_REFRESH)
-        st2 = SESSIONS.get(user_id)
-        if not st2:
-            return
+def add_user_message(user_id, text):
+    current_version, delay = record_user_message(user_id, text)
 
-        # إذا ردّينا/وقفنا typing، نطلع
-        if not st2.get("is_typing"):
-            return
+    # اذا typing شغال من قبل، خليه (لا تسوي شي)
+    # اذا مو شغال، أجّل موعد التشغيل لبعد 4 ثواني
+    TYPING.on_message(user_id)
 
-        # إذا صارت رسالة أحدث وتبدل typing_version، نطلع ويجي تايمر جديد
-        if st2.get("typing_version") != typing_snapshot:
-            return
+    # الموعد ينعاد جدولته (ما نفتح thread جديد)
+    REPLY_SCHEDULER.schedule(
+        ("reply", user_id), delay, schedule_reply, user_id, current_version, delay, current_trace()
+    )
 
-        send_typing(user_id)
 
-def add_user_message(user_id, text):
-    ensure_session(user_id)
-    st = SESSIONS[user_id]
 
-    # خزن بالهيستري (للسياق)
-    append_history(user_id, "user", text)
+# =======================================================
+# 💾 Session Snapshot (الجلسات تبقى بعد deploy/restart)
+# =======================================================
+# مسار ملف (مثلاً sessions.db) لـ memory store بـ worker واحد؛ فارغ (الافتراضي) = بدون snapshot
+SESSION_SNAPSHOT = os.getenv("SESSION_SNAPSHOT", "")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "5"))     # كل كم ثانية نكتب الجلسات المتغيرة
+SNAPSHOT_LOAD_CHUNK = 500
+RESUME_DELAY = 2     # بعد الـ restart ننطي البروسس ثانيتين قبل ما نرد على الباتشات المعلقة
+RESUME_LEASE = 120   # باتش انجدول من الملف ما يرجع ينجدول (بأي worker) قبل دقيقتين
 
-    # خزن بالباتش (للتجميع الحقيقي)
-    push_pending(user_id, text)
 
-    st["last_message_time"] = time.time()
+class SessionSnapshot:
+    """
+    نسخة من جلسات الـ MemorySessionStore بملف SQLite.
+    - كل SNAPSHOT_INTERVAL نكتب بس الجلسات اللي بالـ dirty (incremental)، وبالـ SIGTERM/exit نكتب الباقي
+    - بالتشغيل ما ننتظر التحميل: thread يحمل الملف بدفعات (الأحدث أول)، وأي جلسة
+      ينطلب قبل ما توصل تنقرا لوحدها من الملف (fault)
+    - كل جلسة ترجع وبيها باتش معلق (pending أو inflight) تنجدول إلها الرد من جديد
+    الـ memory store = worker واحد، فالملف إله كاتب واحد. إذا أكثر من worker فتحوا نفس الملف
+    بالغلط، جدول resumed (lease على user_id + msg_version) يخلي باتش واحد ينرد مرة وحدة بس.
+    """
 
-    # ✅ جهّز typing بعد 4 ثواني
-    st["typing_version"] += 1
-    tver = st["typing_version"]
+    def __init__(self, store, path=SESSION_SNAPSHOT, interval=SNAPSHOT_INTERVAL, on_restore=None):
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.on_restore = on_restore
+        self.loaded = False
+        self.rows_loaded = 0
+        self.faults = 0
+        self.flushes = 0
+        self.last_flush_rows = 0
+        self.last_flush_ms = 0.0
+        self._io = threading.Lock()
+        self._db = self._connect()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id TEXT PRIMARY KEY, data TEXT NOT NULL, last_message_time REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS resumed (user_id TEXT PRIMARY KEY, msg_version INTEGER, until REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=REQUEST_TIMEOUT, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @staticmethod
+    def _decode(raw):
+        return SessionRecord(SQLiteSessionStore._load(raw))
+
+    def _adopt(self, stripe, user_id, st, front):
+        # ينادى تحت lock الـ stripe مال المراجع
+        stripe.sessions[user_id] = st
+        if front:
+            # الجلسات القديمة تروح للراس (أقدم من أي رسالة وصلت بعد التشغيل)
+            stripe.sessions.move_to_end(user_id, last=False)
+        if self.on_restore and (st.get("pending_texts") or st.get("inflight_texts")) \
+                and self._claim_resume(user_id, st.get("msg_version")):
+            self.on_restore(user_id, st)
+            stripe.dirty.add(user_id)
+
+    def _claim_resume(self, user_id, version):
+        """True إذا إحنا أول من ياخذ هذا الباتش (أو الـ lease القديم خلص)."""
+        now = time.time()
+        with self._io:
+            cur = self._db.execute(
+                "INSERT INTO resumed (user_id, msg_version, until) VALUES (?, ?, ?)"
+                " ON CONFLICT (user_id) DO UPDATE SET msg_version = excluded.msg_version, until = excluded.until"
+                " WHERE resumed.msg_version IS NOT excluded.msg_version OR resumed.until < ?",
+                (user_id, version, now + RESUME_LEASE, now),
+            )
+        return cur.rowcount == 1
+
+    def fault(self, stripe, user_id):
+        """جلسة وحدة من الملف (قبل ما يخلص التحميل الكامل). ينادى تحت lock الـ stripe."""
+        with self._io:
+            row = self._db.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        if not row:
+            return None
+        self.faults += 1
+        st = self._decode(row[0])
+        self._adopt(stripe, user_id, st, front=True)
+        return st
+
+    def _load_all(self):
+        t0 = time.monotonic()
+        cutoff = time.time() - SESSION_CLEAN_AFTER
+        db = self._connect()
+        cur = db.execute(
+            "SELECT user_id, data FROM sessions WHERE last_message_time >= ? ORDER BY last_message_time DESC",
+            (cutoff,),
+        )
+        while True:
+            rows = cur.fetchmany(SNAPSHOT_LOAD_CHUNK)
+            if not rows:
+                break
+            for uid, raw in rows:
+                st = self._decode(raw)
+                stripe = self.store.stripe(uid)
+                with stripe.lock:
+                    # الموجودة بالذاكرة (أو اللي انمسحت) أحدث من الملف
+                    if uid in stripe.sessions or uid in stripe.dirty:
+                        continue
+                    self._adopt(stripe, uid, st, front=True)
+                    self.rows_loaded += 1
+        db.close()
+        self.loaded = True
+        with self._io:
+            self._db.execute("DELETE FROM sessions WHERE last_message_time < ?", (cutoff,))
+            self._db.execute("DELETE FROM resumed WHERE until < ?", (time.time(),))
+        log(f"session snapshot loaded: {self.rows_loaded} sessions in {time.monotonic() - t0:.2f}s")
+
+    def flush(self):
+        t0 = time.monotonic()
+        ids, upserts, deletes = [], [], []
+        for stripe in self.store.stripes:
+            # stripe ورا stripe، حتى الكتابة ما توكف كل المراجعين سوية
+            with stripe.lock:
+                dirty, stripe.dirty = stripe.dirty, set()
+                for uid in dirty:
+                    st = stripe.sessions.get(uid)
+                    if st is None:
+                        deletes.append((uid,))
+                    else:
+                        data = json.dumps(st.as_dict(), ensure_ascii=False, default=list, separators=(",", ":"))
+                        upserts.append((uid, data, st["last_message_time"]))
+            ids.extend(dirty)
+        if not ids:
+            return 0
+        try:
+            with self._io:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO sessions (user_id, data, last_message_time) VALUES (?, ?, ?)", upserts
+                )
+                self._db.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+                self._db.execute("COMMIT")
+        except Exception:
+            with self._io:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+            # نرجعهم للـ dirty حتى ينكتبون بالمرة الجاية
+            for uid in ids:
+                stripe = self.store.stripe(uid)
+                with stripe.lock:
+                    stripe.dirty.add(uid)
+            raise
+        self.flushes += 1
+        self.last_flush_rows = len(ids)
+        self.last_flush_ms = round((time.monotonic() - t0) * 1000, 1)
+        return len(ids)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log("Snapshot flush error:", e)
+
+    def _flush_on_exit(self):
+        # بـ thread منفصل: إذا الـ signal وصل والـ main thread ماسك lock stripe، ما نعلك
+        t = threading.Thread(target=self.flush, daemon=True)
+        t.start()
+        t.join(timeout=10)
+
+    def _install_signal_handlers(self):
+        atexit.register(self._flush_on_exit)
+        if threading.current_thread() is not threading.main_thread():
+            return
+        prev = signal.getsignal(signal.SIGTERM)
+
+        def on_term(signum, frame):
+            self._flush_on_exit()
+            # نكمل بالـ handler القديم (مثلاً graceful shutdown مال gunicorn)
+            if callable(prev):
+                prev(signum, frame)
+            elif prev == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, on_term)
+
+    def start(self):
+        self._install_signal_handlers()
+        threading.Thread(target=self._load_all, daemon=True).start()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stats(self):
+        return {
+            "loaded": self.loaded,
+            "rows_loaded": self.rows_loaded,
+            "faults": self.faults,
+            "dirty": self.store.dirty_count(),
+            "flushes": self.flushes,
+            "last_flush_rows": self.last_flush_rows,
+            "last_flush_ms": self.last_flush_ms,
+        }
 
-    # اذا typing شغال من قبل، خليه (لا تسوي شي)
-    # اذا مو شغال، سوّي تايمر يشغله بعد 4 ثواني
-    if not st.get("is_typing"):
-        threading.Thread(
-            target=schedule_typing,
-            args=(user_id, tver),
-            daemon=True
-        ).start()
 
-    # version counter يلغي أي Thread قديم للرد
-    st["msg_version"] += 1
-    current_version = st["msg_version"]
+def requeue_inflight(st):
+    """يرجع نصوص الباتش المعلق (inflight + pending) للـ pending. False إذا قديمة وانرمت."""
+    texts = list(st.get("inflight_texts") or []) + list(st.get("pending_texts") or [])
+    st["inflight_texts"] = []
+    if time.time() - (st.get("last_message_time") or 0) > MEMORY_TIMEOUT:
+        # رسالة قديمة هواي — الجلسة نفسها راح تنعاد من الصفر
+        st["pending_texts"] = []
+        return False
+    st["pending_texts"] = texts[-PENDING_MAX:]
+    st["pending_since"] = st.get("pending_since") or st.get("batch_since") or time.time()
+    return True
 
-    threading.Thread(
-        target=schedule_reply,
-        args=(user_id, current_version),
-        daemon=True
-    ).start()
 
+def resume_pending(user_id, st):
+    """
+    جلسة رجعت من الـ snapshot وبيها باتش معلق (ينتظر الـ debounce أو انسحب وما انرد عليه):
+    نرجع النصوص للـ pending ونجدول الرد. ينادى تحت lock الـ stripe مال المراجع.
+    """
+    if not requeue_inflight(st):
+        return
+    REPLY_SCHEDULER.schedule(
+        ("reply", user_id), RESUME_DELAY, schedule_reply, user_id, st["msg_version"], 0, None
+    )
 
 
+SNAPSHOT = None
+if SESSION_SNAPSHOT and isinstance(STORE, MemorySessionStore) and THREADED:
+    SNAPSHOT = SessionSnapshot(STORE, on_restore=resume_pending)
+    STORE.snapshot = SNAPSHOT
+    SNAPSHOT.start()
+
 # =======================================================
 # 📡 WEBHOOK (GET verification)
 # =======================================================
@@ -501,15 +3542,237 @@ def verify():
         return request.args.get("hub.challenge")
     return "Error", 403
 
+# =======================================================
+# 📥 Ingest Queue (الـ webhook يرد فوراً والشغل يصير بالخلفية)
+# =======================================================
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_DB = os.getenv("INGEST_DB")     # مسار SQLite اختياري حتى الأحداث ما تضيع إذا طفى البروسس
+INGEST_LEASE = 30                      # حدث worker ما جدد الـ lease مالته 30 ثانية (طفى) ياخذه غيره
+
+class IngestQueue:
+    """
+    الـ webhook يحط الحدث بالطابور ويرجع 200 فوراً، و consumers منفصلين
+    يسوون استخراج الرقم والإشعار وتحديث الجلسة.
+    كل مستخدم دايماً على نفس الـ shard حتى رسائله تنعالج بالترتيب.
+    إذا INGEST_DB محدد، الحدث ينكتب بـ SQLite قبل الطابور وينمسح بعد ما يخلص.
+    الملف مشترك بين workers الـ gunicorn، فكل حدث عليه owner و lease يجدده صاحبه
+    كل INGEST_LEASE/3؛ اللي lease مالته خلص (البروسس طفى بالنص) ياخذه أي worker بعده حي.
+    """
+
+    def __init__(self, handler, workers=INGEST_WORKERS, maxsize=INGEST_QUEUE_SIZE, path=INGEST_DB,
+                 lease=INGEST_LEASE):
+        self.handler = handler
+        self.lease = lease
+        self.owner = f"{os.getpid()}:{random.getrandbits(32):08x}"
+        self._queues = [queue.Queue(maxsize=max(1, maxsize // max(1, workers))) for _ in range(max(1, workers))]
+        self._lock = threading.Lock()
+        self._db = None
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latency_avg = 0.0     # EWMA من لحظة الاستلام لحد ما ينعالج
+        self.latency_max = 0.0
+
+        if path:
+            self._db = sqlite3.connect(path, timeout=REQUEST_TIMEOUT, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS ingest (id INTEGER PRIMARY KEY, ts REAL, event TEXT)")
+            for column in ("owner TEXT", "lease_until REAL"):
+                try:
+                    # ملفات قبل الـ lease: صفوفها lease_until = NULL وتنحسب خالصة
+                    self._db.execute(f"ALTER TABLE ingest ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    pass
+
+    def start(self):
+        for q in self._queues:
+            threading.Thread(target=self._consume, args=(q,), daemon=True).start()
+        if self._db is not None:
+            self._recover()
+            threading.Thread(target=self._keep_leases, daemon=True).start()
+
+    def put(self, event):
+        """يرجع False إذا الحدث ما دخل (الطابور مليان أو INGEST_DB فشل) بدل ما نأخر رد الـ webhook."""
+        ts = time.time()
+        row_id = None
+        if self._db is not None:
+            try:
+                with self._lock:
+                    row_id = self._db.execute(
+                        "INSERT INTO ingest (ts, event, owner, lease_until) VALUES (?, ?, ?, ?)",
+                        (ts, json.dumps(event, ensure_ascii=False), self.owner, ts + self.lease),
+                    ).lastrowid
+            except sqlite3.Error as e:
+                with self._lock:
+                    self.dropped += 1
+                METRICS.inc("ingest_dropped_total")
+                log("ingest db write failed, event dropped for", event.get("user_id"), e)
+                return False
+        return self._enqueue(row_id, ts, event)
+
+    def _enqueue(self, row_id, ts, event):
+        q = self._queues[hash(event.get("user_id")) % len(self._queues)]
+        try:
+            q.put_nowait((row_id, ts, event))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            METRICS.inc("ingest_dropped_total")
+            log("ingest queue full, event dropped for", event.get("user_id"))
+            self._forget(row_id)
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _recover(self):
+        # بس الأحداث اللي lease مالتها خلص، ونصير إحنا owner بنفس الـ transaction،
+        # حتى إذا أكثر من worker فحص سوية، كل حدث يرجع لواحد بس، واللي عند worker حي ما ينلمس
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT id, ts, event FROM ingest WHERE lease_until IS NULL OR lease_until < ? ORDER BY id",
+                    (now,),
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE ingest SET owner = ?, lease_until = ? WHERE id = ?",
+                    [(self.owner, now + self.lease, r[0]) for r in rows],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        if rows:
+            METRICS.inc("ingest_recovered_total", len(rows))
+            log(f"ingest: recovered {len(rows)} events with expired leases")
+        for row_id, ts, event in rows:
+            self._enqueue(row_id, ts, json.loads(event))
+
+    def _keep_leases(self):
+        while True:
+            time.sleep(self.lease / 3)
+            try:
+                with self._lock:
+                    self._db.execute(
+                        "UPDATE ingest SET lease_until = ? WHERE owner = ?", (time.time() + self.lease, self.owner)
+                    )
+                self._recover()
+            except sqlite3.Error as e:
+                log("ingest lease error:", e)
+
+    def _forget(self, row_id):
+        if self._db is not None and row_id is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM ingest WHERE id = ?", (row_id,))
+
+    def _consume(self, q):
+        while True:
+            row_id, ts, event = q.get()
+            set_trace(event.get("trace"))
+            METRICS.observe("stage_seconds", time.time() - ts, stage="ingest_wait")
+            try:
+                self.handler(event)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                log("Ingest handler error:", e)
+            self._forget(row_id)
+
+            lat = time.time() - ts
+            with self._lock:
+                self.processed += 1
+                self.latency_avg = lat if self.processed == 1 else 0.9 * self.latency_avg + 0.1 * lat
+                self.latency_max = max(self.latency_max, lat)
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "depth": self.depth(),
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "latency_avg_ms": round(self.latency_avg * 1000, 1),
+                "latency_max_ms": round(self.latency_max * 1000, 1),
+            }
+
+
+def process_event(event):
+    """consumer: نفس الشغل اللي جان يصير داخل الـ webhook."""
+    user_id = event["user_id"]
+    txt = event.get("text", "")
+
+    with use_tenant(TENANTS.get(event.get("page"))) as tenant:
+        add_user_message(user_id, txt)
+
+        # الرقم يروح للـ outbox (بعد ما الجلسة تحدثت، حتى الاسم والخدمة يكونون وياه)
+        phone = extract_iraqi_phone(txt)
+        if phone:
+            facts = (get_session(user_id) or {}).get("facts") or {}
+            LEADS.add(user_id, phone, name=facts.get("name"), service=facts.get("service"), page=tenant.page_id)
+
+
+INGEST = IngestQueue(process_event)
+if THREADED:
+    INGEST.start()
+
 # =======================================================
 # 📡 WEBHOOK (POST messages)
 # =======================================================
+def valid_signature(body: bytes, header: str):
+    if not APP_SECRET:
+        return True
+    expected = "sha256=" + hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, header or "")
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    data = request.get_json(silent=True) or {}
+    with METRICS.timer("stage_seconds", stage="webhook"):
+        return handle_webhook()
 
+def handle_webhook():
+    return ingest_webhook(request.get_data(), request.headers.get("X-Hub-Signature-256"), INGEST.put)
+
+def ingest_webhook(body, signature, put):
+    """
+    يتحقق من التوقيع ويمنع التكرار، وكل رسالة نصية تطلع لـ put(event).
+    يرجع (نص, status). مشترك بين Flask (put = INGEST.put) و asgi_bot.
+    إذا put رجع False (أو فشل) نرجع الـ mid مو معالج ونرد 503، فيسبوك يعيد الإرسال
+    والرسائل اللي دخلت من نفس الطلب يمنعها فحص التكرار.
+    """
+    # هنا بس نتحقق ونمنع التكرار ونحط بالطابور — ولا أي HTTP call
+    set_trace(new_trace_id())
+    if not valid_signature(body, signature):
+        METRICS.inc("webhook_rejected_total")
+        log("webhook signature mismatch")
+        return "Error", 403
+    return ingest_events(body, put)
+
+def ingest_events(body, put):
+    """نص ingest_webhook بعد التوقيع: التكرار والـ put. asgi_bot يناديه من الـ consumer بعد ما رد 200."""
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict) or data.get("object", "page") != "page":
+        return "OK", 200
+
+    rejected = False
     try:
         for entry in data.get("entry", []):
+            # كل entry من صفحة وحدة (entry.id)؛ صفحة مو بـ TENANTS_FILE ما نرد عليها
+            tenant = TENANTS.for_page(entry.get("id"))
+            if tenant is None:
+                METRICS.inc("webhook_unknown_page_total")
+                log("webhook entry for unknown page", entry.get("id"))
+                continue
             for ev in entry.get("messaging", []):
                 sender = ev.get("sender", {})
                 user_id = sender.get("id")
@@ -523,20 +3786,27 @@ def webhook():
                 msg_id = msg.get("mid")
 
                 # منع تكرار نفس الرسالة
-                if msg_id:
-                    if msg_id in PROCESSED_MESSAGES:
-                        continue
-                    PROCESSED_MESSAGES[msg_id] = time.time()
+                if msg_id and not STORE.mark_processed(msg_id):
+                    METRICS.inc("webhook_duplicates_total")
+                    continue
 
                 # نص
                 if "text" in msg:
-                    txt = msg.get("text", "")
-
-                    phone = extract_iraqi_phone(txt)
-                    if phone:
-                        notify_callmebot(phone)
-
-                    add_user_message(user_id, txt)
+                    # كل رسالة trace خاص بيها يمشي وياها لحد الرد
+                    trace = new_trace_id()
+                    set_trace(trace)
+                    METRICS.inc("messages_received_total")
+                    METRICS.inc("tenant_messages_total", tenant=tenant.name)
+                    try:
+                        accepted = put({"user_id": user_id, "text": msg.get("text", ""), "mid": msg_id,
+                                        "trace": trace, "page": tenant.page_id})
+                    except Exception as e:
+                        log("ingest put failed:", e)
+                        accepted = False
+                    if not accepted:
+                        if msg_id:
+                            STORE.unmark_processed(msg_id)
+                        rejected = True
 
                 # مرفقات (صور/فويس/فيديو/ملفات)
                 elif "attachments" in msg:
@@ -546,10 +3816,75 @@ def webhook():
 
 
     except Exception as e:
-        print("Webhook error:", e)
+        log("Webhook error:", e)
 
+    if rejected:
+        METRICS.inc("webhook_retry_requested_total")
+        return "Busy", 503
     return "OK", 200
 
+# =======================================================
+# 📈 STATS
+# =======================================================
+def tenant_stats():
+    return [
+        {
+            "page": t.page_id,
+            "name": t.name,
+            "model_quota": t.model_concurrency,
+            "model_inflight": MODEL_EXECUTOR.tenant_inflight(t),
+        }
+        for t in TENANTS.tenants
+    ]
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return {
+        "threads": threading.active_count(),
+        "rss_bytes": rss_bytes(),
+        "sessions": STORE.count(),
+        "sessions_evicted": getattr(STORE, "evicted", 0),
+        "scheduled_timers": REPLY_SCHEDULER.pending(),
+        "answer_cache": ANSWER_CACHE.stats(),
+        "ingest": INGEST.stats(),
+        "typing": TYPING.stats(),
+        "debounce": DEBOUNCE.stats(),
+        "openai": LLM_STATS.stats(),
+        "breakers": {name: b.stats() for name, b in BREAKERS.items()},
+        "graph_batch": GRAPH_BATCHER.stats(),
+        "leads": LEADS.stats(),
+        "model_executor": MODEL_EXECUTOR.stats(),
+        "routing": ROUTER.stats(),
+        "snapshot": SNAPSHOT.stats() if SNAPSHOT else None,
+        "tenants": tenant_stats(),
+    }
+
+
+METRICS.gauge("threads", threading.active_count)
+METRICS.gauge("rss_bytes", rss_bytes)
+METRICS.gauge("sessions_active", STORE.count)
+METRICS.gauge("pending_batches", REPLY_SCHEDULER.pending)
+METRICS.gauge("ingest_queue_depth", INGEST.depth)
+METRICS.gauge("typing_active", TYPING.active)
+METRICS.gauge("graph_outbound_depth", GRAPH_BATCHER.depth)
+METRICS.gauge("lead_outbox_pending", LEADS.pending)
+METRICS.gauge("model_queue_depth", MODEL_EXECUTOR.depth)
+METRICS.gauge("model_inflight", MODEL_EXECUTOR.inflight)
+METRICS.gauge("answer_cache_entries", lambda: ANSWER_CACHE.stats()["size"])
+for _name, _breaker in BREAKERS.items():
+    METRICS.gauge("circuit_open", lambda b=_breaker: int(b.is_open()), endpoint=_name)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "10000"))
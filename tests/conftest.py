@@ -0,0 +1,17 @@
+"""
+البوت يقرا الإعدادات ويشغل الـ singletons وقت الـ import، فنثبت بيئة اختبار قبل أي import:
+بدون OpenAI حقيقي، الـ leads والـ snapshot بالذاكرة، وبدون threads الخلفية
+(BOT_RUNTIME=asyncio) حتى asgi_bot يتستورد بنفس البروسس.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LEAD_DB", ":memory:")
+os.environ["SESSION_SNAPSHOT"] = ""
+os.environ["SESSION_STORE_URL"] = "memory"
+os.environ["BOT_RUNTIME"] = "asyncio"
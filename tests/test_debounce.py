@@ -0,0 +1,21 @@
+"""DebounceRouter: policy تنسجل بعد ما الـ router انخلق (مثل DEBOUNCE بالـ import) تشتغل."""
+import bot
+
+
+def test_policy_registered_after_router(monkeypatch):
+    monkeypatch.setattr(bot, "DEBOUNCE_POLICY_CLASSES", dict(bot.DEBOUNCE_POLICY_CLASSES))
+    router = bot.DebounceRouter("fixed:1,instant:1")
+
+    @bot.register_debounce_policy
+    class InstantDebounce:
+        name = "instant"
+
+        def delay(self, st, text):
+            return 0.0
+
+    names = {router.policy_for(f"u{i}").name for i in range(50)}
+    assert names == {"fixed", "instant"}
+    user = next(f"u{i}" for i in range(50) if router.policy_for(f"u{i}").name == "instant")
+    assert router.delay_for(user, {}, "هلا") == 0.0
+    router.record_reply(user, 1.5)
+    assert router.stats()["instant"]["replies"] == 1
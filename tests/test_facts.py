@@ -0,0 +1,44 @@
+import pytest
+
+import bot
+
+
+def facts_of(text):
+    st = {}
+    bot._extract_facts(st, text)
+    return st["facts"]
+
+
+@pytest.mark.parametrize("text, name", [
+    ("اسمي أحمد علي", "أحمد علي"),
+    ("الاسم: زينب", "زينب"),
+    ("اريد احجز اسمي حسين 07701234567", "حسين"),
+])
+def test_name_is_extracted(text, name):
+    assert facts_of(text)["name"] == name
+
+
+@pytest.mark.parametrize("text", [
+    "انا عندي سن مكسور",
+    "الضمانات عدكم",
+    "انا خايف من الوجع",
+    "باسمي الشخصي",
+    "بيش التغليف",
+])
+def test_no_false_name(text):
+    assert "name" not in facts_of(text)
+
+
+@pytest.mark.parametrize("text, day", [
+    ("اريد احجز باجر", "باجر"),
+    ("اكدر اجي اليوم؟", "اليوم"),
+    ("عدكم موعد الخميس", "الخميس"),
+    ("ممكن الموعد يوم السبت", "السبت"),
+])
+def test_requested_day_with_booking(text, day):
+    assert facts_of(text)["day"] == day
+
+
+@pytest.mark.parametrize("text", ["اليوم سني يوجعني", "باجر اسألكم عن السعر", "الجمعه عطله؟"])
+def test_day_without_booking_is_not_requested(text):
+    assert "day" not in facts_of(text)
@@ -0,0 +1,53 @@
+"""GraphBatcher.submit: إذا الوقت خلص، الـ item ينسحب من الطابور (ما ينبعث بعدين) أو يرجع SEND_PENDING."""
+import threading
+
+import bot
+
+
+class FakeMessenger:
+    token = "tok"
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.posted = []
+
+    def post_message(self, body, retries=1, token=None):
+        self.gate.wait(5)
+        self.posted.append(body)
+        return {"message_id": "m1"}
+
+
+def test_timed_out_item_is_cancelled_while_queued():
+    messenger = FakeMessenger()
+    batcher = bot.GraphBatcher(messenger, window=0)
+    # الـ batcher ما مشتغل → الـ item يبقى بالطابور لحد ما الوقت يخلص
+    with bot.deadline_budget(0.1):
+        assert batcher.submit({"recipient": {"id": "u1"}, "message": {"text": "هلا"}}) is None
+    assert batcher.depth() == 0
+    batcher.start()
+    messenger.gate.set()
+    assert batcher.submit({"recipient": {"id": "u1"}, "message": {"text": "ثانية"}})
+    assert [b["message"]["text"] for b in messenger.posted] == ["ثانية"]
+
+
+def test_timed_out_item_in_flight_is_pending():
+    messenger = FakeMessenger()
+    batcher = bot.GraphBatcher(messenger, window=0)
+    batcher.start()
+    with bot.deadline_budget(0.2):
+        assert batcher.submit({"recipient": {"id": "u2"}, "message": {"text": "هلا"}}) is bot.SEND_PENDING
+    messenger.gate.set()
+
+
+def test_async_timed_out_item_is_cancelled_while_queued():
+    import asyncio
+
+    import asgi_bot
+
+    async def main():
+        graph = asgi_bot.AsyncGraph(batch=True, window=10)
+        assert await graph.send("u3", {"message": {"text": "هلا"}}, "tok", timeout=0.05) is None
+        assert graph.depth() == 0
+        graph._flush_handle.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+"""ingest_webhook و IngestQueue: الحدث اللي ما دخل الطابور ما ينحسب معالج، وفيسبوك يعيده."""
+import json
+import time
+
+import bot
+
+
+def _body(mid, text="بيش التنظيف"):
+    page = bot.TENANTS.default.page_id
+    return json.dumps({"object": "page", "entry": [{"id": page, "messaging": [
+        {"sender": {"id": "u-ingest"}, "message": {"mid": mid, "text": text}}]}]}).encode()
+
+
+def test_failed_put_is_retried():
+    assert bot.ingest_webhook(_body("m-full"), None, lambda event: False) == ("Busy", 503)
+
+    def broken(event):
+        raise RuntimeError("queue down")
+
+    assert bot.ingest_webhook(_body("m-full"), None, broken) == ("Busy", 503)
+
+    events = []
+    assert bot.ingest_webhook(_body("m-full"), None, lambda event: events.append(event) or True) == ("OK", 200)
+    assert [e["mid"] for e in events] == ["m-full"]
+    # بعد ما دخل، الإعادة تنمنع
+    assert bot.ingest_webhook(_body("m-full"), None, lambda event: events.append(event) or True) == ("OK", 200)
+    assert len(events) == 1
+
+
+def test_put_reports_db_failure(tmp_path):
+    q = bot.IngestQueue(lambda event: None, workers=1, path=str(tmp_path / "ingest.db"))
+    q._db.close()
+    assert q.put({"user_id": "u", "text": "هلا"}) is False
+    assert q.stats()["dropped"] == 1
+
+
+def test_recover_skips_live_leases(tmp_path):
+    path = str(tmp_path / "ingest.db")
+    live = bot.IngestQueue(lambda event: None, workers=1, path=path)     # consumers ما اشتغلت: الأحداث باقية
+    live.put({"user_id": "u1", "text": "بالطريق عند worker حي"})
+    live._db.execute("INSERT INTO ingest (ts, event) VALUES (?, ?)", (0, json.dumps({"user_id": "u2", "text": "قديم"})))
+
+    handled = []
+    other = bot.IngestQueue(lambda event: handled.append(event["text"]), workers=1, path=path)
+    other.start()
+    deadline = time.time() + 2
+    while len(handled) < 1 and time.time() < deadline:
+        time.sleep(0.02)
+    assert handled == ["قديم"]
+
+    # الـ worker الأول طفى: الـ lease مالته يخلص وغيره ياخذ الحدث
+    live._db.execute("UPDATE ingest SET lease_until = 0 WHERE owner = ?", (live.owner,))
+    other._recover()
+    deadline = time.time() + 2
+    while len(handled) < 2 and time.time() < deadline:
+        time.sleep(0.02)
+    assert handled == ["قديم", "بالطريق عند worker حي"]
+    assert other._db.execute("SELECT COUNT(*) FROM ingest").fetchone()[0] == 0
+
+
+def test_asgi_webhook_acks_before_sqlite(monkeypatch):
+    import asyncio
+    import threading
+
+    import asgi_bot
+
+    events, gate = [], threading.Event()
+    monkeypatch.setattr(asgi_bot, "process_event", lambda event: events.append(event["mid"]) or True)
+
+    async def main():
+        monkeypatch.setattr(asgi_bot, "LOOP", asyncio.get_running_loop())
+        monkeypatch.setattr(asgi_bot, "WEBHOOK_QUEUE", asyncio.Queue(maxsize=1))
+        # الـ thread مال الـ ingest مشغول (SQLite بطيء) → الـ ack ما ينتظره
+        busy = asgi_bot.LOOP.run_in_executor(asgi_bot.INGEST_POOL, gate.wait, 5)
+        assert asgi_bot.accept_webhook(_body("m-asgi-1"), None) == ("OK", 200)
+        assert asgi_bot.accept_webhook(_body("m-asgi-2"), None) == ("Busy", 503)
+        consumer = asyncio.create_task(asgi_bot.webhook_consumer())
+        await asyncio.sleep(0.05)
+        assert events == []
+        gate.set()
+        await busy
+        while asgi_bot.WEBHOOK_QUEUE.qsize() or not events:
+            await asyncio.sleep(0.01)
+        consumer.cancel()
+
+    asyncio.run(main())
+    assert events == ["m-asgi-1"]
@@ -0,0 +1,38 @@
+"""نوايا الكتالوج والـ fast path: سؤال الموقع لازم يذكر المكان، وأي كلمة مو معروفة تروح للموديل."""
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("text", ["وين مكانكم", "وين العيادة", "شنو العنوان", "ممكن اللوكيشن", "وين محلكم"])
+def test_location_questions(text):
+    assert ("info", "location") in bot.TENANTS.default.intents.match(text)[1]
+    assert bot.fast_path_reply(text).startswith("موقعنا")
+
+
+@pytest.mark.parametrize("text", ["وين صرتو", "وين الرد مالتكم", "وين الحجز مالتي"])
+def test_where_without_a_place_is_not_location(text):
+    assert ("info", "location") not in bot.TENANTS.default.intents.match(text)[1]
+    assert bot.fast_path_reply(text) is None
+
+
+@pytest.mark.parametrize("text", ["عدكم تقويم شفاف بيش", "بيش قلع ضرس العقل", "شكد تبييض بالبيت"])
+def test_unknown_modifier_goes_to_model(text):
+    assert bot.fast_path_reply(text) is None
+
+
+@pytest.mark.parametrize("text", ["شكد القلع؟", "اكو تقسيط؟", "شنو سعر التنظيف", "بيش تبييض الاسنان", "عدكم تقويم بيش"])
+def test_plain_catalog_questions_use_fast_path(text):
+    assert bot.fast_path_reply(text)
+
+
+def test_warranty_note_only_on_services_that_carry_it():
+    assert "ضمان" in bot.fast_path_reply("بيش الزاركون")
+    assert "ضمان" not in bot.fast_path_reply("شكد القلع")
+    assert "ضمان" not in bot.fast_path_reply("شنو سعر التنظيف")
+
+
+def test_normalize_keeps_repeated_digits():
+    assert bot.normalize_arabic("هلااااا") == "هلا"
+    assert bot.normalize_arabic("عندي 1000 دينار و ١٠٠٠") == "عندي 1000 دينار و 1000"
+    assert bot.normalize_arabic("07770001112") == "07770001112"
@@ -0,0 +1,25 @@
+"""LeadOutbox: الملف ما ينفتح بالـ import، والمسار الافتراضي جنب bot.py مو بالـ cwd."""
+import os
+import subprocess
+import sys
+
+import bot
+from conftest import ROOT
+
+
+def test_import_does_not_open_lead_db(tmp_path):
+    env = {k: v for k, v in os.environ.items() if k != "LEAD_DB"}
+    code = "import bot; print(bot.LEAD_DB); print(bot.LEADS._conn is None)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env={**env, "PYTHONPATH": ROOT},
+                         capture_output=True, text=True, check=True).stdout.split("\n")
+    assert out[0] == os.path.join(ROOT, "leads.db")
+    assert out[1] == "True"
+    assert not os.listdir(tmp_path)
+
+
+def test_lead_db_opens_on_first_use(tmp_path):
+    path = tmp_path / "leads.db"
+    outbox = bot.LeadOutbox(path=str(path))
+    assert not path.exists()
+    assert outbox.add("u1", "07701234567")
+    assert path.exists() and outbox.pending() == 1
@@ -0,0 +1,8 @@
+"""Metrics.render: قيم الـ labels تطلع بصيغة exposition صحيحة."""
+import bot
+
+
+def test_label_values_are_escaped():
+    m = bot.Metrics(prefix="t_")
+    m.inc("events_total", tenant='عيادة "النور"\\بغداد\nالكرادة')
+    assert 't_events_total{tenant="عيادة \\"النور\\"\\\\بغداد\\nالكرادة"} 1' in m.render().splitlines()
@@ -0,0 +1,28 @@
+"""ModelGate (وضع asgi): call واحد بالطريق لكل مستخدم وبالترتيب، والمستخدمين الباقين ما ينتظرونه."""
+import asyncio
+
+import asgi_bot
+
+
+def test_one_call_per_user_in_order():
+    gate = asgi_bot.ModelGate(workers=4, max_queue=10)
+    running, peak, done = [], {}, []
+
+    async def call(user_id, n):
+        running.append(user_id)
+        peak[user_id] = max(peak.get(user_id, 0), running.count(user_id))
+        await asyncio.sleep(0.05)
+        running.remove(user_id)
+        done.append((user_id, n))
+        return n
+
+    async def main():
+        jobs = [gate.run("a", call, "a", n) for n in range(3)] + [gate.run("b", call, "b", 0)]
+        return await asyncio.gather(*jobs)
+
+    assert asyncio.run(main()) == [0, 1, 2, 0]
+    assert peak == {"a": 1, "b": 1}
+    assert [n for user_id, n in done if user_id == "a"] == [0, 1, 2]
+    # b ما ينتظر ورا طابور a
+    assert done.index(("b", 0)) < done.index(("a", 1))
+    assert not gate._user_locks and gate.depth() == 0 and gate.inflight() == 0
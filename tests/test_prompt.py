@@ -0,0 +1,14 @@
+"""render_prompt: الحقول تنبدل، وأي قوس ثاني بـ prompt العيادة يبقى مثل ما هو."""
+import bot
+
+
+def test_braces_in_tenant_prompt_are_kept():
+    template = 'اتصل على {phone}. إذا طلب JSON رجعه بهالشكل: {"name": "..."} أو {غير_معروف} و }'
+    out = bot.render_prompt(template)
+    assert out == ('اتصل على 07728802820. إذا طلب JSON رجعه بهالشكل: {"name": "..."} أو {غير_معروف} و }')
+
+
+def test_default_prompt_has_no_placeholders_left():
+    out = bot.render_prompt(bot.SYSTEM_PROMPT_TEMPLATE)
+    assert "{catalog}" not in out and "{phone}" not in out
+    assert bot.catalog_prompt_section() in out
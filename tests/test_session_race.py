@@ -0,0 +1,29 @@
+"""نسخة قصيرة من bench/session_race.py: كل رسالة تنسحب بباتش مرة وحدة بالضبط، بالـ memory store وبـ SQLite."""
+import pytest
+
+import bot
+import session_race
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite"])
+def test_every_message_drained_once(store, tmp_path, monkeypatch):
+    if store == "memory":
+        monkeypatch.setattr(bot, "STORE", bot.MemorySessionStore())
+    else:
+        monkeypatch.setattr(bot, "STORE", bot.SQLiteSessionStore(str(tmp_path / "sessions.db")))
+    monkeypatch.setattr(bot, "PENDING_MAX", bot.PENDING_MAX)
+
+    r = session_race.race(bot, writers=4, messages=30, repliers=3, drains=60, timeout=20, fillers=1)
+    assert not r["errors"]
+    assert r["enough"], r["drained"]
+    assert not r["lost"] and not r["duplicated"]
+
+
+def test_sqlite_locked_is_one_transaction(tmp_path):
+    store = bot.SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    with pytest.raises(RuntimeError):
+        with store.locked("u1"):
+            store.modify("u1", lambda st: ({"msg_version": 1, "last_message_time": 0}, None))
+            raise RuntimeError("crash between steps")
+    # الـ modify اللي داخل locked انلغى ويا الباقي
+    assert store.get("u1") is None
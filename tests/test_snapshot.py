@@ -0,0 +1,33 @@
+"""SessionSnapshot: باتش معلق بالملف ينجدول مرة وحدة بس، حتى لو أكثر من worker فتح نفس الملف."""
+import json
+import time
+
+import bot
+
+
+def test_pending_batch_resumes_once(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    writer = bot.SessionSnapshot(bot.MemorySessionStore(), path=path)
+    st = {"pending_texts": ["بيش التنظيف"], "msg_version": 3, "last_message_time": time.time()}
+    writer._db.execute("INSERT INTO sessions VALUES (?, ?, ?)", ("u1", json.dumps(st), st["last_message_time"]))
+
+    resumed = []
+    workers = [
+        bot.SessionSnapshot(bot.MemorySessionStore(), path=path, on_restore=lambda uid, s, n=n: resumed.append(n))
+        for n in range(2)
+    ]
+    for snap in workers:
+        stripe = snap.store.stripe("u1")
+        with stripe.lock:
+            assert snap.fault(stripe, "u1")["msg_version"] == 3
+    assert resumed == [0]
+
+    # رسالة أحدث (msg_version جديد) تنجدول عادي
+    st["msg_version"] = 4
+    writer._db.execute("UPDATE sessions SET data = ? WHERE user_id = 'u1'", (json.dumps(st),))
+    snap = workers[1]
+    stripe = snap.store.stripe("u1")
+    with stripe.lock:
+        del stripe.sessions["u1"]
+        snap.fault(stripe, "u1")
+    assert resumed == [0, 1]
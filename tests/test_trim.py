@@ -0,0 +1,46 @@
+import bot
+
+
+def test_cuts_at_last_sentence_end_within_budget():
+    text = "هلا بيك. " + " ".join(["كلمة"] * 60)
+    assert bot.trim_to_sentence(text, words=45) == "هلا بيك."
+
+
+def test_no_sentence_end_keeps_text_cut_to_budget():
+    words = [f"كلمة{i}،" for i in range(50)]
+    out = bot.trim_to_sentence(" ".join(words), words=45)
+    assert out == " ".join(words[:45])
+
+
+def test_short_text_without_terminator_is_kept():
+    assert bot.trim_to_sentence("هلا بيك اكدر اساعدك") == "هلا بيك اكدر اساعدك"
+
+
+def test_stream_cut_without_terminator_is_not_a_fallback(monkeypatch):
+    # stream طويل بدون نقطة: complete_chat يقصه على الميزانية بدل ما يرجع فارغ
+    class Delta:
+        def __init__(self, content):
+            self.content = content
+
+    class Choice:
+        def __init__(self, content):
+            self.delta = Delta(content)
+            self.finish_reason = None
+
+    class Chunk:
+        usage = None
+
+        def __init__(self, content):
+            self.choices = [Choice(content)]
+
+    class Stream:
+        def __iter__(self):
+            return iter([Chunk(f"كلمة{i}، ") for i in range(80)])
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(bot, "OPENAI_STREAM", True)
+    monkeypatch.setattr(bot.client.chat.completions, "create", lambda **kw: Stream())
+    out = bot.complete_chat([{"role": "user", "content": "سؤال"}])
+    assert out and len(out.split()) <= bot.REPLY_WORD_BUDGET
@@ -0,0 +1,41 @@
+"""TypingManager: Graph بطيء لمستخدم ما يوكف typing الباقين، و finish ينتظر typing_on اللي بالطريق."""
+import threading
+import time
+
+import bot
+
+
+def test_slow_typing_send_does_not_block_others(monkeypatch):
+    release = threading.Event()
+    sent = []
+
+    def send_typing(user_id):
+        if user_id == "slow":
+            release.wait(5)
+        sent.append((user_id, "typing_on"))
+
+    monkeypatch.setattr(bot, "send_typing", send_typing)
+    monkeypatch.setattr(bot, "send_typing_off", lambda user_id: sent.append((user_id, "typing_off")))
+    typing = bot.TypingManager(delay=0.05, refresh=0.1, senders=2)
+    typing.start()
+
+    typing.on_message("slow")
+    time.sleep(0.2)                     # typing_on مال slow واكف بـ Graph
+    typing.on_message("fast")
+    time.sleep(0.3)
+    assert ("fast", "typing_on") in sent
+
+    t0 = time.monotonic()
+    typing.finish("fast", message_follows=False)
+    assert time.monotonic() - t0 < 0.5
+    assert sent[-1] == ("fast", "typing_off")
+
+    # finish مال slow ما يرجع لحد ما الـ typing_on اللي بالطريق يوصل، فما يطلع بعد الرد
+    done = threading.Event()
+    threading.Thread(target=lambda: (typing.finish("slow", message_follows=True), done.set())).start()
+    assert not done.wait(0.3)
+    release.set()
+    assert done.wait(2)
+    assert sent.count(("slow", "typing_on")) == 1
+    time.sleep(0.3)
+    assert sent.count(("slow", "typing_on")) == 1
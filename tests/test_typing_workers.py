@@ -0,0 +1,113 @@
+"""
+typing مع أكثر من worker على نفس الـ SQLite store: الـ worker اللي ما رد (الباتش سحبه غيره)
+لازم يبطل typing، فماكو sender_action يوصل للمراجع بعد الرد.
+"""
+import hashlib
+import hmac
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+import requests
+
+from conftest import ROOT
+from stubs import start_stub_server
+
+SECRET = "typing-test"
+USERS = 12
+MESSAGES = 3
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _post(url, user_id, i):
+    body = json.dumps({"object": "page", "entry": [{"id": "page", "messaging": [{
+        "sender": {"id": user_id}, "message": {"mid": f"{user_id}-{i}", "text": f"سؤال رقم {i} عن التغليف"},
+    }]}]}).encode()
+    sig = "sha256=" + hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+    # بدون keep-alive حتى الطلبات تتوزع على الـ workers
+    r = requests.post(f"{url}/webhook", data=body, timeout=10,
+                      headers={"X-Hub-Signature-256": sig, "Connection": "close"})
+    assert r.status_code == 200
+
+
+SERVERS = {
+    "gunicorn": lambda port: ["gunicorn", "bot:app", "--bind", f"127.0.0.1:{port}", "--workers", "2",
+                              "--threads", "8", "--log-level", "warning"],
+    "uvicorn": lambda port: ["uvicorn", "asgi_bot:app", "--host", "127.0.0.1", "--port", str(port),
+                             "--workers", "2", "--log-level", "warning"],
+}
+
+
+@pytest.mark.parametrize("server", sorted(SERVERS))
+def test_no_typing_after_reply_with_two_workers(server):
+    stub, rec, base = start_stub_server("fixed:0.3", "fixed:0.01", "fixed:0.01")
+    data_dir = tempfile.mkdtemp(prefix="typing-test-")
+    port = _free_port()
+    env = dict(os.environ)
+    env.pop("BOT_RUNTIME", None)    # كل سيرفر يختار وضعه (gunicorn → threads)
+    env.update({
+        "SESSION_STORE_URL": f"sqlite:///{os.path.join(data_dir, 'sessions.db')}",
+        "SESSION_SNAPSHOT": "",
+        "LEAD_DB": os.path.join(data_dir, "leads.db"),
+        "PAGE_ACCESS_TOKEN": "test",
+        "OPENAI_API_KEY": "test",
+        "OPENAI_BASE_URL": f"{base}/v1",
+        "GRAPH_API_BASE": base,
+        "CALLMEBOT_URL": f"{base}/text.php",
+        "APP_SECRET": SECRET,
+        "BUFFER_DELAY": "1.5",
+        "TYPING_DELAY": "0.3",
+        "TYPING_REFRESH": "1",
+        "ANSWER_CACHE_SIZE": "0",
+    })
+    proc = subprocess.Popen(
+        [sys.executable, "-m", *SERVERS[server](port)],
+        cwd=ROOT, env=env, start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                requests.get(f"{url}/stats", timeout=1)
+                break
+            except requests.RequestException:
+                assert time.time() < deadline, "bot did not start"
+                time.sleep(0.2)
+
+        users = [f"tw-{n}" for n in range(USERS)]
+        for i in range(MESSAGES):
+            for uid in users:
+                _post(url, uid, i)
+            time.sleep(0.6)
+
+        deadline = time.time() + 30
+        while {rid for _, rid in rec.replies()} != set(users):
+            assert time.time() < deadline, "not every user got a reply"
+            time.sleep(0.2)
+        # كافي لعدة دورات TYPING_REFRESH: الـ worker الثاني لو بقى يعيد typing يبين هنا
+        time.sleep(5)
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=10)
+        stub.shutdown()
+
+    with rec.lock:
+        events = list(rec.graph)
+    late = []
+    for uid in users:
+        last_reply = max(ts for ts, rid, kind, _ in events if rid == uid and kind == "message")
+        late += [(uid, kind, round(ts - last_reply, 1)) for ts, rid, kind, _ in events
+                 if rid == uid and kind != "message" and ts > last_reply]
+    assert not late, late